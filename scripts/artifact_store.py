@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Store for intermediate files of the prediction pipeline, e.g.
+# segmentations, votes and basic and enhanced parses, keyed by the
+# content of the input files and a signature of the step, i.e. the
+# module, model and options used to produce the file.
+#
+# Unlike a check for an existing output file, this detects outputs
+# that are stale because an input changed, and re-uses outputs for
+# identical inputs under a different name. Files are stored once per
+# content in objects/ and keys/ holds hard links to the objects.
+# Outputs are hard links to the stored objects where possible, i.e.
+# storing and re-using an output does not copy it.
+#
+# As in eval_store.py, entries are moved into place with rename() to be
+# safe with concurrent processes and the least recently used objects are
+# removed when the store grows beyond EUD_ARTIFACT_STORE_SIZE. As keys,
+# objects and outputs share an inode, the time of last use of a key is
+# recorded in a separate, empty file in stamps/. Note that an evicted
+# object still takes up disk space while pipeline files link to it.
+#
+# The store is in the temp folder unless EUD_ARTIFACT_STORE_DIR is set
+# and can be disabled with EUD_ARTIFACT_STORE=0. Outputs produced before
+# the store was used are trusted and added to the store if they are
+# newer than their inputs, as the pipeline did before the store. Set
+# EUD_ARTIFACT_STORE_ADOPT=0 to re-compute them instead.
+
+from __future__ import print_function
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+import utilities
+
+class ArtifactStore:
+
+    def __init__(self, store_dir, max_size = None):
+        self.store_dir = store_dir
+        if max_size is None:
+            if 'EUD_ARTIFACT_STORE_SIZE' in os.environ:
+                max_size = utilities.float_with_suffix(
+                    os.environ['EUD_ARTIFACT_STORE_SIZE']
+                )
+            else:
+                max_size = 16 * 1024**3
+        self.max_size = max_size
+        self.path2hash = {}
+        # running estimate of the size of the store to
+        # avoid scanning the store on each add()
+        self.size_estimate = None
+        self.last_scan = 0.0
+        self.scan_interval = 600.0
+
+    def get_file_hash(self, path):
+        ''' sha256 of the file content, re-using the hash of the
+            previous call if size and modification time did not
+            change
+        '''
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime, stat.st_ino)
+        if path in self.path2hash:
+            last_signature, h = self.path2hash[path]
+            if last_signature == signature:
+                return h
+        h = hashlib.sha256()
+        f = open(path, 'rb')
+        while True:
+            data = f.read(1024**2)
+            if not data:
+                break
+            h.update(data)
+        f.close()
+        h = h.hexdigest()
+        self.path2hash[path] = (signature, h)
+        return h
+
+    def get_key(self, signature, input_paths):
+        h = hashlib.sha256(utilities.bstring(signature))
+        for path in input_paths:
+            h.update(b'\n')
+            h.update(utilities.bstring(self.get_file_hash(path)))
+        return h.hexdigest()
+
+    def get_key_path(self, key):
+        return '%s/keys/%s/%s' %(self.store_dir, key[:2], key)
+
+    def get_stamp_path(self, key):
+        return '%s/stamps/%s/%s' %(self.store_dir, key[:2], key)
+
+    def p_touch(self, key):
+        ''' marks the key as recently used '''
+        path = self.get_stamp_path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            utilities.makedirs(os.path.dirname(path))
+            open(path, 'ab').close()
+
+    def get_object_path(self, content_hash):
+        return '%s/objects/%s/%s' %(self.store_dir, content_hash[:2], content_hash)
+
+    def get_temp_name(self, path):
+        ''' returns a filename next to path that will not clash
+            with other processes or threads
+        '''
+        return '%s.%s-%d-%d.prep' %(
+            path,
+            utilities.std_string(utilities.hex2base62(
+                hashlib.sha256(b'%.9f' %time.time()).hexdigest(), 6
+            )[:6]),
+            os.getpid(),
+            threading.current_thread().ident,
+        )
+
+    def p_link(self, source, target):
+        ''' replaces target with a hard link to source or, e.g. across
+            file systems, with a copy of source
+        '''
+        utilities.makedirs(os.path.dirname(target))
+        temp_name = self.get_temp_name(target)
+        try:
+            os.link(source, temp_name)
+        except OSError:
+            shutil.copyfile(source, temp_name)
+        os.rename(temp_name, target)
+        if os.path.lexists(temp_name):
+            # rename() does nothing if both names link to the
+            # same inode, e.g. when another process linked the
+            # target to the same object first
+            os.unlink(temp_name)
+
+    def fetch(self, key, output_path):
+        ''' places the stored output for the key at output_path and
+            returns True or returns False if there is no such output
+        '''
+        key_path = self.get_key_path(key)
+        if not os.path.exists(key_path):
+            return False
+        self.p_touch(key)
+        try:
+            if os.path.exists(output_path) \
+            and os.path.samefile(key_path, output_path):
+                return True
+            self.p_link(key_path, output_path)
+        except OSError:
+            # not in store or evicted by another process
+            return False
+        return True
+
+    def add(self, key, output_path):
+        ''' stores the output for the key '''
+        if os.path.islink(output_path):
+            # e.g. a basic parse that is a single vote
+            source = os.path.realpath(output_path)
+        else:
+            source = output_path
+        object_path = self.get_object_path(self.get_file_hash(source))
+        if os.path.exists(object_path):
+            # same content as another output
+            if source == output_path \
+            and not os.path.samefile(object_path, output_path):
+                self.p_link(object_path, output_path)
+        else:
+            self.p_link(source, object_path)
+            if self.size_estimate is not None:
+                self.size_estimate += os.path.getsize(object_path)
+        self.p_touch(key)
+        self.p_link(object_path, self.get_key_path(key))
+        if self.size_estimate is None \
+        or self.size_estimate > self.max_size \
+        or time.time() > self.last_scan + self.scan_interval:
+            # other processes also add to the store
+            # --> re-scan from time to time
+            self.evict()
+
+    def evict(self):
+        ''' removes the least recently used objects and their keys
+            until the store is within its size limit
+        '''
+        self.last_scan = time.time()
+        if not self.max_size:
+            self.size_estimate = 0
+            return
+        # time of last use of each object is the time of
+        # last use of any of its keys
+        inode2keys = {}
+        inode2last_use = {}
+        keys_dir = '/'.join((self.store_dir, 'keys'))
+        for dirname, _, filenames in os.walk(keys_dir):
+            for filename in filenames:
+                if filename.endswith('.prep'):
+                    continue
+                path = '/'.join((dirname, filename))
+                try:
+                    inode = os.stat(path).st_ino
+                except OSError:
+                    continue
+                try:
+                    last_use = os.path.getmtime(self.get_stamp_path(filename))
+                except OSError:
+                    last_use = 0.0
+                if inode not in inode2keys:
+                    inode2keys[inode] = []
+                    inode2last_use[inode] = 0.0
+                inode2keys[inode].append(filename)
+                inode2last_use[inode] = max(inode2last_use[inode], last_use)
+        entries = []
+        total_size = 0
+        objects_dir = '/'.join((self.store_dir, 'objects'))
+        for dirname, _, filenames in os.walk(objects_dir):
+            for filename in filenames:
+                if filename.endswith('.prep'):
+                    continue
+                path = '/'.join((dirname, filename))
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                # objects without keys are removed first
+                last_use = inode2last_use.get(stat.st_ino, 0.0)
+                entries.append((last_use, stat.st_size, path, stat.st_ino))
+                total_size += stat.st_size
+        if total_size > self.max_size:
+            entries.sort()
+            for _, size, path, inode in entries:
+                if total_size <= self.max_size:
+                    break
+                to_remove = [path]
+                for key in inode2keys.get(inode, []):
+                    to_remove.append(self.get_key_path(key))
+                    to_remove.append(self.get_stamp_path(key))
+                for remove_path in to_remove:
+                    try:
+                        os.unlink(remove_path)
+                    except OSError:
+                        # removed by another process
+                        pass
+                total_size -= size
+        self.size_estimate = total_size
+
+def get_store(options):
+    ''' returns the artifact store configured for the given
+        options, creating it on first use, or None if
+        disabled with EUD_ARTIFACT_STORE=0
+    '''
+    try:
+        return options.artifact_store
+    except AttributeError:
+        pass
+    if 'EUD_ARTIFACT_STORE' in os.environ \
+    and os.environ['EUD_ARTIFACT_STORE'].lower() in ('0', 'false'):
+        options.artifact_store = None
+        return None
+    if 'EUD_ARTIFACT_STORE_DIR' in os.environ:
+        store_dir = os.environ['EUD_ARTIFACT_STORE_DIR']
+    else:
+        store_dir = '%s/artifacts' %options.tempdir
+    utilities.makedirs(store_dir)
+    options.artifact_store = ArtifactStore(store_dir)
+    return options.artifact_store
+
+def get_adopt_outputs():
+    if 'EUD_ARTIFACT_STORE_ADOPT' in os.environ \
+    and os.environ['EUD_ARTIFACT_STORE_ADOPT'].lower() in ('0', 'false'):
+        return False
+    return True
+
+def is_up_to_date(output_path, input_paths):
+    ''' whether the output exists and is newer than its inputs '''
+    try:
+        output_mtime = os.path.getmtime(output_path)
+        for path in input_paths:
+            if os.path.getmtime(path) > output_mtime:
+                return False
+    except OSError:
+        return False
+    return True
+
+def run_step(options, signature, input_paths, output_path, function, args = (), kw_args = {}):
+    ''' produces output_path with function(*args, **kw_args) unless the
+        store has an output for the same inputs and signature, i.e. the
+        module, model and options producing the output, and returns
+        whether output_path exists
+    '''
+    store = get_store(options)
+    if store is None:
+        # re-use any existing output as before
+        if not os.path.exists(output_path):
+            function(*args, **kw_args)
+        return os.path.exists(output_path)
+    key = store.get_key(signature, input_paths)
+    if store.fetch(key, output_path):
+        if options.debug:
+            print('Re-using stored %s for %s' %(output_path, signature))
+        return True
+    if get_adopt_outputs() \
+    and is_up_to_date(output_path, input_paths):
+        # produced before the store was used
+        store.add(key, output_path)
+        return True
+    if os.path.lexists(output_path):
+        # not from the store, e.g. stale
+        # --> remove so that the step does not re-use it
+        os.unlink(output_path)
+    function(*args, **kw_args)
+    if not os.path.exists(output_path):
+        return False
+    store.add(key, output_path)
+    return True
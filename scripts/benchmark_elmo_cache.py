@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Measures write throughput, load time and read throughput of the elmo
+# cache formats with random vectors, without running any elmo tasks.
+#
+# With --probing, measures the cost of finding records for new entries
+# at different load factors instead.
+#
+# With --submit-profile, measures the latency of submitting npz requests
+# to a cache with many entries in memory.
+
+from __future__ import print_function
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+import elmo_udpf
+import utilities
+
+def print_usage():
+    print('Usage: %s [options]' %sys.argv[0])
+    print("""
+Options:
+
+    --sentences  N          Number of sentences to store in the cache
+                            (Default: 2000)
+
+    --mean-length  N        Average number of tokens per sentence
+                            (Default: 20)
+
+    --dim  N                Size of each vector
+                            (Default: 1024)
+
+    --format  NAME          text, binary or both
+                            (Default: both)
+
+    --workdir  DIR          Where to create the temporary caches
+                            (Default: system temporary directory)
+
+    --seed  N               Seed for the random number generator
+                            (Default: 42)
+
+    --probing               Compare the probe sequence of get_location()
+                            with the earlier sha512-per-probe sequence at
+                            load factors 0.5 to 0.95
+
+    --records  N            Number of records for --probing
+                            (Default: 100000)
+
+    --submit-profile        Compare the latency of ElmoCache.submit() with
+                            the earlier scan over all cache entries
+
+    --entries  N            Number of cache entries for --submit-profile
+                            (Default: 1000000)
+""")
+
+def get_sentences(n_sentences, mean_length, dim, seed):
+    rng = numpy.random.RandomState(seed)
+    sentences = []
+    for index in range(n_sentences):
+        length = 1 + rng.poisson(mean_length - 1)
+        tokens = ['t%d' %i for i in range(length)]
+        vectors = rng.normal(size = (length, dim)).astype(numpy.float32)
+        sentences.append((tokens, 'sentence %d' %index, vectors))
+    return sentences
+
+def configure_size(cache_class, sentences):
+    ''' sets EFML_NPZ_CACHE_SIZE such that all sentences fit into
+        the cache below its maximum load factor
+    '''
+    record_size = int(os.environ['EFML_NPZ_CACHE_RECORD_SIZE'])
+    probe = cache_class.__new__(cache_class)
+    probe.dtype_name = 'float32'
+    vectors_per_record = probe.get_default_vectors_per_record(record_size)
+    n_records = 0
+    for tokens, _, _ in sentences:
+        n_records += int((len(tokens)+vectors_per_record-1)/vectors_per_record)
+    os.environ['EFML_NPZ_CACHE_SIZE'] = '%d' %(
+        record_size * int(1.2 * n_records + 10)
+    )
+
+def run_benchmark(cache_class, sentences, workdir):
+    cache_dir = tempfile.mkdtemp(prefix = 'elmo-cache-', dir = workdir)
+    lcode = b'en'
+    n_bytes = 0
+    for _, _, vectors in sentences:
+        n_bytes += vectors.nbytes
+    configure_size(cache_class, sentences)
+    retval = {}
+    cache = cache_class(cache_dir)
+    keys = []
+    for tokens, hdf5_key, vectors in sentences:
+        key = cache.get_cache_key(tokens, hdf5_key, lcode)
+        cache.add_vectors(key, lcode, vectors, time.time())
+        keys.append(key)
+    start = time.time()
+    cache.sync_to_disk_files(force = True)
+    retval['write'] = time.time() - start
+    if cache_class is elmo_udpf.ElmoMmapCache:
+        cache.unmap_disk_files()
+    del cache
+    disk_size = 0
+    for filename in os.listdir(cache_dir):
+        # count allocated blocks as binary cache files are sparse
+        disk_size += os.stat(os.path.join(cache_dir, filename)).st_blocks * 512
+    retval['disk'] = disk_size
+    start = time.time()
+    cache = cache_class(cache_dir)
+    retval['load'] = time.time() - start
+    start = time.time()
+    checksum = 0.0
+    for key in keys:
+        vectors = cache.get_vectors(cache.key2entry[key])
+        checksum += float(vectors[0, 0])
+    retval['read'] = time.time() - start
+    expected = sum([float(vectors[0, 0]) for _, _, vectors in sentences])
+    if abs(checksum - expected) > 1e-3 * len(sentences):
+        raise ValueError('Vectors read back from %s do not match' %cache_class.__name__)
+    if cache_class is elmo_udpf.ElmoMmapCache:
+        cache.unmap_disk_files()
+    del cache
+    shutil.rmtree(cache_dir)
+    retval['bytes'] = n_bytes
+    return retval
+
+def legacy_get_location(cache, key, part_index):
+    ''' probe sequence of earlier versions with a sha512 hash for each
+        probe; returns the first free or initialised record and the
+        number of probes
+    '''
+    probe_index = 0
+    while True:
+        h = hashlib.sha512(b'%d:%d:%s' %(
+              probe_index, part_index, key
+        )).hexdigest()
+        r_index = int(h, 16) % cache.n_records
+        if cache.record_states[r_index] in (ord('i'), ord('f')):
+            return r_index, probe_index + 1
+        probe_index += 1
+
+def run_probing(n_records, workdir, n_measure = 2000):
+    cache_dir = tempfile.mkdtemp(prefix = 'elmo-cache-', dir = workdir)
+    record_size = 256
+    os.environ['EFML_NPZ_CACHE_RECORD_SIZE'] = '%d' %record_size
+    os.environ['EFML_NPZ_CACHE_VECTORS_PER_RECORD'] = '1'
+    os.environ['EFML_NPZ_CACHE_SIZE'] = '%d' %(record_size * n_records)
+    cache = elmo_udpf.ElmoMmapCache(cache_dir)
+    results = []
+    for load_factor in (0.5, 0.6, 0.7, 0.8, 0.9, 0.95):
+        n_fill = int(load_factor * n_records)
+        row = [load_factor]
+        for method in ('legacy', 'current'):
+            cache.create_new_disk_files()
+            keys = []
+            for index in range(n_fill + n_measure):
+                keys.append(b'%05d:en:%s' %(
+                    1 + index % 40,
+                    utilities.bstring(hashlib.sha256(b'%d' %index).hexdigest()),
+                ))
+            for key in keys[:n_fill]:
+                if method == 'legacy':
+                    r_index, _ = legacy_get_location(cache, key, 0)
+                else:
+                    r_index, _ = cache.get_location(None, key, 0, accept_free = True)
+                cache.set_record_state(r_index, ord('d'))
+                cache.set_location(r_index, key, 0)
+            start = time.time()
+            n_probes = 0
+            for key in keys[n_fill:]:
+                if method == 'legacy':
+                    _, probes = legacy_get_location(cache, key, 0)
+                else:
+                    probes = cache.n_probes
+                    cache.get_location(None, key, 0, accept_free = True)
+                    probes = cache.n_probes - probes
+                n_probes += probes
+            duration = time.time() - start
+            row.append(1000000.0 * duration / n_measure)
+            row.append(float(n_probes) / n_measure)
+        # lookup of stored data
+        start = time.time()
+        for key in keys[:n_measure]:
+            cache.get_location(None, key, 0)
+        row.append(1000000.0 * (time.time() - start) / n_measure)
+        results.append(row)
+    cache.unmap_disk_files()
+    shutil.rmtree(cache_dir)
+    print()
+    print('%d records, %d new entries per load factor' %(n_records, n_measure))
+    print('Load factor | Legacy us/entry | Legacy probes | Current us/entry | Current probes | Lookup us')
+    print('------------+-----------------+---------------+------------------+----------------+----------')
+    for row in results:
+        print('%11.2f |%16.1f |%14.2f |%17.1f |%15.2f |%9.1f' %tuple(row))
+
+def legacy_submit_scan(cache, npz_name):
+    ''' loop over all cache entries as in submit() of earlier
+        versions; returns the number of requests found
+    '''
+    n_requests = 0
+    for key, entry in utilities.iteritems(cache.key2entry):
+        if npz_name in entry.requesters:
+            n_requests += entry.requesters[npz_name]
+    return n_requests
+
+def run_submit_profile(n_entries, sentences, workdir, n_repeats = 5):
+    cache_dir = tempfile.mkdtemp(prefix = 'elmo-cache-', dir = workdir)
+    record_size = 256
+    os.environ['EFML_NPZ_CACHE_RECORD_SIZE'] = '%d' %record_size
+    os.environ['EFML_NPZ_CACHE_SIZE'] = '%d' %(record_size * 1000)
+    cache = elmo_udpf.ElmoCache(cache_dir)
+    lcode = b'en'
+    # the requested sentences are cache hits so that no elmo
+    # tasks are submitted
+    for tokens, hdf5_key, vectors in sentences:
+        key = cache.get_cache_key(tokens, hdf5_key, lcode)
+        cache.add_vectors(key, lcode, vectors[:1])
+    filler = numpy.zeros((1, 1), dtype = numpy.float32)
+    start = time.time()
+    for index in range(n_entries - len(sentences)):
+        cache.add_vectors(b'filler:%d' %index, lcode, filler)
+    print('Added %d entries in %.1f seconds' %(len(cache.key2entry), time.time() - start))
+    results = []
+    stdout = sys.stdout
+    for repeat in range(n_repeats):
+        npz_name = b'%s/request-%d.npz' %(utilities.bstring(cache_dir), repeat)
+        row = []
+        start = time.time()
+        for tokens, hdf5_key, _ in sentences:
+            cache.request(tokens, hdf5_key, npz_name, lcode)
+        row.append(time.time() - start)
+        start = time.time()
+        if legacy_submit_scan(cache, npz_name) != len(sentences):
+            raise ValueError('Legacy scan did not find all requests')
+        row.append(time.time() - start)
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            start = time.time()
+            cache.submit(npz_name)
+            row.append(time.time() - start)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        if cache.npz2ready_count[npz_name] != len(sentences):
+            raise ValueError('Not all requested sentences are ready')
+        start = time.time()
+        for tokens, hdf5_key, _ in sentences:
+            cache.collect(tokens, hdf5_key, lcode, npz_name)
+        row.append(time.time() - start)
+        del cache.npz2ready_count[npz_name]
+        del cache.npz2keys[npz_name]
+        results.append(row)
+    del cache
+    shutil.rmtree(cache_dir)
+    print()
+    print('%d cache entries, %d sentences per request' %(n_entries, len(sentences)))
+    print('Request ms | Legacy scan ms | Submit ms | Collect ms')
+    print('-----------+----------------+-----------+-----------')
+    for row in results:
+        print('%10.1f |%15.1f |%10.1f |%10.1f' %tuple([1000.0 * x for x in row]))
+
+def main():
+    opt_sentences = 2000
+    opt_mean_length = 20
+    opt_dim = 1024
+    opt_format = 'both'
+    opt_workdir = None
+    opt_seed = 42
+    opt_probing = False
+    opt_records = 100000
+    opt_submit_profile = False
+    opt_entries = 1000000
+    while len(sys.argv) >= 2 and sys.argv[1][:1] == '-':
+        option = sys.argv[1]
+        option = option.replace('_', '-')
+        del sys.argv[1]
+        if option in ('--help', '-h'):
+            print_usage()
+            sys.exit(0)
+        elif option == '--sentences':
+            opt_sentences = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--mean-length':
+            opt_mean_length = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--dim':
+            opt_dim = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--format':
+            opt_format = sys.argv[1]
+            del sys.argv[1]
+        elif option == '--workdir':
+            opt_workdir = sys.argv[1]
+            del sys.argv[1]
+        elif option == '--seed':
+            opt_seed = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--probing':
+            opt_probing = True
+        elif option == '--records':
+            opt_records = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--submit-profile':
+            opt_submit_profile = True
+        elif option == '--entries':
+            opt_entries = int(sys.argv[1])
+            del sys.argv[1]
+        else:
+            print('Unsupported option %s' %option)
+            print_usage()
+            sys.exit(1)
+    if len(sys.argv) != 1:
+        print_usage()
+        sys.exit(1)
+    if opt_probing:
+        run_probing(opt_records, opt_workdir)
+        return
+    if opt_format == 'both':
+        cache_classes = [elmo_udpf.ElmoCache, elmo_udpf.ElmoMmapCache]
+    elif opt_format == 'text':
+        cache_classes = [elmo_udpf.ElmoCache]
+    elif opt_format == 'binary':
+        cache_classes = [elmo_udpf.ElmoMmapCache]
+    else:
+        raise ValueError('Unknown format %s' %opt_format)
+    if 'EFML_NPZ_CACHE_RECORD_SIZE' not in os.environ:
+        os.environ['EFML_NPZ_CACHE_RECORD_SIZE'] = '32768'
+    sentences = get_sentences(opt_sentences, opt_mean_length, opt_dim, opt_seed)
+    if opt_submit_profile:
+        run_submit_profile(opt_entries, sentences, opt_workdir)
+        return
+    results = []
+    for cache_class in cache_classes:
+        results.append((cache_class.__name__, run_benchmark(
+            cache_class, sentences, opt_workdir
+        )))
+    print()
+    print('%d sentences, %.1f MiB of vectors' %(
+        opt_sentences, results[0][1]['bytes'] / 1024.0**2
+    ))
+    print('Cache         | Disk MiB |  Write s | Write MiB/s |   Load s |   Read s | Read MiB/s')
+    print('--------------+----------+----------+-------------+----------+----------+-----------')
+    for name, result in results:
+        mib = result['bytes'] / 1024.0**2
+        print('%-14s|%9.1f |%9.2f |%12.1f |%9.2f |%9.3f |%10.1f' %(
+            name,
+            result['disk'] / 1024.0**2,
+            result['write'], mib / max(result['write'], 1e-9),
+            result['load'],
+            result['read'], mib / max(result['read'], 1e-9),
+        ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Measures the end-to-end latency of a chain of tiny tasks, each
+# requiring the output of the previous task, run through the task queue
+# with a local worker:
+#
+#   legacy    fixed poll intervals and no completion watcher in wait()
+#   adaptive  exponential backoff from short poll intervals and watcher
+#   inline    as adaptive but the submitter runs its own task
+#             (EUD_TASK_INLINE)
+
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import common_udpipe_future
+
+def print_usage():
+    print('Usage: %s [options]' %sys.argv[0])
+    print("""
+Options:
+
+    --tasks  N              Length of the chain of tasks
+                            (Default: 100)
+
+    --mode  NAME            legacy, adaptive, inline or all
+                            (Default: all)
+
+    --poll-frequency  F     EUD_TASK_POLL_FREQUENCY for the worker and
+                            the submitter; the legacy mode takes about
+                            40 / F seconds per task
+                            (Default: 10.0)
+
+    --workdir  DIR          Where to create the temporary task folders
+                            (Default: system temporary directory)
+""")
+
+mode2env = {
+    'legacy': {
+        'EUD_TASK_WAIT_WATCHER':      '0',
+        'EUD_TASK_MIN_POLL_INTERVAL': '1000000',
+    },
+    'adaptive': {},
+    'inline': {
+        'EUD_TASK_INLINE': 'udpf',
+    },
+}
+
+def run_chain(mode, n_tasks, poll_frequency, workdir):
+    task_dir = tempfile.mkdtemp(prefix = 'task-latency-', dir = workdir)
+    env = {
+        'EUD_TASK_DIR': task_dir,
+        'EUD_TASK_POLL_FREQUENCY': '%f' %poll_frequency,
+    }
+    env.update(mode2env[mode])
+    saved_env = {}
+    for name in ('EUD_TASK_WAIT_WATCHER', 'EUD_TASK_MIN_POLL_INTERVAL', 'EUD_TASK_INLINE'):
+        if name in os.environ:
+            saved_env[name] = os.environ[name]
+            del os.environ[name]
+    for name in env:
+        if name in os.environ and name not in saved_env:
+            saved_env[name] = os.environ[name]
+        os.environ[name] = env[name]
+    stopfile = os.path.join(task_dir, 'stop')
+    worker = subprocess.Popen([
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'common_udpipe_future.py'),
+        '--stopfile', stopfile,
+        '--max-idle', '1.0',
+    ], stdout = open(os.path.join(task_dir, 'worker.log'), 'wb'), stderr = subprocess.STDOUT)
+    # give the worker time to start, see random_delay() in worker()
+    time.sleep(5.0)
+    latencies = []
+    start_time = time.time()
+    previous = None
+    for index in range(n_tasks):
+        output = os.path.join(task_dir, 'output-%03d' %index)
+        requires = []
+        if previous:
+            requires.append(previous)
+        task = common_udpipe_future.Task(
+            ['touch', output], 'udpf', requires = requires,
+        )
+        t0 = time.time()
+        task.run()
+        latencies.append(time.time() - t0)
+        if not os.path.exists(output):
+            raise ValueError('Task %d did not produce its output' %index)
+        previous = output
+    total = time.time() - start_time
+    open(stopfile, 'wb').close()
+    worker.wait()
+    for name in env:
+        del os.environ[name]
+    os.environ.update(saved_env)
+    shutil.rmtree(task_dir)
+    latencies.sort()
+    return total, latencies
+
+def main():
+    opt_tasks = 100
+    opt_mode = 'all'
+    opt_poll_frequency = 10.0
+    opt_workdir = None
+    while len(sys.argv) >= 2 and sys.argv[1][:1] == '-':
+        option = sys.argv[1]
+        option = option.replace('_', '-')
+        del sys.argv[1]
+        if option in ('--help', '-h'):
+            print_usage()
+            sys.exit(0)
+        elif option == '--tasks':
+            opt_tasks = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--mode':
+            opt_mode = sys.argv[1]
+            del sys.argv[1]
+        elif option == '--poll-frequency':
+            opt_poll_frequency = float(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--workdir':
+            opt_workdir = sys.argv[1]
+            del sys.argv[1]
+        else:
+            print('Unsupported option %s' %option)
+            print_usage()
+            sys.exit(1)
+    if opt_mode == 'all':
+        modes = ['legacy', 'adaptive', 'inline']
+    elif opt_mode in mode2env:
+        modes = [opt_mode]
+    else:
+        raise ValueError('Unknown mode %s' %opt_mode)
+    print('Chain of %d tasks, poll frequency %.1f' %(opt_tasks, opt_poll_frequency))
+    results = []
+    for mode in modes:
+        total, latencies = run_chain(mode, opt_tasks, opt_poll_frequency, opt_workdir)
+        results.append((mode, total, latencies))
+    print()
+    print('Mode     | Total (s) | Mean (s) | Median (s) | Max (s)')
+    print('---------+-----------+----------+------------+--------')
+    for mode, total, latencies in results:
+        print('%-9s|%10.1f |%9.3f |%11.3f |%8.3f' %(
+            mode, total,
+            sum(latencies) / len(latencies),
+            latencies[len(latencies)//2],
+            latencies[-1],
+        ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Python port of enhanced_collapse_empty_nodes.pl by Dan Zeman (UD tools),
+# processing one sentence at a time so that it can be used as a filter
+# in front of iwpt20_xud_eval.load_conllu() without intermediate files.
+#
+# Empty nodes are removed and paths of enhanced dependencies that traverse
+# them are collapsed into individual edges whose labels show the original
+# path without the ids of the empty nodes, e.g. "conj>nsubj".
+#
+# The order in which paths are expanded follows the Perl script exactly
+# as it affects which paths are found when empty nodes are chained.
+# Columns other than DEPS are copied unchanged.
+
+from __future__ import print_function
+
+import io
+import re
+import sys
+
+id_column   = 0
+deps_column = 8
+
+re_word_id  = re.compile(r'^\d+$')
+re_empty_id = re.compile(r'^\d+\.\d+$')
+re_empty_in_path = re.compile(r'>\d+\.\d+>')
+
+def cmpid_key(node_id):
+    ''' sort key equivalent to cmpids() in the UD tools
+        (major id, then minor id of empty nodes)
+    '''
+    if '.' in node_id:
+        major, minor = node_id.split('.', 1)
+        return (int(major), int(minor))
+    return (int(node_id), 0)
+
+def p_warn(message, warn):
+    if warn:
+        sys.stderr.write(message + '\n')
+
+def collapse_sentence(lines, warn = True):
+    ''' takes the lines of one CoNLL-U sentence without linebreaks
+        and without the final empty line and returns the lines of
+        the sentence with empty nodes collapsed
+    '''
+    # parse graph, keeping the line order of everything that is
+    # not an empty node
+    output = []            # comment, multiword token and word rows
+    id2iedges = {}         # node id --> list of [parent_id, deprel]
+    word_ids = []
+    empty_ids = []
+    for line in lines:
+        if line.startswith('#'):
+            output.append(line)
+            continue
+        fields = line.split('\t')
+        node_id = fields[id_column]
+        if '-' in node_id:
+            output.append(line)
+            continue
+        if re_empty_id.match(node_id):
+            empty_ids.append(node_id)
+        elif re_word_id.match(node_id):
+            word_ids.append(node_id)
+            output.append(fields)
+        else:
+            # not a node line; the Perl graph reader ignores it
+            continue
+        iedges = []
+        if len(fields) > deps_column and fields[deps_column] != '_':
+            for dep in fields[deps_column].split('|'):
+                parent_id, deprel = dep.split(':', 1)
+                edge = [parent_id, deprel]
+                if edge not in iedges:
+                    iedges.append(edge)
+        id2iedges[node_id] = iedges
+    # collect all edges in node order
+    edges = []
+    for node_id in sorted(word_ids + empty_ids, key = cmpid_key):
+        for parent_id, deprel in id2iedges[node_id]:
+            edges.append([parent_id, deprel, node_id])
+    okedges = [e for e in edges if re_word_id.match(e[0]) and re_word_id.match(e[-1])]
+    epedges = [e for e in edges if re_empty_id.match(e[0])]
+    ecedges = [e for e in edges if re_empty_id.match(e[-1])]
+    ep_index = 0
+    while ep_index < len(epedges):
+        epedge = epedges[ep_index]
+        ep_index += 1
+        myecedges = [e for e in ecedges if e[-1] == epedge[0]]
+        if not myecedges:
+            p_warn('Ignoring enhanced path because the empty source node does not have any parent: ' + '>'.join(epedge), warn)
+        for ecedge in myecedges:
+            newedge = ecedge[:-1] + epedge
+            if re_word_id.match(newedge[0]) and re_word_id.match(newedge[-1]):
+                okedges.append(newedge)
+                continue
+            # not OK yet as it still begins or ends in an empty node;
+            # only use it for longer edges if it does not contain a cycle
+            node_ids = newedge[0::2]
+            if len(set(node_ids)) < len(node_ids):
+                p_warn('Cyclic enhanced path will not be used to construct longer paths: ' + '>'.join(newedge), warn)
+                continue
+            if re_empty_id.match(newedge[0]):
+                epedges.append(newedge)
+            if re_empty_id.match(newedge[-1]):
+                ecedges.append(newedge)
+    # all edges in okedges have non-empty ends
+    okedges.sort(key = lambda e: (int(e[-1]), int(e[0])))
+    if warn:
+        oknodes = set()
+        for okedge in okedges:
+            for item in okedge:
+                if re_empty_id.match(item):
+                    oknodes.add(item)
+        for ecedge in ecedges:
+            if ecedge[-1] not in oknodes:
+                p_warn('Incoming path to an empty node ignored because the node has no children: ' + '>'.join(ecedge), warn)
+    # remove edges going to or from an empty node
+    for node_id in word_ids:
+        id2iedges[node_id] = [
+            edge for edge in id2iedges[node_id]
+            if not re_empty_id.match(edge[0])
+        ]
+    # add the new collapsed edges
+    for edge in okedges:
+        if len(edge) == 3:
+            # simple edges are already in the graph
+            continue
+        parent_id = edge[0]
+        deprel = re_empty_in_path.sub('>', '>'.join(edge[1:-1]))
+        iedges = id2iedges[edge[-1]]
+        if [parent_id, deprel] not in iedges:
+            iedges.append([parent_id, deprel])
+    # write DEPS column in canonical order
+    retval = []
+    for row in output:
+        if type(row) is list:
+            iedges = id2iedges[row[id_column]]
+            if iedges:
+                iedges = sorted(iedges, key = lambda e: (cmpid_key(e[0]), e[1]))
+                deps = '|'.join(['%s:%s' %(e[0], e[1]) for e in iedges])
+            else:
+                deps = '_'
+            while len(row) <= deps_column:
+                row.append('_')
+            row = row[:deps_column] + [deps] + row[deps_column+1:]
+            row = '\t'.join(row)
+        retval.append(row)
+    return retval
+
+def read_sentences(f_in):
+    ''' yields the lines of each sentence without linebreaks
+        like the reader loop of the Perl script
+    '''
+    sentence = []
+    while True:
+        line = f_in.readline()
+        if not line:
+            break
+        if line.isspace():
+            yield sentence
+            sentence = []
+        else:
+            sentence.append(line.rstrip('\r\n'))
+    # in case of incorrect files that lack the last empty line:
+    if sentence:
+        yield sentence
+
+class CollapsedFile:
+
+    ''' read-only file-like object that returns the lines of the
+        given CoNLL-U file object with empty nodes collapsed,
+        converting one sentence at a time
+    '''
+
+    def __init__(self, f_in, warn = False):
+        self.sentences = read_sentences(f_in)
+        self.warn = warn
+        self.buffer = []
+        self.b_index = 0
+
+    def readline(self):
+        if self.b_index >= len(self.buffer):
+            try:
+                sentence = next(self.sentences)
+            except StopIteration:
+                return ''
+            # an empty sentence is written as 2 empty lines
+            self.buffer = collapse_sentence(sentence, self.warn) or ['']
+            self.buffer.append('')
+            self.b_index = 0
+        line = self.buffer[self.b_index]
+        self.b_index += 1
+        return line + '\n'
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+def open_collapsed(path, warn = False):
+    return CollapsedFile(io.open(path, 'r', encoding = 'utf-8'), warn)
+
+def collapse_file(f_in, f_out, warn = True):
+    for sentence in read_sentences(f_in):
+        f_out.write('\n'.join(collapse_sentence(sentence, warn)))
+        f_out.write('\n\n')
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1][:2] in ('-h', '--'):
+        print('usage: %s [input.conllu ...] > output.conllu' %sys.argv[0])
+        sys.exit(1)
+    f_out = io.open(sys.stdout.fileno(), 'w', encoding = 'utf-8', closefd = False)
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            f_in = io.open(path, 'r', encoding = 'utf-8')
+            collapse_file(f_in, f_out)
+            f_in.close()
+    else:
+        collapse_file(io.open(sys.stdin.fileno(), 'r', encoding = 'utf-8', closefd = False), f_out)
+    f_out.flush()
+
+if __name__ == "__main__":
+    main()
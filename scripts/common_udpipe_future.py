@@ -17,8 +17,12 @@ import hashlib
 import os
 import subprocess
 import sys
+import threading
 import time
 
+import file_watcher
+import task_index
+import task_stats
 import utilities
 
 def print_usage(last_arg = None):
@@ -110,12 +114,75 @@ def incomplete(model_dir):
 def my_makedirs(required_dir):
     utilities.makedirs(required_dir)
 
+def get_worker_name():
+    return '%s:%d' %(
+        os.environ['HOSTNAME'] if 'HOSTNAME' in os.environ else 'unknown',
+        os.getpid(),
+    )
+
+def get_idle_dir(queue_dir):
+    ''' returns the folder in which workers of the queue
+        mark themselves as idle, see have_idle_local_worker()
+    '''
+    return b'/'.join((queue_dir, b'idle'))
+
+def set_idle_marker(idle_name, is_idle):
+    if is_idle:
+        my_makedirs(os.path.dirname(idle_name))
+        open(idle_name, 'wb').close()
+    else:
+        try:
+            os.unlink(idle_name)
+        except OSError:
+            pass
+
+def have_idle_local_worker(queue_dir):
+    ''' whether a worker of the queue on this host
+        is running and has no task
+    '''
+    host = utilities.bstring(get_worker_name().rsplit(':', 1)[0])
+    try:
+        filenames = os.listdir(get_idle_dir(queue_dir))
+    except OSError:
+        return False
+    for filename in filenames:
+        if b':' not in filename:
+            continue
+        worker_host, pid = filename.rsplit(b':', 1)
+        if worker_host != host:
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except (OSError, ValueError):
+            # worker no longer running
+            continue
+        return True
+    return False
+
+def get_inline_queues():
+    ''' returns the queue names listed in EUD_TASK_INLINE,
+        None for all queues or an empty list if not set
+    '''
+    if 'EUD_TASK_INLINE' not in os.environ:
+        return []
+    value = os.environ['EUD_TASK_INLINE']
+    if value.lower() in ('', '0', 'false'):
+        return []
+    if value.lower() in ('1', 'true'):
+        return None
+    return [utilities.bstring(x) for x in value.split(',')]
+
 def run_command(
     command, queue_name = 'udpf', requires = None, priority = 50,
     submit_and_return = False,
     cleanup = None,
+    resources = None,
+    idempotent = False,
 ):
-    task = Task(command, queue_name, requires, priority = priority)
+    task = Task(
+        command, queue_name, requires, priority = priority,
+        resources = resources, idempotent = idempotent,
+    )
     if submit_and_return:
         task.submit()
         task.cleanup_object = cleanup
@@ -127,7 +194,16 @@ def run_command(
 
 class Task:
 
-    def __init__(self, command, queue_name = 'udpf', requires = None, priority = 50):
+    def __init__(self, command, queue_name = 'udpf', requires = None, priority = 50, resources = None, idempotent = False):
+        ''' resources: dictionary with the cpus, mem_gb and gpu the
+            task needs, see resource_names
+
+            idempotent: whether two copies of the command can run at
+            the same time, e.g. because the command writes its outputs
+            to temporary files and moves them into place with rename();
+            only such tasks are re-executed when they straggle, see
+            TaskQueue.pick_straggler()
+        '''
         self.command = [utilities.bstring(x) for x in command]
         self.queue_name = utilities.bstring(queue_name)
         if 'EUD_TASK_DIR' in os.environ:
@@ -143,10 +219,37 @@ class Task:
             patience = 48 * 3600.0
         self.expires = time.time() + patience
         self.priority = int(priority)
+        self.resources = {}
+        if resources:
+            for name, value in utilities.iteritems(resources):
+                if name not in resource_names:
+                    raise ValueError('Unknown task resource %s' %name)
+                self.resources[name] = float(value)
+        self.gpu_devices = None
+        # set by workers with resource limits to run tasks side by side
+        self.asynchronous = False
+        self.child = None
+        # set by workers when a duplicate of the task finished first
+        self.cancelled = False
+        # set for re-executions of stragglers, see pick_straggler()
+        self.speculative = False
+        self.idempotent = idempotent
         if 'EUD_TASK_POLL_FREQUENCY' in os.environ:
             self.poll_frequency = float(os.environ['EUD_TASK_POLL_FREQUENCY'])
         else:
             self.poll_frequency = 1.0
+        # wait() starts with short poll intervals and backs off
+        # exponentially to the interval set by the poll frequency
+        if 'EUD_TASK_MIN_POLL_INTERVAL' in os.environ:
+            self.min_poll_interval = float(os.environ['EUD_TASK_MIN_POLL_INTERVAL'])
+        else:
+            self.min_poll_interval = 0.25
+        if 'EUD_TASK_POLL_BACKOFF' in os.environ:
+            self.poll_backoff = float(os.environ['EUD_TASK_POLL_BACKOFF'])
+        else:
+            self.poll_backoff = 1.5
+        self.use_watcher = 'EUD_TASK_WAIT_WATCHER' not in os.environ \
+            or os.environ['EUD_TASK_WAIT_WATCHER'].lower() not in ('0', 'false')
         assert self.priority >= 0
         assert self.priority < 1000
 
@@ -172,21 +275,92 @@ class Task:
         return True
 
     def run(self):
-        self.submit()
+        # not deferred to an open batch as we wait for the task
+        self.p_submit()
+        if self.may_run_inline():
+            self.run_inline()
         self.wait()
 
+    def may_run_inline(self):
+        ''' whether this process, which otherwise would be idle in
+            wait(), can claim and run its own task, see EUD_TASK_INLINE
+        '''
+        if 'EUD_TASK_DIR' not in os.environ:
+            # already ran in submit()
+            return False
+        queues = get_inline_queues()
+        if queues is not None and self.queue_name not in queues:
+            return False
+        if not have_idle_local_worker(self.queue_dir):
+            # no resources to spare on this host
+            return False
+        return self.required_files_exist()
+
+    def run_inline(self):
+        ''' claims the task like a worker would and runs it in
+            this process unless a worker claimed it first
+        '''
+        index = task_index.get_task_index()
+        if index is not None \
+        and not index.claim(self.queue_name, self.task_id, get_worker_name()):
+            return
+        active_name = self.get_marker_name('active')
+        my_makedirs(os.path.dirname(active_name))
+        try:
+            os.rename(self.submit_name, active_name)
+        except OSError:
+            # claimed by a worker
+            return
+        self.active_name = active_name
+        self.task_bucket = b'%d' %self.my_task_bucket
+        self.start_time = time.time()
+        print('Running task %r inline' %self)
+        sys.stderr.flush()
+        sys.stdout.flush()
+        error = None
+        try:
+            self.process()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # the task must not stay in the active queue
+            end_time = time.time()
+            write_completion_record(
+                b'/'.join((self.queue_dir, b'completed')),
+                self, end_time, error = error,
+            )
+            if index is not None:
+                index.set_state(
+                    self.queue_name, self.task_id,
+                    'completed' if error is None else 'failed'
+                )
+        stats = task_stats.get_task_stats()
+        if stats is not None:
+            record_completion(stats, self, end_time)
+
     def process(self):
         self.start_processing()
         self.wait_for_processing()
 
     def start_processing(self):
         if self.required_files_exist(exception_if_not = True):
-            subprocess.call(self.command)
+            env = None
+            if self.gpu_devices is not None:
+                # devices assigned by the worker
+                env = dict(os.environ)
+                env['CUDA_VISIBLE_DEVICES'] = ','.join(self.gpu_devices)
+            self.child = subprocess.Popen(self.command, env = env)
+            if not self.asynchronous:
+                self.child.wait()
 
     def wait_for_processing(self):
-        return
+        if self.child is not None:
+            self.child.wait()
 
     def finished_processing(self):
+        if self.child is not None:
+            return self.child.poll() is not None
         return True
 
     def get_task_id(self):
@@ -223,9 +397,10 @@ class Task:
     def get_expiry(self):
         return self.expires
 
-    def get_submit_name(self, task_id, my_task_bucket):
+    def get_submit_name(self, task_id, my_task_bucket, create_inbox = True):
         inbox_dir = b'/'.join((self.queue_dir, b'inbox'))
-        my_makedirs(inbox_dir)
+        if create_inbox:
+            my_makedirs(inbox_dir)
         filename = b'%s/%s-%d.task' %(
             inbox_dir,
             task_id,
@@ -235,41 +410,99 @@ class Task:
         return filename
 
     def submit(self):
+        if p_open_batches and 'EUD_TASK_DIR' in os.environ:
+            # submitted together with the other tasks of the batch
+            p_open_batches[-1].add(self)
+            return
+        self.p_submit()
+
+    def p_submit(self):
         if 'EUD_TASK_DIR' not in os.environ:
             print('Running', self.command)
             sys.stderr.flush()
             sys.stdout.flush()
             self.process()
             return
-        # prepare task submission file
+        filename = self.prepare_task_file()
+        os.rename(filename+b'.prep', filename)
+        self.submit_time = time.time()
+        index = task_index.get_task_index()
+        if index is not None:
+            index.add(*self.get_index_row())
+        print('Submitted task %s to run command %r' %(self.task_id, self.command))
+        sys.stderr.flush()
+        sys.stdout.flush()
+
+    def prepare_task_file(self, inbox_ready = False):
+        ''' writes the task submission file to be moved into the
+            inbox with rename() and returns the final filename
+        '''
         task_id  = self.get_task_id()
-        filename = self.get_submit_name(task_id, self.my_task_bucket)
+        if inbox_ready:
+            filename = self.get_submit_name(task_id, self.my_task_bucket, False)
+        else:
+            filename = self.get_submit_name(task_id, self.my_task_bucket)
         expires  = self.get_expiry()
         f = open(filename+b'.prep', 'wb')
         f.write(b'expires\t%.1f\n' %expires)
         for required_file in self.requires:
             f.write(b'requires\t%s\n' %required_file)
+        for name in sorted(self.resources):
+            f.write(utilities.bstring('%s\t%g\n' %(name, self.resources[name])))
+        if self.idempotent:
+            f.write(b'idempotent\t1\n')
         f.write(b'\n')
         f.write(b'\n'.join(self.command))
         f.write(b'\n')
         f.close()
-        os.rename(filename+b'.prep', filename)
-        self.submit_time = time.time()
-        print('Submitted task %s to run command %r' %(task_id, self.command))
-        sys.stderr.flush()
-        sys.stdout.flush()
+        return filename
+
+    def get_index_row(self):
+        ''' returns the parameters of TaskIndex.add() for this task '''
+        return (
+            self.queue_name, self.task_id, b'%d' %self.my_task_bucket,
+            self.priority, self.get_expiry(), self.requires,
+            self.submit_time, self.resources, self.command,
+        )
+
+    def submit_pending(self):
+        ''' submits the open batch that holds this task, if any, as
+            the task has no task id and files before it is submitted
+        '''
+        for batch in p_open_batches:
+            if self in batch.pending:
+                batch.submit()
 
     def wait(self):
         if 'EUD_TASK_DIR' not in os.environ:
             return
+        # cannot wait for a task that is not yet submitted
+        self.submit_pending()
         expires          = self.expires
         my_task_bucket   = self.my_task_bucket
         queue_dir        = self.queue_dir
         submit_time      = self.submit_time
         task_fingerprint = self.task_fingerprint
         task_id          = self.task_id
+        # optionally watch the task's active and completion markers so
+        # that we notice changes immediately; poll intervals start short
+        # and grow exponentially up to the earlier poll interval, i.e.
+        # short tasks finish quickly even without notification
+        active_name    = self.get_marker_name('active')
+        completed_name = self.get_marker_name('completed')
+        if self.use_watcher:
+            for filename in (active_name, completed_name):
+                my_makedirs(os.path.dirname(filename))
+            watcher = file_watcher.FileWatcher(
+                scan_interval = 30.0 / self.poll_frequency
+            )
+            watcher.add(active_name)
+            watcher.add(completed_name)
+        else:
+            watcher = None
         # wait for task to start
         iteration = 0
+        poll_interval = self.min_poll_interval
         fp_length = len(task_fingerprint)
         verbosity_interval = 3600.0
         if 'EUD_DEBUG' in os.environ:
@@ -278,10 +511,11 @@ class Task:
         start_time_interval = (submit_time, time.time())
         while time.time() < expires and os.path.exists(self.submit_name):
             duration = 30.0 + int(task_fingerprint[iteration % fp_length], 16)
-            duration = duration / self.poll_frequency
+            duration = min(poll_interval, duration / self.poll_frequency)
+            poll_interval *= self.poll_backoff
             now = time.time()
-            start_time_interval = (now, now+duration)
-            time.sleep(duration)
+            self.p_sleep(watcher, duration)
+            start_time_interval = (now, time.time())
             iteration += 1
             now = time.time()
             if now >= next_verbose:
@@ -294,12 +528,9 @@ class Task:
         # did it expire?
         has_expired = True
         # check for file in active queue
-        time.sleep(5.0/self.poll_frequency) # just in case moving the file is not atomic
-        filename = b'%s/active/%d/%s.task' %(
-            queue_dir,
-            my_task_bucket,
-            task_id,
-        )
+        filename = active_name
+        if not os.path.exists(filename) and not os.path.exists(completed_name):
+            time.sleep(5.0/self.poll_frequency) # just in case moving the file is not atomic
         if os.path.exists(filename):
             has_expired = False
             # expectation value of start time assuming uniform
@@ -310,25 +541,92 @@ class Task:
             if 'EUD_DEBUG' in os.environ:
                 verbosity_interval /= 100.0
             next_verbose = min(next_verbose, start_time + verbosity_interval)
+            # the task may be short --> start again with short intervals
+            poll_interval = self.min_poll_interval
             while os.path.exists(filename):
                 duration = 30.0 + int(task_fingerprint[iteration % fp_length], 16)
-                duration = duration / self.poll_frequency
-                time.sleep(duration)
+                duration = min(poll_interval, duration / self.poll_frequency)
+                poll_interval *= self.poll_backoff
+                self.p_sleep(watcher, duration)
                 iteration += 1
                 now = time.time()
                 if now >= next_verbose:
-                    print('Task %s is running about %.1f hours so far' %(
+                    recorded_start, _ = read_start_record(filename)
+                    if recorded_start is not None:
+                        start_time = recorded_start
+                    print('Task %s is running about %.1f hours so far%s' %(
                         task_id,
                         (now-start_time)/3600.0,
+                        self.get_eta_message(start_time, now),
                     ))
                     verbosity_interval *= 1.4
                     next_verbose += verbosity_interval
+        if watcher is not None:
+            watcher.close()
         # task is not active --> check for completion
-        filename = b'%s/completed/%d/%s.task' %(
-            queue_dir,
-            my_task_bucket,
-            task_id,
+        self.finish()
+
+    def get_eta_message(self, start_time, now):
+        ''' returns the expected time to completion of the running
+            task for progress messages, see task_stats.py
+        '''
+        stats = task_stats.get_task_stats()
+        if stats is None:
+            return ''
+        eta = stats.get_eta(self.queue_name, self.command, start_time, now)
+        if eta is None:
+            return ''
+        return ', expected to finish in about %.1f hours' %(eta/3600.0)
+
+    def p_sleep(self, watcher, duration):
+        if watcher is None:
+            time.sleep(duration)
+        else:
+            # returns early when a marker changes
+            watcher.wait(duration)
+            watcher.poll()
+
+    def get_marker_name(self, state):
+        ''' returns the path of the task file in the given queue
+            folder, i.e. active, completed or archive
+        '''
+        self.submit_pending()
+        return b'%s/%s/%d/%s.task' %(
+            self.queue_dir,
+            utilities.bstring(state),
+            self.my_task_bucket,
+            self.task_id,
         )
+
+    def get_state(self):
+        ''' returns 'queued', 'active', 'completed' or 'failed'
+            for a submitted task without waiting
+        '''
+        if 'EUD_TASK_DIR' not in os.environ:
+            # ran in submit()
+            return 'completed'
+        self.submit_pending()
+        # check in the order in which the task file moves
+        # through the folders so that no move is missed
+        if os.path.exists(self.submit_name):
+            if time.time() > self.expires:
+                return 'failed'
+            return 'queued'
+        if os.path.exists(self.get_marker_name('active')):
+            return 'active'
+        if os.path.exists(self.get_marker_name('completed')):
+            return 'completed'
+        return 'failed'
+
+    def finish(self):
+        ''' checks that the task completed and archives or removes
+            its completion record as configured
+        '''
+        if 'EUD_TASK_DIR' not in os.environ:
+            return
+        queue_dir = self.queue_dir
+        task_id   = self.task_id
+        filename  = self.get_marker_name('completed')
         if not os.path.exists(filename):
             print('Task %s failed' %utilities.std_string(task_id))
             raise ValueError('Task %s marked by task master as no longer active but not as complete' %utilities.std_string(task_id))
@@ -348,6 +646,172 @@ class Task:
         os.environ['EUD_TASK_CLEANUP_COMPLETED'].lower() not in ('0', 'false'):
             os.unlink(filename)
 
+# batches opened with "with TaskBatch():", innermost last
+p_open_batches = []
+
+class TaskBatch:
+
+    ''' Submits many tasks in one go: the task files are written first
+        and then moved into the inbox, followed by one fsync() of each
+        inbox folder and one transaction for the task index. The
+        folders for the tasks' active and completion markers are
+        created once per bucket.
+
+        Within "with batch:", Task.submit() adds tasks to the batch
+        and the batch is submitted at the end of the with block.
+    '''
+
+    def __init__(self, tasks = None):
+        self.tasks = []
+        self.pending = []
+        if tasks:
+            for task in tasks:
+                self.add(task)
+
+    def __enter__(self):
+        p_open_batches.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        p_open_batches.remove(self)
+        self.submit()
+        return False
+
+    def add(self, task):
+        self.tasks.append(task)
+        self.pending.append(task)
+
+    def submit(self):
+        pending = self.pending
+        self.pending = []
+        if not pending:
+            return
+        if 'EUD_TASK_DIR' not in os.environ:
+            for task in pending:
+                task.p_submit()
+            return
+        inbox_dirs = set()
+        marker_dirs = set()
+        for task in pending:
+            inbox_dir = b'/'.join((task.queue_dir, b'inbox'))
+            if inbox_dir not in inbox_dirs:
+                my_makedirs(inbox_dir)
+                inbox_dirs.add(inbox_dir)
+        filenames = []
+        for task in pending:
+            filenames.append(task.prepare_task_file(inbox_ready = True))
+            for state in ('active', 'completed'):
+                marker_dirs.add(b'%s/%s/%d' %(
+                    task.queue_dir, utilities.bstring(state), task.my_task_bucket,
+                ))
+        submit_time = time.time()
+        for task, filename in zip(pending, filenames):
+            os.rename(filename+b'.prep', filename)
+            task.submit_time = submit_time
+        for inbox_dir in inbox_dirs:
+            # make the new directory entries durable in one go
+            try:
+                fd = os.open(inbox_dir, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                # not supported for directories on some platforms
+                pass
+            os.close(fd)
+        # folders for wait() and the workers
+        for marker_dir in marker_dirs:
+            my_makedirs(marker_dir)
+        index = task_index.get_task_index()
+        if index is not None:
+            index.add_many([task.get_index_row() for task in pending])
+        queue2count = {}
+        for task in pending:
+            queue_name = utilities.std_string(task.queue_name)
+            if queue_name not in queue2count:
+                queue2count[queue_name] = 0
+            queue2count[queue_name] += 1
+        print('Submitted %s' %(', '.join([
+            '%d task(s) to queue %s' %(queue2count[queue_name], queue_name)
+            for queue_name in sorted(queue2count)
+        ])))
+        sys.stderr.flush()
+        sys.stdout.flush()
+
+    def wait(self, tasks = None):
+        ''' waits in one loop until all given tasks (default: all tasks
+            of the batch) are no longer queued or active and then checks
+            their completion in order like Task.wait()
+        '''
+        self.submit()
+        if tasks is None:
+            tasks = self.tasks
+        if 'EUD_TASK_DIR' not in os.environ or not tasks:
+            return
+        min_poll_interval = min([task.min_poll_interval for task in tasks])
+        max_poll_interval = 30.0 / max([task.poll_frequency for task in tasks])
+        poll_backoff = tasks[0].poll_backoff
+        watcher = None
+        if tasks[0].use_watcher:
+            watcher = file_watcher.FileWatcher(scan_interval = max_poll_interval)
+            for task in tasks:
+                watcher.add(task.get_marker_name('active'))
+                watcher.add(task.get_marker_name('completed'))
+        remaining = list(tasks)
+        poll_interval = min_poll_interval
+        start_time = time.time()
+        verbosity_interval = 3600.0
+        if 'EUD_DEBUG' in os.environ:
+            verbosity_interval /= 100.0
+        next_verbose = start_time + verbosity_interval
+        while True:
+            still_remaining = []
+            for task in remaining:
+                if task.get_state() in ('queued', 'active'):
+                    still_remaining.append(task)
+            if len(still_remaining) < len(remaining):
+                # progress --> check again soon
+                poll_interval = min_poll_interval
+            remaining = still_remaining
+            if not remaining:
+                break
+            duration = min(poll_interval, max_poll_interval)
+            poll_interval *= poll_backoff
+            if watcher is None:
+                time.sleep(duration)
+            else:
+                watcher.wait(duration)
+                watcher.poll()
+            now = time.time()
+            if now >= next_verbose:
+                print('Waited %.1f hours so far for %d of %d task(s)' %(
+                    (now-start_time)/3600.0, len(remaining), len(tasks),
+                ))
+                verbosity_interval *= 1.4
+                next_verbose += verbosity_interval
+        if watcher is not None:
+            watcher.close()
+        for task in tasks:
+            task.finish()
+
+def wait_for_tasks(task_list):
+    ''' like utilities.wait_for_tasks() but with a single wait
+        loop for all tasks
+    '''
+    tasks = []
+    for task in task_list:
+        if task is not None:
+            tasks.append(task)
+    TaskBatch().wait(tasks)
+    for task in tasks:
+        try:
+            cleanup = task.cleanup_object
+        except:
+            cleanup = None
+        if cleanup is not None:
+            cleanup.cleanup()
+
 def main(
     queue_name = 'udpf',
     task_processor = None,
@@ -400,9 +864,193 @@ def main(
         callback,
     )
 
+# Resources that tasks can declare in the header of their task file.
+# Workers configured with EUD_TASK_WORKER_CPUS, EUD_TASK_WORKER_MEM_GB
+# and/or EUD_TASK_WORKER_GPUS start as many tasks as fit into these
+# limits. EUD_TASK_WORKER_GPUS is either a number of GPUs or a
+# comma-separated list of device IDs; devices are assigned to tasks via
+# CUDA_VISIBLE_DEVICES. Tasks needing less than 1 GPU share a device
+# with other such tasks; tasks needing 1 or more GPUs get whole devices.
+# Resources without a limit are not checked.
+# Tasks not declaring a resource need the default amount.
+
+resource_names = ('cpus', 'mem_gb', 'gpu')
+
+default_resources = {
+    'cpus':   1.0,
+    'mem_gb': 0.0,
+    'gpu':    0.0,
+}
+
+class WorkerSlots:
+
+    ''' resources of a worker and the resources allocated
+        to its active tasks
+    '''
+
+    def __init__(self):
+        self.capacity = {}
+        self.gpu_devices = None
+        for name, envname in [
+            ('cpus',   'EUD_TASK_WORKER_CPUS'),
+            ('mem_gb', 'EUD_TASK_WORKER_MEM_GB'),
+            ('gpu',    'EUD_TASK_WORKER_GPUS'),
+        ]:
+            if envname not in os.environ:
+                self.capacity[name] = None
+                continue
+            value = os.environ[envname]
+            if name == 'gpu' and ',' in value:
+                self.gpu_devices = value.split(',')
+                value = len(self.gpu_devices)
+            self.capacity[name] = float(value)
+        if self.capacity['gpu'] and self.gpu_devices is None:
+            if 'CUDA_VISIBLE_DEVICES' in os.environ:
+                self.gpu_devices = os.environ['CUDA_VISIBLE_DEVICES'].split(',')
+            else:
+                self.gpu_devices = ['%d' %i for i in range(int(self.capacity['gpu']))]
+            self.gpu_devices = self.gpu_devices[:int(self.capacity['gpu'])]
+        # fraction of each device allocated to tasks
+        self.device2allocated = {}
+        if self.gpu_devices is not None:
+            for device in self.gpu_devices:
+                self.device2allocated[device] = 0.0
+        self.allocated = {}
+        self.allocated_seconds = {}
+        for name in resource_names:
+            self.allocated[name] = 0.0
+            self.allocated_seconds[name] = 0.0
+        self.last_update = time.time()
+        if 'EUD_TASK_PACKING' in os.environ:
+            self.packing = os.environ['EUD_TASK_PACKING']
+        else:
+            self.packing = 'first'
+        if self.packing not in ('first', 'best'):
+            raise ValueError('Unknown task packing policy %s' %self.packing)
+
+    def is_limited(self):
+        for name in resource_names:
+            if self.capacity[name] is not None:
+                return True
+        return False
+
+    def get_need(self, resources, name):
+        if name in resources:
+            return resources[name]
+        return default_resources[name]
+
+    def fits(self, resources):
+        for name in resource_names:
+            capacity = self.capacity[name]
+            if capacity is None:
+                continue
+            if self.allocated[name] + self.get_need(resources, name) > capacity + 1e-6:
+                return False
+        if self.gpu_devices is not None \
+        and self.p_pick_devices(self.get_need(resources, 'gpu')) is None:
+            # enough GPU capacity in total but not on the free devices
+            return False
+        return True
+
+    def get_device_share(self, need):
+        ''' fraction of each assigned device allocated to
+            a task needing the given amount of GPUs
+        '''
+        if need < 1.0:
+            return need
+        return 1.0
+
+    def p_pick_devices(self, need):
+        ''' returns a list of devices for a task needing the given
+            amount of GPUs or None if the free devices do not suffice
+        '''
+        if need <= 0.0:
+            return []
+        if need < 1.0:
+            # share the fullest device that still has room
+            # so that other devices stay free for larger tasks
+            candidates = []
+            for index, device in enumerate(self.gpu_devices):
+                allocated = self.device2allocated[device]
+                if allocated + need <= 1.0 + 1e-6:
+                    candidates.append((-allocated, index, device))
+            if not candidates:
+                return None
+            candidates.sort()
+            return [candidates[0][2]]
+        n_gpus = int(need + 0.999)
+        free_devices = []
+        for device in self.gpu_devices:
+            if self.device2allocated[device] <= 1e-6:
+                free_devices.append(device)
+        if len(free_devices) < n_gpus:
+            return None
+        return free_devices[:n_gpus]
+
+    def get_packing_key(self, resources):
+        ''' candidates of equal priority are tried in order of this key:
+            with the "best" policy, tasks that need a larger share of
+            the worker come first so that small tasks fill the gaps
+            (first-fit decreasing)
+        '''
+        if self.packing == 'first':
+            return 0.0
+        size = 0.0
+        for name in resource_names:
+            capacity = self.capacity[name]
+            if capacity:
+                size += self.get_need(resources, name) / capacity
+        return -size
+
+    def p_update(self):
+        now = time.time()
+        duration = now - self.last_update
+        for name in resource_names:
+            self.allocated_seconds[name] += duration * self.allocated[name]
+        self.last_update = now
+
+    def allocate(self, task):
+        self.p_update()
+        for name in resource_names:
+            self.allocated[name] += self.get_need(task.resources, name)
+        if self.gpu_devices is not None:
+            need = self.get_need(task.resources, 'gpu')
+            devices = self.p_pick_devices(need)
+            if devices is None:
+                raise ValueError('Task %r does not fit into the free GPU devices' %task)
+            if devices:
+                share = self.get_device_share(need)
+                for device in devices:
+                    self.device2allocated[device] += share
+                task.gpu_devices = devices
+        task.start_allocated_seconds = dict(self.allocated_seconds)
+
+    def release(self, task):
+        ''' returns the average fraction of the limited resources
+            of this worker that was allocated while the task ran
+        '''
+        self.p_update()
+        for name in resource_names:
+            self.allocated[name] -= self.get_need(task.resources, name)
+        if task.gpu_devices is not None and self.gpu_devices is not None:
+            share = self.get_device_share(self.get_need(task.resources, 'gpu'))
+            for device in task.gpu_devices:
+                self.device2allocated[device] = max(
+                    0.0, self.device2allocated[device] - share
+                )
+        duration = max(1.0e-6, time.time() - task.start_time)
+        utilization = {}
+        for name in resource_names:
+            capacity = self.capacity[name]
+            if not capacity:
+                continue
+            allocated_seconds = self.allocated_seconds[name] - task.start_allocated_seconds[name]
+            utilization[name] = allocated_seconds / (duration * capacity)
+        return utilization
+
 class TaskQueue:
 
-    def __init__(self, inbox_dir, active_dir, delete_dir, task_processor, extra_kw_parameters):
+    def __init__(self, inbox_dir, active_dir, delete_dir, task_processor, extra_kw_parameters, queue_name = None):
         if task_processor is None:
             raise ValueError('Missing task processor')
         self.inbox_dir = inbox_dir
@@ -411,22 +1059,354 @@ class TaskQueue:
         self.task_processor = task_processor
         self.extra_kw_parameters = extra_kw_parameters
         self.filename2requires = {}
+        self.filename2resources = {}
+        if queue_name is None:
+            queue_name = extra_kw_parameters['queue_name']
+        self.queue_name = utilities.bstring(queue_name)
+        # optional index of queued tasks, see task_index.py
+        self.task_index = task_index.get_task_index()
+        self.last_index_sync = 0.0
+        self.index_sync_interval = 300.0
+        # how long finished tasks stay in the index
+        self.index_keep = 3600.0
+        # tasks found to wait for required files are not checked
+        # again within one poll interval of the worker loop
+        if 'EUD_TASK_POLL_FREQUENCY' in os.environ:
+            poll_frequency = float(os.environ['EUD_TASK_POLL_FREQUENCY'])
+        else:
+            poll_frequency = 1.0
+        self.not_eligible = set()
+        self.not_eligible_since = 0.0
+        self.not_eligible_ttl = 12.0 / poll_frequency
+        self.worker_name = get_worker_name()
+        queue_dir = os.path.dirname(inbox_dir)
+        self.final_dir = b'/'.join((queue_dir, b'completed'))
+        self.speculation_dir = b'/'.join((queue_dir, b'speculative'))
+        # historical durations from completion records, kept in
+        # memory only if EUD_TASK_STATS is not set
+        self.task_stats = task_stats.get_task_stats()
+        if self.task_stats is None:
+            self.task_stats = task_stats.TaskStats(':memory:')
+        self.last_history_update = 0.0
+        self.history_update_interval = 600.0
+        # order of tasks with the same priority: 'submission' or
+        # 'sje' for shortest expected job first
+        if 'EUD_TASK_ORDER' in os.environ:
+            self.order = os.environ['EUD_TASK_ORDER']
+        else:
+            self.order = 'submission'
+        if self.order not in ('submission', 'sje'):
+            raise ValueError('Unknown task order %s' %self.order)
+        self.filename2kind = {}
+
+    def read_task_file(self, taskfile):
+        ''' returns expires, lcode, required files, resources and the
+            command of a task file or None if the file cannot be read,
+            e.g. because it was claimed by another worker
+        '''
+        try:
+            f = open(taskfile, 'rb')
+        except IOError:
+            return None
+        expires = 0.0
+        lcode = None
+        required_files = []
+        resources = {}
+        while True:
+            line = f.readline().rstrip()
+            if not line: # empty line or EOF
+                break
+            fields = line.split(b'\t')
+            if len(fields) != 2:
+                continue
+            elif line.startswith(b'expires'):
+                expires = float(fields[1])
+            elif line.startswith(b'lcode'):
+                lcode = fields[1]
+            elif line.startswith(b'requires'):
+                required_files.append(fields[1])
+            elif utilities.std_string(fields[0]) in resource_names:
+                resources[utilities.std_string(fields[0])] = float(fields[1])
+        command = f.read().split(b'\n')
+        f.close()
+        # handle last line with linebreak
+        if command and command[-1] == b'':
+            del command[-1]
+        return expires, lcode, required_files, resources, command
+
+    def sync_index(self, opt_debug = False):
+        ''' adds tasks in the inbox that are missing in the index,
+            e.g. tasks submitted without EUD_TASK_INDEX, and marks
+            indexed tasks that are no longer in the inbox as gone,
+            e.g. claimed by a worker not using the index
+        '''
+        self.last_index_sync = time.time()
+        queued = self.task_index.get_task_ids(self.queue_name)
+        in_inbox = set()
+        n_added = 0
+        for filename in os.listdir(self.inbox_dir):
+            if not filename.endswith(b'.task') or b'-' not in filename:
+                continue
+            task_id, task_bucket = filename[:-5].rsplit(b'-', 1)
+            in_inbox.add(task_id)
+            if task_id in queued:
+                continue
+            details = self.read_task_file(b'/'.join((self.inbox_dir, filename)))
+            if details is None:
+                continue
+            expires, _, required_files, resources, command = details
+            self.task_index.add(
+                self.queue_name, task_id, task_bucket,
+                int(task_id[:3]), expires, required_files,
+                resources = resources, command = command,
+            )
+            n_added += 1
+        n_gone = 0
+        for task_id in queued - in_inbox:
+            self.task_index.set_state(self.queue_name, task_id, 'gone')
+            n_gone += 1
+        n_purged = self.task_index.purge(
+            self.queue_name, self.last_index_sync - self.index_keep
+        )
+        if opt_debug or n_added or n_gone or n_purged:
+            print('Task index: added %d task(s) from inbox, %d task(s) no longer in inbox, %d finished task(s) removed' %(
+                n_added, n_gone, n_purged
+            ))
+
+    def pick_task_from_index(self, opt_ignore_expiry = False, opt_debug = False, slots = None):
+        if time.time() > self.last_index_sync + self.index_sync_interval:
+            self.sync_index(opt_debug)
+        candidates = self.task_index.get_candidates(self.queue_name)
+        if slots is not None or self.order != 'submission':
+            # stable sort keeps the order of submission
+            candidates.sort(key = lambda x: (
+                x[2], self.get_order_key(x[6], x[7]),
+                slots.get_packing_key(x[5]) if slots is not None else 0.0,
+            ))
+        if opt_debug:
+            print('Candidate tasks in index:', len(candidates))
+        now = time.time()
+        if now > self.not_eligible_since + self.not_eligible_ttl:
+            self.not_eligible = set()
+            self.not_eligible_since = now
+        for task_id, task_bucket, _, expires, required_files, resources, _, _ in candidates:
+            filename = b'%s-%s.task' %(task_id, task_bucket)
+            taskfile = b'/'.join((self.inbox_dir, filename))
+            if time.time() > expires and not opt_ignore_expiry:
+                if self.task_index.claim(self.queue_name, task_id, self.worker_name):
+                    print('Deleting expired task', utilities.std_string(task_id))
+                    try:
+                        os.rename(taskfile, b'/'.join((self.delete_dir, filename)))
+                    except OSError:
+                        print('Task %s claimed by other worker' %utilities.std_string(task_id))
+                    self.task_index.set_state(self.queue_name, task_id, 'deleted')
+                continue
+            eligible = task_id not in self.not_eligible
+            if eligible:
+                for required_file in required_files:
+                    if not os.path.exists(required_file):
+                        eligible = False
+                        self.not_eligible.add(task_id)
+                        break
+            if not eligible:
+                if opt_debug:
+                    print('Task %s not eligible to run' %utilities.std_string(task_id))
+                continue
+            if slots is not None and not slots.fits(resources):
+                if opt_debug:
+                    print('Task %s does not fit into free resources' %utilities.std_string(task_id))
+                continue
+            if not self.task_index.claim(self.queue_name, task_id, self.worker_name):
+                if opt_debug:
+                    print('Task %s claimed by other worker' %utilities.std_string(task_id))
+                continue
+            # move the task file as without the index
+            bucket_dir  = b'/'.join((self.active_dir, task_bucket))
+            my_makedirs(bucket_dir)
+            active_name = b'%s/%s.task' %(bucket_dir, task_id)
+            try:
+                os.rename(taskfile, active_name)
+            except OSError:
+                print('Task %s claimed by other worker' %utilities.std_string(task_id))
+                self.task_index.set_state(self.queue_name, task_id, 'gone')
+                continue
+            details = self.read_task_file(active_name)
+            if details is None:
+                raise ValueError('Cannot read claimed task %s' %utilities.std_string(task_id))
+            _, lcode, _, resources, command = details
+            if opt_debug:
+                print('Successfully claimed task', utilities.std_string(task_id))
+            return self.p_new_task(command, active_name, task_id, task_bucket, expires, lcode, resources)
+        if opt_debug:
+            print('No eligible task found')
+        return None
+
+    def p_new_task(self, command, active_name, task_id, task_bucket, expires, lcode, resources):
+        task = self.task_processor(command, **self.extra_kw_parameters)
+        task.resources = resources
+        task.active_name = active_name
+        task.submit_time = os.path.getmtime(active_name)
+        task.task_id = task_id
+        task.task_bucket = task_bucket
+        task.expires = expires
+        if lcode:
+            task.lcode = lcode
+        return task
+
+    def update_history(self):
+        ''' adds completion records not seen before to the statistics '''
+        self.last_history_update = time.time()
+        self.task_stats.update_queue(os.path.dirname(self.final_dir), self.queue_name)
+
+    def get_expected_duration(self, command, min_samples = 3):
+        ''' returns the median duration of earlier tasks running the
+            same script, preferably on the same treebank(s), or None
+            if there are too few such tasks
+        '''
+        command_type, tbid = task_stats.get_task_kind(command)
+        return self.p_get_expected_duration(command_type, tbid, min_samples)
+
+    def p_get_expected_duration(self, command_type, tbid, min_samples = 3, any_kind = False):
+        if time.time() > self.last_history_update + self.history_update_interval:
+            self.update_history()
+        return self.task_stats.estimate_duration(
+            self.queue_name, command_type, tbid,
+            min_samples, any_kind = any_kind,
+        )
+
+    def get_order_key(self, command_type, tbid):
+        ''' returns the key for sorting tasks with the same priority '''
+        if self.order == 'submission':
+            return 0.0
+        # shortest expected job first; tasks of unknown
+        # duration count as tasks of average duration
+        expected = self.p_get_expected_duration(command_type, tbid, any_kind = True)
+        if expected is None:
+            return 0.0
+        return expected
+
+    def pick_straggler(self, straggler_factor, heartbeat_timeout, slots = None, opt_debug = False):
+        ''' claims a task of another worker for re-execution if it runs
+            much longer than earlier tasks of the same type or if its
+            worker stopped sending heartbeats; only tasks submitted as
+            idempotent are considered as both copies write the same
+            outputs
+        '''
+        now = time.time()
+        try:
+            buckets = os.listdir(self.active_dir)
+        except OSError:
+            return None
+        for task_bucket in buckets:
+            bucket_dir = b'/'.join((self.active_dir, task_bucket))
+            try:
+                filenames = os.listdir(bucket_dir)
+            except OSError:
+                continue
+            for filename in filenames:
+                if not filename.endswith(b'.task'):
+                    continue
+                task_id = filename[:-5]
+                active_name = b'/'.join((bucket_dir, filename))
+                start, worker_name = read_start_record(active_name)
+                if start is None or worker_name == self.worker_name:
+                    # no heartbeats from this worker or our own task
+                    continue
+                if not is_idempotent(active_name):
+                    continue
+                try:
+                    last_heartbeat = os.path.getmtime(active_name)
+                except OSError:
+                    continue
+                details = self.read_task_file(active_name)
+                if details is None:
+                    continue
+                expires, lcode, _, resources, command = details
+                if slots is not None and not slots.fits(resources):
+                    continue
+                expected = self.get_expected_duration(command)
+                if now > last_heartbeat + heartbeat_timeout:
+                    reason = 'no heartbeat for %.1f minutes' %((now - last_heartbeat) / 60.0)
+                elif expected is not None \
+                and now - start > straggler_factor * expected + 60.0:
+                    reason = 'running %.1f minutes, expected %.1f minutes' %(
+                        (now - start) / 60.0, expected / 60.0,
+                    )
+                else:
+                    continue
+                speculation_name = self.claim_speculation(task_bucket, task_id, heartbeat_timeout)
+                if speculation_name is None:
+                    if opt_debug:
+                        print('Straggler %s is already re-executed' %task_id)
+                    continue
+                print('Re-executing task %s of worker %s: %s' %(
+                    utilities.std_string(task_id), worker_name, reason,
+                ))
+                task = self.p_new_task(command, active_name, task_id, task_bucket, expires, lcode, resources)
+                task.speculative = True
+                task.speculation_name = speculation_name
+                return task
+        return None
 
-    def pick_task(self, opt_ignore_expiry = False, opt_debug = False):
+    def claim_speculation(self, task_bucket, task_id, heartbeat_timeout):
+        ''' returns the path of the new marker of the re-execution
+            or None if another worker re-executes the task
+        '''
+        bucket_dir = b'/'.join((self.speculation_dir, task_bucket))
+        my_makedirs(bucket_dir)
+        speculation_name = b'%s/%s.task' %(bucket_dir, task_id)
+        try:
+            if time.time() > os.path.getmtime(speculation_name) + heartbeat_timeout:
+                # worker of re-execution stopped sending heartbeats
+                os.unlink(speculation_name)
+        except OSError:
+            pass
+        try:
+            fd = os.open(speculation_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return None
+        os.write(fd, utilities.bstring('%s\n' %self.worker_name))
+        os.close(fd)
+        return speculation_name
+
+    def set_state(self, task_id, state):
+        ''' records the new state of a task in the index, if any '''
+        if self.task_index is not None:
+            self.task_index.set_state(self.queue_name, task_id, state)
+
+    def pick_task(self, opt_ignore_expiry = False, opt_debug = False, slots = None):
+        ''' slots: WorkerSlots to only pick a task that fits into
+            the free resources of the worker
+        '''
+        if self.task_index is not None:
+            return self.pick_task_from_index(opt_ignore_expiry, opt_debug, slots)
         candidate_tasks = []
         filename2requires = {}
+        filename2resources = {}
+        filename2kind = {}
         for filename in os.listdir(self.inbox_dir):
             if filename.endswith(b'.task') and b'-' in filename:
                 priority = filename[:2]
-                candidate_tasks.append((priority, utilities.random(), filename))
+                order_key = 0.0
+                packing_key = 0.0
                 if filename in self.filename2requires:
                     required_files = self.filename2requires[filename]
                     filename2requires[filename] = required_files
+                    resources = self.filename2resources[filename]
+                    filename2resources[filename] = resources
+                    kind = self.filename2kind[filename]
+                    filename2kind[filename] = kind
+                    order_key = self.get_order_key(*kind)
+                    if slots is not None:
+                        packing_key = slots.get_packing_key(resources)
+                candidate_tasks.append((priority, order_key, packing_key, utilities.random(), filename))
         self.filename2requires = filename2requires
+        self.filename2resources = filename2resources
+        self.filename2kind = filename2kind
         candidate_tasks.sort()
         if opt_debug:
             print('Candidate tasks in inbox:', len(candidate_tasks))
-        for _, _, filename in candidate_tasks:
+        for _, _, _, _, filename in candidate_tasks:
             task_id, task_bucket = filename[:-5].rsplit(b'-', 1)
             eligible = 'unknown'
             if filename in filename2requires:
@@ -436,6 +1416,8 @@ class TaskQueue:
                     if not os.path.exists(required_file):
                         eligible = 'no'
                         break
+                if slots is not None and not slots.fits(filename2resources[filename]):
+                    eligible = 'no'
             if eligible == 'no':
                 if opt_debug:
                     print('Task %s not eligible to run' %task_id)
@@ -454,6 +1436,7 @@ class TaskQueue:
             expires = 0.0
             lcode = None
             required_files = []
+            resources = {}
             while True:
                 line = f.readline().rstrip()
                 if not line: # empty line or EOF
@@ -474,6 +1457,8 @@ class TaskQueue:
                     required_files.append(required_file)
                     if not os.path.exists(required_file):
                         eligible = 'no'
+                elif utilities.std_string(fields[0]) in resource_names:
+                    resources[utilities.std_string(fields[0])] = float(fields[1])
                 if delete_task:
                     break
             if delete_task:
@@ -486,16 +1471,19 @@ class TaskQueue:
                 if opt_debug:
                     print('Deleted task', task_id)
                 continue
+            command = f.read().split(b'\n')
+            f.close()
             # keep list of required files to avoid reading this task file
             # again until all required files are there
             self.filename2requires[filename] = required_files
+            self.filename2resources[filename] = resources
+            self.filename2kind[filename] = task_stats.get_task_kind(command)
+            if slots is not None and not slots.fits(resources):
+                eligible = 'no'
             if eligible == 'no':
-                f.close()
                 if opt_debug:
                     print('Task %s not eligible to run' %task_id)
                 continue
-            command = f.read().split(b'\n')
-            f.close()
             # try to claim this task
             bucket_dir  = b'/'.join((self.active_dir, task_bucket))
             my_makedirs(bucket_dir)
@@ -511,19 +1499,225 @@ class TaskQueue:
             if command and command[-1] == b'':
                 del command[-1]
             # found the first task eligible to run
-            task = self.task_processor(command, **self.extra_kw_parameters)
-            task.active_name = active_name
-            task.submit_time = os.path.getmtime(active_name)
-            task.task_id = task_id
-            task.task_bucket = task_bucket
-            task.expires = expires
-            if lcode:
-                task.lcode = lcode
-            return task
+            return self.p_new_task(command, active_name, task_id, task_bucket, expires, lcode, resources)
         if opt_debug:
             print('No eligible task found')
         return None
 
+def write_completion_record(final_dir, task, end_time, utilization = {}, capacity = {}, error = None):
+    ''' writes the completion record of a task and removes the task
+        from the active queue, unless a duplicate of the task, see
+        pick_straggler(), finished first; returns whether the record
+        was written
+    '''
+    bucket_dir = b'%s/%s' %(final_dir, task.task_bucket)
+    my_makedirs(bucket_dir)
+    final_file = b'%s/%s.task' %(bucket_dir, task.task_id)
+    # write via rename() so that waiting submitters are
+    # notified only when the marker is complete
+    f = open(final_file+b'.prep', 'wb')
+    f.write(b'duration\t%.1f\n' %(end_time-task.start_time))
+    f.write(b'waiting\t%.1f\n' %(task.start_time-task.submit_time))
+    f.write(b'total\t%.1f\n' %(end_time-task.submit_time))
+    for keyname, envname in [
+        ('cluster',  'SLURM_CLUSTER_NAME'),
+        ('job_id',   'SLURM_JOB_ID'),
+        ('job_name', 'SLURM_JOB_NAME'),
+        ('host',     'HOSTNAME'),
+    ]:
+        if envname in os.environ:
+            f.write(utilities.bstring(
+                '%s\t%s\n' %(keyname, os.environ[envname])
+            ))
+    f.write(b'process\t%d\n' %os.getpid())
+    f.write(b'submitted\t%.1f\n' %task.submit_time)
+    f.write(b'start\t%.1f\n' %task.start_time)
+    f.write(b'end\t%.1f\n' %end_time)
+    f.write(b'expires\t%.1f\n' %task.expires)
+    f.write(b'task_id\t%s\n' %task.task_id)
+    f.write(b'bucket\t%s\n' %task.task_bucket)
+    f.write(b'arg_len\t%d\n' %len(task.command))
+    if task.speculative:
+        f.write(b'speculative\t1\n')
+    if error is not None:
+        f.write(utilities.bstring('error\t%s\n' %(
+            ('%s: %s' %(type(error).__name__, error)).replace('\n', ' ')
+        )))
+    for name in resource_names:
+        if name in task.resources:
+            f.write(utilities.bstring('%s\t%g\n' %(name, task.resources[name])))
+    if task.gpu_devices is not None:
+        f.write(utilities.bstring('gpu_devices\t%s\n' %','.join(task.gpu_devices)))
+    for name in resource_names:
+        # average fraction of this worker's capacity that
+        # was allocated to tasks while this task ran
+        if name in utilization:
+            f.write(utilities.bstring('capacity_%s\t%g\n' %(name, capacity[name])))
+            f.write(utilities.bstring('utilization_%s\t%.3f\n' %(name, utilization[name])))
+    # TODO: 'requires' header lines are currently lost
+    f.write(b'\n') # empty line to mark end of header, like in http
+    f.write(b'\n'.join(task.command))
+    f.write(b'\n') # final newline
+    f.close()
+    # the first result wins: unlike rename(), link() does not
+    # replace a record written by a duplicate of the task
+    try:
+        os.link(final_file+b'.prep', final_file)
+        os.unlink(final_file+b'.prep')
+    except OSError:
+        if os.path.exists(final_file):
+            os.unlink(final_file+b'.prep')
+            return False
+        # file system without hard links
+        os.rename(final_file+b'.prep', final_file)
+    try:
+        os.unlink(task.active_name)
+    except OSError:
+        print('Error: Could not remove finished task %r from active queue' %task.task_id)
+    return True
+
+def is_idempotent(taskfile):
+    ''' whether the task file declares that the task can run
+        twice at the same time, see Task.__init__()
+    '''
+    try:
+        f = open(taskfile, 'rb')
+    except IOError:
+        return False
+    idempotent = False
+    while True:
+        line = f.readline().rstrip()
+        if not line: # empty line or EOF
+            break
+        if line == b'idempotent\t1':
+            idempotent = True
+            break
+    f.close()
+    return idempotent
+
+def record_completion(stats, task, end_time):
+    ''' adds a task for which write_completion_record()
+        succeeded to the task statistics
+    '''
+    if 'HOSTNAME' in os.environ:
+        host = os.environ['HOSTNAME']
+    else:
+        host = None
+    stats.add(
+        task.queue_name, task.task_id, task.command,
+        task.submit_time, task.start_time, end_time,
+        host = host, speculative = task.speculative,
+        resources = task.resources,
+    )
+
+def write_start_record(task, worker_name):
+    ''' adds the start time and the worker to the header of the task
+        file in the active queue, keeping the file's modification time
+        for heartbeats
+    '''
+    f = open(task.active_name, 'rb')
+    data = f.read()
+    f.close()
+    header, _, command = data.partition(b'\n\n')
+    f = open(task.active_name+b'.prep', 'wb')
+    f.write(header)
+    f.write(b'\nstart\t%.1f\n' %task.start_time)
+    f.write(utilities.bstring('worker\t%s\n' %worker_name))
+    f.write(b'\n')
+    f.write(command)
+    f.close()
+    os.rename(task.active_name+b'.prep', task.active_name)
+
+def read_start_record(active_name):
+    ''' returns the start time and worker recorded by
+        write_start_record() or (None, None)
+    '''
+    start, worker_name = None, None
+    try:
+        f = open(active_name, 'rb')
+    except IOError:
+        return None, None
+    while True:
+        line = f.readline().rstrip()
+        if not line:
+            break
+        fields = line.split(b'\t')
+        if len(fields) != 2:
+            continue
+        elif fields[0] == b'start':
+            start = float(fields[1])
+        elif fields[0] == b'worker':
+            worker_name = utilities.std_string(fields[1])
+    f.close()
+    return start, worker_name
+
+class TaskHeartbeat:
+
+    ''' Touches the active task files of a worker every interval seconds
+        from a background thread, also while the worker is blocked in a
+        synchronous task, and terminates tasks for which a duplicate
+        already wrote the completion record.
+    '''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.tasks = []
+        self.lock = threading.Lock()
+        thread = threading.Thread(target = self.p_run)
+        thread.daemon = True
+        thread.start()
+
+    def add(self, task):
+        with self.lock:
+            task.last_heartbeat = time.time()
+            self.tasks.append(task)
+
+    def remove(self, task):
+        with self.lock:
+            if task in self.tasks:
+                self.tasks.remove(task)
+
+    def p_run(self):
+        while True:
+            time.sleep(min(5.0, self.interval))
+            with self.lock:
+                tasks = list(self.tasks)
+            now = time.time()
+            for task in tasks:
+                if now >= task.last_heartbeat + self.interval:
+                    if task.speculative:
+                        heartbeat_name = task.speculation_name
+                    else:
+                        heartbeat_name = task.active_name
+                    try:
+                        os.utime(heartbeat_name, None)
+                    except OSError:
+                        # e.g. duplicate finished first
+                        pass
+                    task.last_heartbeat = now
+                if task.child is not None and task.child.poll() is None \
+                and os.path.exists(task.final_name):
+                    print('Task %r was completed by another worker, terminating this run' %task)
+                    sys.stdout.flush()
+                    task.cancelled = True
+                    task.child.terminate()
+
+def start_task(task, slots, heartbeat, worker_name, final_dir):
+    task.start_time = time.time()
+    task.final_name = b'%s/%s/%s.task' %(final_dir, task.task_bucket, task.task_id)
+    slots.allocate(task)
+    if heartbeat is not None:
+        if not task.speculative:
+            write_start_record(task, worker_name)
+        heartbeat.add(task)
+    if task.speculative:
+        print('Running duplicate of task %r' %task)
+    else:
+        print('Running task %r' %task)
+    sys.stderr.flush()
+    sys.stdout.flush()
+    task.start_processing()
+
 def worker(
     queue_name = 'udpf',
     task_processor = None,
@@ -558,6 +1752,47 @@ def worker(
         inbox_dir, active_dir, delete_dir,
         task_processor, extra_kw_parameters
     )
+    slots = WorkerSlots()
+    # number of tasks to claim at a time when the worker has no
+    # resource limits; claimed tasks are started one per iteration
+    if 'EUD_TASK_CLAIM_BATCH' in os.environ:
+        claim_batch = int(os.environ['EUD_TASK_CLAIM_BATCH'])
+    else:
+        claim_batch = 1
+    if slots.is_limited():
+        print('Worker capacity:', ', '.join([
+            '%s=%g' %(name, slots.capacity[name])
+            for name in resource_names
+            if slots.capacity[name] is not None
+        ]))
+        print('Packing policy:', slots.packing)
+    # heartbeats in the active task files and re-execution of
+    # stragglers, see TaskQueue.pick_straggler(); off by default
+    # as each heartbeat updates the task file
+    if 'EUD_TASK_HEARTBEAT_INTERVAL' in os.environ:
+        heartbeat_interval = float(os.environ['EUD_TASK_HEARTBEAT_INTERVAL'])
+    else:
+        heartbeat_interval = 0.0
+    if 'EUD_TASK_HEARTBEAT_TIMEOUT' in os.environ:
+        heartbeat_timeout = float(os.environ['EUD_TASK_HEARTBEAT_TIMEOUT'])
+    else:
+        heartbeat_timeout = 10.0 * heartbeat_interval
+    if 'EUD_TASK_STRAGGLER_FACTOR' in os.environ:
+        straggler_factor = float(os.environ['EUD_TASK_STRAGGLER_FACTOR'])
+    else:
+        straggler_factor = 2.0
+    speculate = False
+    if 'EUD_TASK_SPECULATE' in os.environ:
+        value = os.environ['EUD_TASK_SPECULATE']
+        if value.lower() in ('1', 'true'):
+            speculate = True
+        elif value.lower() not in ('', '0', 'false'):
+            speculate = queue_name in value.split(',')
+    if heartbeat_interval > 0.0:
+        heartbeat = TaskHeartbeat(heartbeat_interval)
+    else:
+        heartbeat = None
+        speculate = False
     utilities.random_delay(5.0)
     start_time = time.time()
     print('Worker loop starting', time.ctime(start_time))
@@ -572,7 +1807,14 @@ def worker(
             time.ctime(idle_deadline)
         )
     my_active_tasks = []
+    my_claimed_tasks = []
     last_verbose = 0.0
+    # tells submitters on this host that they can run
+    # their tasks inline, see Task.may_run_inline()
+    idle_name = b'/'.join((
+        get_idle_dir(queue_dir), utilities.bstring(task_queue.worker_name)
+    ))
+    is_idle = False
     while True:
         now = time.time()
         exit_reason = None
@@ -589,20 +1831,47 @@ def worker(
             exit_reason = callback.check_limits()
         if exit_reason:
             print('\n*** %s ***\n' %exit_reason)
-            if not my_active_tasks:
+            if not my_active_tasks and not my_claimed_tasks:
+                set_idle_marker(idle_name, False)
                 if callback:
                     callback.on_worker_exit()
                 sys.exit(0)
             print('Waiting for active tasks to finish, not accepting new tasks')
-            task = None
+        elif slots.is_limited():
+            # start as many tasks as fit
+            while True:
+                task = task_queue.pick_task(opt_debug = opt_debug, slots = slots)
+                if task is None:
+                    break
+                task.asynchronous = True
+                start_task(task, slots, heartbeat, task_queue.worker_name, final_dir)
+                my_active_tasks.append(task)
         else:
-            task = task_queue.pick_task(opt_debug = opt_debug)
-        if task is not None:
-            task.start_time = time.time()
-            print('Running task %r' %task)
-            sys.stderr.flush()
-            sys.stdout.flush()
-            task.start_processing()
+            while len(my_claimed_tasks) < claim_batch:
+                task = task_queue.pick_task(opt_debug = opt_debug)
+                if task is None:
+                    break
+                my_claimed_tasks.append(task)
+        if speculate and not exit_reason \
+        and not my_active_tasks and not my_claimed_tasks:
+            # idle --> help with tasks that take too long
+            if slots.is_limited():
+                task = task_queue.pick_straggler(
+                    straggler_factor, heartbeat_timeout, slots, opt_debug
+                )
+            else:
+                task = task_queue.pick_straggler(
+                    straggler_factor, heartbeat_timeout, opt_debug = opt_debug
+                )
+            if task is not None:
+                task.asynchronous = slots.is_limited()
+                start_task(task, slots, heartbeat, task_queue.worker_name, final_dir)
+                my_active_tasks.append(task)
+        if my_claimed_tasks:
+            # start one task per iteration as before, including
+            # tasks claimed before an exit reason occurred
+            task = my_claimed_tasks.pop(0)
+            start_task(task, slots, heartbeat, task_queue.worker_name, final_dir)
             my_active_tasks.append(task)
         still_active_tasks = []
         for index, task in enumerate(my_active_tasks):
@@ -615,41 +1884,22 @@ def worker(
                 continue
             print('Detected that task %r has finished' %task)
             end_time = time.time()
+            utilization = slots.release(task)
+            if heartbeat is not None:
+                heartbeat.remove(task)
+            if task.cancelled:
+                print('Task %r was cancelled as a duplicate finished first' %task)
             # signal completion
-            bucket_dir = b'%s/%s' %(final_dir, task.task_bucket)
-            my_makedirs(bucket_dir)
-            final_file = b'%s/%s.task' %(bucket_dir, task.task_id)
-            f = open(final_file, 'wb')
-            f.write(b'duration\t%.1f\n' %(end_time-task.start_time))
-            f.write(b'waiting\t%.1f\n' %(task.start_time-task.submit_time))
-            f.write(b'total\t%.1f\n' %(end_time-task.submit_time))
-            for keyname, envname in [
-                ('cluster',  'SLURM_CLUSTER_NAME'),
-                ('job_id',   'SLURM_JOB_ID'),
-                ('job_name', 'SLURM_JOB_NAME'),
-                ('host',     'HOSTNAME'),
-            ]:
-                if envname in os.environ:
-                    f.write(utilities.bstring(
-                        '%s\t%s\n' %(keyname, os.environ[envname])
-                    ))
-            f.write(b'process\t%d\n' %os.getpid())
-            f.write(b'submitted\t%.1f\n' %task.submit_time)
-            f.write(b'start\t%.1f\n' %task.start_time)
-            f.write(b'end\t%.1f\n' %end_time)
-            f.write(b'expires\t%.1f\n' %task.expires)
-            f.write(b'task_id\t%s\n' %task.task_id)
-            f.write(b'bucket\t%s\n' %task.task_bucket)
-            f.write(b'arg_len\t%d\n' %len(task.command))
-            # TODO: 'requires' header lines are currently lost
-            f.write(b'\n') # empty line to mark end of header, like in http
-            f.write(b'\n'.join(task.command))
-            f.write(b'\n') # final newline
-            f.close()
-            try:
-                os.unlink(task.active_name)
-            except OSError:
-                print('Error: Could not remove finished task %r from active queue' %task.task_id)
+            elif write_completion_record(final_dir, task, end_time, utilization, slots.capacity):
+                task_queue.set_state(task.task_id, 'completed')
+                record_completion(task_queue.task_stats, task, end_time)
+            else:
+                print('Task %r was completed by another worker first' %task)
+            if task.speculative:
+                try:
+                    os.unlink(task.speculation_name)
+                except OSError:
+                    pass
             if opt_max_idle:
                 idle_deadline = time.time() + opt_max_idle
                 if opt_debug:
@@ -659,13 +1909,27 @@ def worker(
         if opt_debug or now > last_verbose + 60.0:
             print('Tasks still active:', len(my_active_tasks))
             last_verbose = now
+        if not exit_reason and not my_active_tasks and not my_claimed_tasks:
+            if not is_idle:
+                set_idle_marker(idle_name, True)
+                is_idle = True
+        elif is_idle:
+            set_idle_marker(idle_name, False)
+            is_idle = False
         if callback:
             callback.on_worker_idle()
         sys.stdout.flush()
-        utilities.random_delay(
-            12.0/poll_frequency,
-            0.8, 1.2
-        )
+        if my_claimed_tasks:
+            # start the next claimed task right away
+            pass
+        elif callback:
+            # returns early when there is progress on an active task
+            callback.wait_for_activity(12.0/poll_frequency)
+        else:
+            utilities.random_delay(
+                12.0/poll_frequency,
+                0.8, 1.2
+            )
 
 if __name__ == "__main__":
     main('udpf', Task)
@@ -11,10 +11,12 @@
 import collections
 import hashlib
 import os
+import shutil
 import subprocess
 import sys
 
 import basic_dataset
+import eval_store
 import utilities
 
 id_column = 0
@@ -193,54 +195,64 @@ class ConlluDataset(basic_dataset.Dataset):
         sentence.write(f_out, remove_comments)
 
 
-def evaluate(prediction_path, gold_path, options, outname = None, reuse_nonemtpty = True):
+def evaluate(prediction_path, gold_path, options, outname = None, reuse_nonemtpty = True, enhancements = '0'):
     if not outname:
         outname = prediction_path[:-7] + '.eval.txt'
-    if reuse_nonemtpty \
-    and os.path.exists(outname) \
-    and os.path.getsize(outname) > 0:
+    # results are stored by content of the system and gold file
+    # so that they are re-used when the same prediction is found
+    # under a different name and not re-used for a new prediction
+    # with the same name
+    store = eval_store.get_store(options)
+    key = store.get_key(prediction_path, gold_path, enhancements)
+    stored_result = None
+    if reuse_nonemtpty:
+        stored_result = store.lookup(key)
+    if stored_result is not None:
+        # keep a copy next to the prediction, e.g. for eval2html.py
+        try:
+            shutil.copyfile(stored_result, outname)
+        except (IOError, OSError):
+            # evicted by another process --> evaluate again
+            stored_result = None
+    if stored_result is not None:
+        if options.debug:
+            print('Re-using stored evaluation result', key)
         return get_score_from_eval_txt(outname)
-    # collapse enhanced dependencies as required by shared task eval script
-    collapsed_dir = '%s/collapsed' %options.predictdir
-    utilities.makedirs(collapsed_dir)
-    collapsed = {}
-    for what, input_conllu in [
-        ('system', prediction_path),
-        ('gold',   gold_path),
-    ]:
-        _, filename = input_conllu.rsplit('/', 1)
-        collapsed_conllu = '%s/%s' %(collapsed_dir, filename)
-        collapsed[what] = collapsed_conllu
-        if not os.path.exists(collapsed_conllu):
-            command = []
-            command.append('scripts/wrapper-collapse-empty-nodes.sh')
-            command.append(input_conllu)
-            command.append(collapsed_conllu)
-            if options.debug:
-                print('Collapsing %s file...' %what)
-            sys.stderr.flush()
-            sys.stdout.flush()
-            subprocess.call(command)
-        elif options.debug:
-            print('Re-using collapsed %s file' %what)
-    # run official shared task script evaluation script
-    # on collapsed files
+    # run official shared task script evaluation script,
+    # collapsing enhanced dependencies as required by the
+    # shared task while loading the files
+    temp_name = store.get_temp_name(key)
     command = []
     command.append('scripts/iwpt20_xud_eval.py') # %os.environ['PRJ_DIR'])
     command.append('--output')
-    command.append(outname)
+    command.append(temp_name)
     command.append('--verbose')
-    command.append(collapsed['gold'])
-    command.append(collapsed['system'])
+    command.append('--collapse-empty-nodes')
+    command.append('--enhancements')
+    command.append(enhancements)
+    command.append(gold_path)
+    command.append(prediction_path)
     if options.debug:
         print('Running', command)
     sys.stderr.flush()
     sys.stdout.flush()
     subprocess.call(command)
+    if not os.path.exists(temp_name) or not os.path.getsize(temp_name):
+        # evaluation failed --> no score as for an empty
+        # evaluation file and nothing to store
+        print('Warning: no evaluation result for', prediction_path)
+        if os.path.exists(temp_name):
+            os.unlink(temp_name)
+        return (0.0, 'N/A')
+    # copy before adding to the store as other processes
+    # may evict the result as soon as it is in the store
+    shutil.copyfile(temp_name, outname)
+    store.add(key, temp_name)
     return get_score_from_eval_txt(outname)
 
 def get_score_from_eval_txt(outname, metric = 'ELAS'):
     score = (0.0, 'N/A')
+    metric = utilities.bstring(metric)
     with open(outname, 'rb') as f:
         for line in f:
             fields = line.split()
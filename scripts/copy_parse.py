@@ -17,7 +17,9 @@ import os
 import random
 import subprocess
 import sys
+import threading
 
+import artifact_store
 import conllu_dataset
 
 def uses_external_models():
@@ -59,11 +61,18 @@ def predict(lcode, init_seed, dataset, options, conllu_input_file, conllu_output
     # TODO: we assume here the input is in our temp folder but
     #       for general use we should make sure to use our temp
     #       folder even when the input comes from somewhere else
-    conllu_input_copy2enh = conllu_input_file + '_c2e'
-    if not os.path.exists(conllu_input_copy2enh):
-        copy_basic_to_enhanced(
-            conllu_input_file, conllu_input_copy2enh
-        )
+    # other heuristics may use the same input in parallel
+    # --> name of the copy must be unique to this thread
+    conllu_input_copy2enh = '%s_c2e-%d-%d' %(
+        conllu_input_file, os.getpid(), threading.current_thread().ident
+    )
+    # re-uses a stored copy if possible
+    if not artifact_store.run_step(
+        options, 'copy_basic_to_enhanced',
+        [conllu_input_file], conllu_input_copy2enh,
+        copy_basic_to_enhanced, (conllu_input_file, conllu_input_copy2enh),
+    ):
+        return False
     # now read this file sentence-by-sentence
     apply_heuristic_rules(conllu_input_copy2enh, conllu_output_file)
     # cleanup _c2e file
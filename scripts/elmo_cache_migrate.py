@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Copies the entries of an elmo cache in the text format to a new
+# elmo cache in the binary format (EFML_NPZ_CACHE_FORMAT=binary).
+#
+# The size of the new cache is taken from EFML_NPZ_CACHE_SIZE and the
+# record layout from EFML_NPZ_CACHE_RECORD_SIZE, EFML_NPZ_CACHE_DTYPE
+# and EFML_NPZ_CACHE_VECTORS_PER_RECORD as for the elmo-npz worker.
+# If the new cache is smaller than the old one, the most recently used
+# entries are kept.
+#
+# Note that the new cache holds all vectors in memory until they are
+# written, i.e. this tool needs enough RAM for all vectors of the old
+# cache.
+
+from __future__ import print_function
+
+import sys
+import time
+
+import elmo_udpf
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1][:1] == '-':
+        print('Usage: %s OLD_CACHE_DIR NEW_CACHE_DIR' %sys.argv[0])
+        sys.exit(1)
+    start_time = time.time()
+    old_cache = elmo_udpf.ElmoCache(sys.argv[1], read_only = True)
+    new_cache = elmo_udpf.ElmoMmapCache(sys.argv[2])
+    n_entries = 0
+    for key, entry in elmo_udpf.utilities.iteritems(old_cache.key2entry):
+        if not entry.ready:
+            continue
+        new_cache.add_vectors(
+            key, entry.lcode, old_cache.get_vectors(entry),
+            entry.last_access,
+        )
+        n_entries += 1
+    del old_cache
+    print('Migrating %d entries...' %n_entries)
+    new_cache.sync_to_disk_files(force = True)
+    new_cache.unmap_disk_files()
+    print('Finished migration in %.1f seconds' %(time.time() - start_time))
+
+if __name__ == "__main__":
+    main()
@@ -15,11 +15,15 @@ from __future__ import print_function
 
 import array
 import base64
+import collections
 import hashlib
 import math
+import mmap
 import os
+import struct
 import subprocess
 import sys
+import threading
 import time
 import zlib
 
@@ -27,6 +31,11 @@ import utilities
 
 try:
     import h5py
+except:
+    # only show error if user needs functionality
+    pass
+
+try:
     import numpy
 except:
     # only show error if user needs functionality
@@ -37,8 +46,18 @@ try:
 except:
     from io import BytesIO as StringIO
 
+try:
+    from math import gcd
+except ImportError:
+    # Python 2
+    from fractions import gcd
+
 import common_udpipe_future
 import fasttext_udpf
+import eviction_policies
+import file_watcher
+import metrics_export
+import vector_handoff
 
 def uses_external_models():
     return False
@@ -134,18 +153,24 @@ class ElmoNpzTask(common_udpipe_future.Task):
         # all vectors are ready
         print('All vectors for task %s are ready --> creating npz file' %std_task_id)
         sentences = self.sentences
-        npz_data = {}
-        for index, sentence in enumerate(sentences):
-            tokens, hdf5_key = sentence
-            vectors = self.cache.collect(tokens, hdf5_key, lcode, npz_name)
-            npz_key = 'arr_%d' %index
-            npz_data[npz_key] = vectors
-        # write npz file
-        numpy.savez(utilities.std_string(npz_name) + '.prep.npz', **npz_data)
-        os.rename(npz_name + b'.prep.npz', npz_name)
+        vectors_list = []
+        for tokens, hdf5_key in sentences:
+            vectors_list.append(self.cache.collect(tokens, hdf5_key, lcode, npz_name))
+        if npz_name.endswith(b'.npy'):
+            # single memory-mappable array, see vector_handoff.py
+            vector_handoff.write(utilities.std_string(npz_name), vectors_list)
+        else:
+            # write npz file
+            npz_data = {}
+            for index, vectors in enumerate(vectors_list):
+                npz_key = 'arr_%d' %index
+                npz_data[npz_key] = vectors
+            numpy.savez(utilities.std_string(npz_name) + '.prep.npz', **npz_data)
+            os.rename(npz_name + b'.prep.npz', npz_name)
         self.cache.npz_bytes_written += os.path.getsize(npz_name)
         # clean up and mark as finished
         del self.cache.npz2ready_count[npz_name]
+        del self.cache.npz2keys[npz_name]
         self.sentences = None
         return True
 
@@ -184,17 +209,89 @@ class ElmoNpzTask(common_udpipe_future.Task):
         _file.close()
         return sentences
 
+def is_mmap_view(vectors):
+    ''' whether the vectors are a view of a memory-mapped file,
+        e.g. of the disk records of an ElmoMmapCache
+    '''
+    base = vectors.base
+    while base is not None:
+        if isinstance(base, mmap.mmap):
+            return True
+        if isinstance(base, memoryview):
+            base = base.obj
+        else:
+            base = getattr(base, 'base', None)
+    return False
+
+class VectorLRU:
+
+    ''' bounded in-memory cache of vectors read from the
+        disk files of the elmo cache, keyed by cache entry
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.entry2vectors = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, entry):
+        try:
+            vectors = self.entry2vectors.pop(entry)
+        except KeyError:
+            self.misses += 1
+            return None
+        # re-insert as most recently used
+        self.entry2vectors[entry] = vectors
+        self.hits += 1
+        return vectors
+
+    def put(self, entry, vectors):
+        self.discard(entry)
+        if vectors.nbytes > self.max_bytes:
+            return
+        self.entry2vectors[entry] = vectors
+        self.n_bytes += vectors.nbytes
+        while self.n_bytes > self.max_bytes:
+            _, old_vectors = self.entry2vectors.popitem(last = False)
+            self.n_bytes -= old_vectors.nbytes
+            self.evictions += 1
+
+    def discard(self, entry):
+        try:
+            vectors = self.entry2vectors.pop(entry)
+        except KeyError:
+            return
+        self.n_bytes -= vectors.nbytes
+
+    def discard_mmap_views(self):
+        ''' removes vectors that are views of a memory-mapped
+            file, e.g. before the file is unmapped
+        '''
+        for entry, vectors in list(self.entry2vectors.items()):
+            if is_mmap_view(vectors):
+                self.discard(entry)
+
 class ElmoCache:
 
+    data_basename  = 'data'
+    atime_basename = 'access.dat'
+    legacy_atime_basename = 'access'   # text records of 48 bytes
+
     class Entry:
         def __init__(self, tokens, lcode, hdf5_key):
-            self.vectors = None
+            self.vectors = None                # may be None for ready entries if on disk
+            self.ready   = False               # vectors available in memory or on disk
             self.last_access = 0.0
+            self.n_accesses  = 0               # for eviction policies
+            self.priority    = 0.0             # for eviction policies
             self.access_time_synced = False
             self.records            = []       # list of records to sync atime to ([] = not yet allocated)
             self.vectors_on_disk    = False
             self.hdf5_in_progress   = False
-            self.requesters         = []       # do not discard entry while there is a requester (= npz_name)
+            self.requesters         = collections.Counter()  # do not discard entry while there is a requester (= npz_name)
             self.tokens             = tokens   # set to None when hdf5 task is submitted
             self.hdf5_key           = hdf5_key # set to None when vector is collected from hdf5 task
             self.lcode              = lcode
@@ -212,69 +309,174 @@ class ElmoCache:
             return 'NPZ write limit reached'
         return None
 
+    def add_vectors(self, key, lcode, vectors, last_access = None):
+        ''' adds ready vectors to the cache, e.g. when migrating
+            or benchmarking the cache
+        '''
+        if key in self.key2entry:
+            return self.key2entry[key]
+        entry = ElmoCache.Entry(None, lcode, None)
+        entry.length = vectors.shape[0]
+        entry.vectors = vectors
+        entry.ready = True
+        if last_access is not None:
+            entry.last_access = last_access
+        self.key2entry[key] = entry
+        self.eviction_policy.on_insert(entry, self.get_n_parts(entry))
+        return entry
+
+    def get_n_parts(self, entry):
+        return eviction_policies.get_n_parts(entry.length, self.vectors_per_record)
+
+    def get_vectors(self, entry):
+        ''' returns the vectors of a ready entry, reading
+            them from disk if they are not in memory
+        '''
+        if entry.vectors is not None:
+            return entry.vectors
+        vectors = self.vector_lru.get(entry)
+        if vectors is None:
+            vectors = self.read_vectors(entry.records)
+            if not is_mmap_view(vectors):
+                # views of disk records are not kept as the records
+                # may be re-used; other vectors, e.g. from
+                # numpy.load(), may still share memory with a buffer
+                if not vectors.flags.owndata:
+                    vectors = numpy.array(vectors)
+                self.vector_lru.put(entry, vectors)
+        return vectors
+
+    def read_vectors(self, records):
+        parts = [self.read_part(r_index) for r_index in records]
+        if len(parts) == 1:
+            return parts[0]
+        return numpy.concatenate(parts, axis=0)
+
+    def read_part(self, r_index):
+        if self.data_reader is None:
+            self.data_reader = open(self.data_filename, 'rb')
+        data_file = self.data_reader
+        data_file.seek(r_index * self.record_size)
+        line = data_file.readline(self.record_size)
+        if not line.startswith(b'data'):
+            raise ValueError('No vectors in elmo cache record %d' %r_index)
+        fields = line.split()
+        n_payload = int(fields[2])
+        payload_hash = fields[3]
+        payload_lines = []
+        while n_payload:
+            line = data_file.readline(self.record_size)
+            if line.startswith(b'#'):
+                continue
+            payload_lines.append(line)
+            n_payload -= 1
+        if self.verify_payload \
+        and payload_hash != self.get_payload_hash(b''.join(payload_lines)):
+            raise ValueError('Wrong payload hash in elmo cache record %d' %r_index)
+        return self.payload_lines_to_vectors(payload_lines[4:])
+
+    def keep_vectors_in_memory(self, entry):
+        ''' makes sure that entry.vectors does not depend on the
+            disk records of the entry so that they can be re-used
+        '''
+        if entry.vectors is None and entry.records:
+            vectors = self.get_vectors(entry)
+            if not vectors.flags.owndata:
+                vectors = numpy.array(vectors)
+            entry.vectors = vectors
+            self.vector_lru.discard(entry)
+
     def allocate(self, data_file, key, part_index):
         r_index, _ = self.get_location(data_file, key, part_index, accept_free = True)
-        self.record_states[r_index] = ord('p')
+        self.set_record_state(r_index, ord('p'))
         return r_index
 
-    def get_location(self, data_file, key, part_index, accept_free = False, max_probes = 999999):
-        # TODO: reduce to returning only r_index if 2nd part never used
-        #print('Probing for %s part %d...' %(key, part_index))
+    def set_record_state(self, r_index, state):
+        ''' changes the state of a record, keeping
+            state2count up-to-date
+        '''
+        state2count = self.state2count
+        state2count[self.record_states[r_index]] -= 1
+        state2count[state] += 1
+        self.record_states[r_index] = state
+
+    def count_record_states(self):
+        ''' initialises state2count after changing
+            record_states directly
+        '''
+        self.state2count = collections.Counter(self.record_states)
+
+    def get_location(self, data_file, key, part_index, accept_free = False, max_probes = None):
+        ''' returns the record index of the given part of the entry
+            for key and whether this record holds the data of this
+            part (b'data'), is free (b'free') or has never been used
+            (b'init')
+        '''
+        r_index = self.key_and_part2idx.get((key, part_index))
+        if r_index is not None and self.record_states[r_index] == ord('d'):
+            return r_index, b'data'
+        # open addressing with double hashing: the step size is
+        # co-prime to the number of records so that the probe sequence
+        # visits every record once
+        n_records = self.n_records
+        r_index, step = self.get_probe_start_and_step(key, part_index)
+        if max_probes is None:
+            max_probes = n_records
+        record_states = self.record_states
         probe_index = 0
-        found_earlier_free = False
-        earlier_free_r_index = None
-        earlier_free_p_index = None
         while probe_index < max_probes:
-            if accept_free and found_earlier_free \
-            and probe_index > earlier_free_p_index + 10:
-                break
-            h = hashlib.sha512(b'%d:%d:%s' %(
-                  probe_index, part_index, key
-            )).hexdigest()
-            r_index = int(h, 16) % self.n_records
-            state = self.record_states[r_index]
+            state = record_states[r_index]
             if state == ord('i'):
-                #print('\t%d: record %d is initialised' %(probe_index, r_index))
-                if accept_free and found_earlier_free:
-                    return earlier_free_r_index, b'free'
+                self.n_probes += probe_index + 1
                 return r_index, b'init'
             elif state == ord('f'):
-                #print('\t%d: record %d is free' %(probe_index, r_index))
-                #return r_index, b'free'
-                # We now keep scanning in case there is a matching entry in a
-                # later probe in order to stabilise the positions of entries
-                # as they are removed and re-added to the cache.
-                # However, to not scan unreasonably long, we note the probe
-                # index and, at the start of the loop above, limit how far
-                # we scan.
-                if accept_free and not found_earlier_free:
-                    found_earlier_free = True
-                    earlier_free_r_index = r_index
-                    earlier_free_p_index = probe_index
-            elif state == ord('p'):
-                # pre-allocated for an earlier part of this key
-                # --> cannot use this record
-                #print('\t%d: record %d is pre-allocated' %(probe_index, r_index))
-                pass
-            elif state == ord('d'):
-                # data record: need to check whether key and part match
-                if (key, part_index) == self.idx2key_and_part[r_index]:
-                    return r_index, b'data'
-                #else:
-                #    print('\t%d: record %d has mismatching data %s part %d' %(
-                #        (probe_index, r_index,) + self.idx2key_and_part[r_index]
-                #    ))
-            else:
+                if accept_free:
+                    self.n_probes += probe_index + 1
+                    return r_index, b'free'
+            elif state not in (ord('p'), ord('d')):
                 raise ValueError('Unknown record state %d at index %d' %(state, r_index))
             probe_index += 1
-        if accept_free and found_earlier_free:
-            # do not complain about reaching max_probes when we
-            # found and accept free records
-            return earlier_free_r_index, b'free'
+            r_index += step
+            if r_index >= n_records:
+                r_index -= n_records
+        self.n_probes += probe_index
         raise ValueError('Unable to find space in elmo disk cache.')
 
-    def write_vectors(self, data_file, r_index, key, part_index, n_parts, partial_vectors, lcode, n_tokens):
-        data_file.seek(r_index * self.record_size)
+    def get_probe_start_and_step(self, key, part_index):
+        if key != self.last_probe_key:
+            # one hash per key for all its parts
+            h = hashlib.sha512(key).digest()
+            self.last_probe_hash = struct.unpack('<QQQ', h[:24])
+            self.last_probe_key = key
+        h1, h2, h3 = self.last_probe_hash
+        n_records = self.n_records
+        r_index = (h1 + part_index * h3) % n_records
+        if n_records < 2:
+            return r_index, 1
+        step = 1 + h2 % (n_records - 1)
+        while gcd(step, n_records) != 1:
+            step += 1
+            if step >= n_records:
+                step = 1
+        return r_index, step
+
+    def set_location(self, r_index, key, part_index):
+        ''' records that r_index holds the given part of key '''
+        old_key_and_part = self.idx2key_and_part[r_index]
+        if old_key_and_part is not None \
+        and self.key_and_part2idx.get(old_key_and_part) == r_index:
+            del self.key_and_part2idx[old_key_and_part]
+        self.idx2key_and_part[r_index] = (key, part_index)
+        self.key_and_part2idx[(key, part_index)] = r_index
+
+    def rebuild_location_index(self):
+        self.key_and_part2idx = {}
+        for r_index, key_and_part in enumerate(self.idx2key_and_part):
+            if key_and_part is not None \
+            and self.record_states[r_index] == ord('d'):
+                self.key_and_part2idx[key_and_part] = r_index
+
+    def get_vector_record(self, r_index, key, part_index, n_parts, partial_vectors, lcode, n_tokens, full_size = False):
         payload = []
         payload.append(b'key %s\n' %key)
         payload.append(b'part %d of %d\n' %(part_index+1, n_parts))
@@ -291,14 +493,15 @@ class ElmoCache:
         n_payload_lines = payload.count(b'\n')
         header = b'data %d %d %s\n' %(r_index, n_payload_lines, payload_hash)
         data = b''.join((header, payload, b'\n'))
-        pad_to = 4096 * int((len(data)+4095)/4096)
-        data_file.write(self.get_data_record(
+        if full_size:
+            pad_to = None
+        else:
+            pad_to = 4096 * int((len(data)+4095)/4096)
+        return self.get_data_record(
             r_index,
             prefix = data,
             pad_to = pad_to,
-        ))
-        self.idx2key_and_part[r_index] = (key, part_index)
-        self.record_states[r_index] = ord('d')
+        )
 
     def payload_lines_to_vectors(self, payload_lines):
         compressed_data = base64.b64decode(b''.join(payload_lines))
@@ -321,37 +524,32 @@ class ElmoCache:
         vectors_per_record = self.vectors_per_record
         candidates = []
         for key, entry in utilities.iteritems(self.key2entry):
-            if entry.vectors is None:
+            if not entry.ready:
                 # nothing to do for this entry, e.g. hdf5 in progress
                 continue
-            if entry.requesters:
-                stale_for = 0.0   # high priority item
-            else:
-                stale_for = now - entry.last_access
-            n_tokens = entry.vectors.shape[0]
-            n_parts = int((n_tokens+vectors_per_record-1)/vectors_per_record)
-            candidates.append((stale_for, key, n_parts))
-        candidates.sort()
-        candidates.append((None, None, self.n_records+1))   # simplify loop below
+            n_parts = eviction_policies.get_n_parts(entry.length, vectors_per_record)
+            # entries with requesters are high priority items
+            candidates.append((key, entry, n_parts, bool(entry.requesters)))
         max_records = self.max_load_factor * self.n_records
-        n_keys = 0
-        n_records_so_far = 0
-        while n_records_so_far + candidates[n_keys][2] < max_records:
-            n_records_so_far += candidates[n_keys][2]
-            n_keys += 1
-        print('\t%d entries, in order of recent usage, require %d of %d allowed records' %(
-            n_keys, n_records_so_far, max_records
+        retval, to_prune = eviction_policies.select_entries(
+            self.eviction_policy, candidates, max_records, now
+        )
+        n_records_so_far = sum([n_parts for _, _, n_parts in retval])
+        print('\t%d entries, in order of %s priority, require %d of %d allowed records' %(
+            len(retval), self.eviction_policy.name, n_records_so_far, max_records
         ))
-        del candidates[-1]
-        retval = candidates[:n_keys]
-        print('\tPruning cache back by %d entries...' %(len(candidates)-n_keys))
+        print('\tPruning cache back by %d entries...' %len(to_prune))
         failed = 0
-        for _, key, _ in candidates[n_keys:]:
+        evicted = []
+        for _, key, _ in to_prune:
             entry = self.key2entry[key]
+            evicted.append(entry)
             # regardless whether there are requesters, we must make available
             # space on disk
+            if entry.requesters:
+                self.keep_vectors_in_memory(entry)
             for r_index in entry.records:
-                self.record_states[r_index] = ord('f')
+                self.set_record_state(r_index, ord('f'))
             if entry.requesters:
                 failed += 1
                 # mark as no longer on disk
@@ -360,58 +558,105 @@ class ElmoCache:
                 entry.access_time_synced = True   # TODO: value should not matter
             else:
                 # without requesters, we can simply delete the full entry
+                self.vector_lru.discard(entry)
                 del self.key2entry[key]
+        self.eviction_policy.on_evict(evicted)
+        self.n_evicted += len(to_prune) - failed
+        self.n_evicted_from_disk_only += failed
         print('\t%d entries only deleted from disk but not from memory due to ongoing requests' %failed)
         return retval
 
     def on_worker_idle(self):
         self.sync_to_disk_files()
+        self.export_metrics()
+        if self.trace_file is not None:
+            self.trace_file.flush()
 
     def on_worker_exit(self):
         self.sync_to_disk_files(force = True)
+        self.export_metrics(force = True)
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+        if self.watcher is not None:
+            self.watcher.close()
+
+    def wait_for_activity(self, timeout):
+        if self.hdf5_tasks:
+            self.get_watcher().wait(timeout)
+        else:
+            time.sleep(timeout)
+
+    def get_watcher(self):
+        if self.watcher is None:
+            self.watcher = file_watcher.FileWatcher(
+                scan_interval = self.scan_interval
+            )
+        return self.watcher
 
     def sync_to_disk_files(self, force = False):
+        if self.sync_thread is not None:
+            if self.sync_thread.is_alive() and not force:
+                # previous sync still running
+                return
+            self.sync_thread.join()
+            plan = self.sync_plan
+            self.sync_thread = None
+            self.sync_plan = None
+            self.finish_sync(plan)
         now = time.time()
         if now < self.last_sync + self.sync_interval and not force:
             return
         self.last_sync = now
         keys = self.prune_cache_to_max_load_factor(now)
-        self.p_sync_to_disk_files(keys)
+        if self.background_sync and not force:
+            print('Syncing elmo cache to disk in the background...')
+            sys.stdout.flush()
+            self.sync_plan = self.plan_sync(keys)
+            self.sync_thread = threading.Thread(
+                target = self.write_sync_plan,
+                args = (self.sync_plan,),
+            )
+            self.sync_thread.start()
+        else:
+            self.p_sync_to_disk_files(keys)
 
     def p_sync_to_disk_files(self, keys):
         print('Syncing elmo cache to disk...')
         sys.stdout.flush()
-        start_time = time.time()
-        data_file = open(self.data_filename, 'r+b')
-        atime_file = open(self.atime_filename, 'r+b')
+        plan = self.plan_sync(keys)
+        self.write_sync_plan(plan)
+        self.finish_sync(plan)
+
+    class SyncPlan:
+        def __init__(self):
+            self.start_time = time.time()
+            self.duration = None
+            self.vector_writes  = []   # (r_index, key, part_index, n_parts, vectors, lcode, n_tokens)
+            self.atime_writes   = []   # (r_index, last_access)
+            self.vector_entries = []   # entries that will have their vectors on disk
+            self.atime_entries  = []   # (entry, last_access) that will have atime synced
+            self.n_entries_total = 0
+            self.exception = None      # set if writing the plan failed
+
+    def plan_sync(self, keys):
+        ''' allocates records for entries that need to be written
+            and returns what needs to be written to disk, so that
+            writing can run in a separate thread
+        '''
+        plan = ElmoCache.SyncPlan()
         vectors_per_record = self.vectors_per_record
-        n_entries_total = 0
-        n_entries_vectors = 0
-        n_entries_atime = 0
-        n_records_vectors = 0
-        n_records_atime = 0
-        last_verbose = start_time
-        n_keys = len(keys)
-        key_index = 0
         for _, key, n_parts in keys:
-            now = time.time()
-            if now > last_verbose + self.verbosity_interval:
-                print('\t%.1f%% of entries processed (%d of %d)' %(
-                    100.0*key_index/n_keys, key_index, n_keys
-                ))
-                sys.stdout.flush()
-                last_verbose = now
-            key_index += 1
             entry = self.key2entry[key]
-            n_entries_total += 1
+            plan.n_entries_total += 1
             if entry.access_time_synced and entry.vectors_on_disk \
-            or entry.vectors is None:
+            or not entry.ready:
                 # nothing to do for this entry
                 continue
             if not entry.records:
                 # find out where the parts are or will be stored
                 for part_index in range(n_parts):
-                    r_index = self.allocate(data_file, key, part_index)
+                    r_index = self.allocate(None, key, part_index)
                     entry.records.append(r_index)
             elif n_parts != len(entry.records):
                 raise ValueError('Incorrect number of records for entry in elmo cache')
@@ -419,25 +664,75 @@ class ElmoCache:
             if not entry.vectors_on_disk:
                 vectors = entry.vectors
                 for part_index, r_index in enumerate(entry.records):
-                    partial_vectors = vectors[:vectors_per_record]
-                    self.write_vectors(
-                        data_file, r_index, key, part_index, n_parts,
-                        partial_vectors, entry.lcode, entry.length,
-                    )
+                    plan.vector_writes.append((
+                        r_index, key, part_index, n_parts,
+                        vectors[:vectors_per_record],
+                        entry.lcode, entry.length,
+                    ))
                     vectors = vectors[vectors_per_record:]
-                n_entries_vectors += 1
-                n_records_vectors += n_parts
-                entry.vectors_on_disk = True
-            if not entry.access_time_synced:
+                    self.set_location(r_index, key, part_index)
+                    self.set_record_state(r_index, ord('d'))
+                plan.vector_entries.append(entry)
+            # new records also need their access time
+            for r_index in entry.records:
+                plan.atime_writes.append((r_index, entry.last_access))
+            plan.atime_entries.append((entry, entry.last_access))
+        return plan
+
+    def write_sync_plan(self, plan):
+        ''' writes vectors and access times in the order of
+            their position on disk; errors are recorded in the
+            plan as this may run in a separate thread
+        '''
+        try:
+            data_file, atime_file = self.open_disk_files()
+            plan.vector_writes.sort(key = lambda x: x[0])
+            self.write_records(data_file, plan.vector_writes)
+            plan.atime_writes.sort()
+            self.write_atimes(atime_file, plan.atime_writes)
+            self.close_disk_files(data_file, atime_file)
+        except Exception as e:
+            plan.exception = e
+        plan.duration = time.time() - plan.start_time
+
+    def finish_sync(self, plan):
+        ''' updates the state of entries after the plan has been
+            written and prints statistics
+        '''
+        if plan.exception is not None:
+            # entries keep their vectors in memory and get new
+            # records in the next sync
+            for entry in plan.vector_entries:
                 for r_index in entry.records:
-                    self.write_atime(atime_file, r_index, entry.last_access)
-                n_entries_atime += 1
-                n_records_atime += n_parts
+                    self.set_record_state(r_index, ord('f'))
+                entry.records = []
+            print('Failed to sync elmo cache to disk after %.1f seconds' %plan.duration)
+            sys.stdout.flush()
+            raise plan.exception
+        for entry in plan.vector_entries:
+            entry.vectors_on_disk = True
+            if not is_mmap_view(entry.vectors):
+                vectors = entry.vectors
+                if not vectors.flags.owndata:
+                    vectors = numpy.array(vectors)
+                self.vector_lru.put(entry, vectors)
+            # vectors will be read from disk when needed
+            entry.vectors = None
+        for entry, last_access in plan.atime_entries:
+            if entry.last_access == last_access:
                 entry.access_time_synced = True
-        data_file.close()
-        atime_file.close()
-        duration = time.time() - start_time
-        print('\t# duration: %.1f seconds' %duration)
+        n_entries_total = plan.n_entries_total
+        n_entries_vectors = len(plan.vector_entries)
+        n_records_vectors = len(plan.vector_writes)
+        n_entries_atime = len(plan.atime_entries)
+        n_records_atime = len(plan.atime_writes)
+        self.n_syncs += 1
+        self.sync_seconds += plan.duration
+        self.last_sync_duration = plan.duration
+        self.n_records_written += n_records_vectors
+        self.n_bytes_written += n_records_vectors * self.record_size + 8 * n_records_atime
+        print('Finished syncing elmo cache to disk')
+        print('\t# duration: %.1f seconds' %plan.duration)
         try:
             nan = math.nan
         except AttributeError:
@@ -460,6 +755,78 @@ class ElmoCache:
         ))
         self.print_cache_stats()
 
+    def write_records(self, data_file, vector_writes):
+        ''' writes the given vectors, sorted by record index, combining
+            adjacent records into a single write
+        '''
+        record_size = self.record_size
+        run_offset = None
+        run = []
+        n_writes = len(vector_writes)
+        for w_index, (r_index, key, part_index, n_parts, vectors, lcode, n_tokens) in enumerate(vector_writes):
+            offset = r_index * record_size
+            if run and offset != run_offset + len(run) * record_size:
+                self.p_write(data_file, run_offset, run)
+                run = []
+            if not run:
+                run_offset = offset
+            # pad records to the full record size when followed by the
+            # next record in the file so that they can be written together
+            is_followed = w_index + 1 < n_writes \
+                and vector_writes[w_index+1][0] == r_index + 1
+            record = self.get_vector_record(
+                r_index, key, part_index, n_parts, vectors, lcode, n_tokens,
+                full_size = is_followed
+            )
+            run.append(record)
+            if not is_followed or len(run) * record_size >= self.max_write_size:
+                self.p_write(data_file, run_offset, run)
+                run = []
+        if run:
+            self.p_write(data_file, run_offset, run)
+
+    def p_write(self, data_file, offset, buffers):
+        data = b''.join(buffers)
+        try:
+            fd = data_file.fileno()
+            while data:
+                n_written = os.pwrite(fd, data, offset)
+                data = data[n_written:]
+                offset += n_written
+        except AttributeError:
+            # Python 2
+            data_file.seek(offset)
+            data_file.write(data)
+
+    def write_atimes(self, atime_file, atime_writes):
+        ''' writes access times, sorted by record index, with one
+            write for each range of consecutive records
+        '''
+        atimes = self.atimes
+        for r_index, last_access in atime_writes:
+            atimes[r_index] = last_access
+        start = None
+        last_r_index = None
+        for r_index, _ in atime_writes + [(None, None)]:
+            if start is not None \
+            and (r_index is None or r_index > last_r_index + 1):
+                self.p_write(atime_file, 8 * start, [
+                    atimes[start:last_r_index+1].tobytes()
+                ])
+                start = None
+            if r_index is None:
+                break
+            if start is None:
+                start = r_index
+            last_r_index = r_index
+
+    def open_disk_files(self):
+        return open(self.data_filename, 'r+b'), open(self.atime_filename, 'r+b')
+
+    def close_disk_files(self, data_file, atime_file):
+        data_file.close()
+        atime_file.close()
+
     def print_cache_stats(self):
         print('\t# npz names:', len(self.npz2ready_count))
         print('\t# running hdf5 tasks:', len(self.hdf5_tasks))
@@ -476,20 +843,68 @@ class ElmoCache:
         print('\t# cache hits with hdf5 in progress: %d (%.1f%%)' %(
             self.cache_hit_in_progress, 100.0*self.cache_hit_in_progress/total_sentences
         ))
-        state2freq = {}
-        for state in self.record_states:
-            try:
-                state2freq[state] += 1
-            except KeyError:
-                state2freq[state] = 1
-        for state in sorted(list(state2freq.keys())):
-            freq = state2freq[state]
-            if state is None:
-                print('\t# unknown records:', freq)
-            else:
+        lru = self.vector_lru
+        print('\t# entries with vectors in memory LRU: %d (%.1f MiB of %.1f MiB)' %(
+            len(lru.entry2vectors), lru.n_bytes / 1024.0**2, lru.max_bytes / 1024.0**2
+        ))
+        print('\t# memory LRU hits: %d, misses: %d' %(lru.hits, lru.misses))
+        print('\t# record probes for allocation:', self.n_probes)
+        for state in sorted(list(self.state2count.keys())):
+            freq = self.state2count[state]
+            if freq:
                 print('\t# %s records: %d' %(chr(state), freq))
         sys.stdout.flush()
 
+    def get_metrics(self):
+        ''' returns the cache statistics in the format expected
+            by metrics_export.format_metrics()
+        '''
+        prefix = 'elmo_cache_'
+        lru = self.vector_lru
+        state_samples = []
+        for state in sorted(list(self.state2count.keys())):
+            state_samples.append(({'state': chr(state)}, self.state2count[state]))
+        return [
+            (prefix + 'records', 'gauge', 'Number of records on disk by state', state_samples),
+            (prefix + 'entries', 'gauge', 'Number of cache entries', len(self.key2entry)),
+            (prefix + 'npz_requests', 'gauge', 'Number of npz requests in progress', len(self.npz2ready_count)),
+            (prefix + 'hdf5_tasks', 'gauge', 'Number of running elmo-hdf5 tasks', len(self.hdf5_tasks)),
+            (prefix + 'sentences_total', 'counter', 'Requested sentences by cache outcome', [
+                ({'outcome': 'hit'}, self.cache_hit),
+                ({'outcome': 'miss'}, self.cache_miss),
+                ({'outcome': 'in_progress'}, self.cache_hit_in_progress),
+            ]),
+            (prefix + 'npz_bytes_written_total', 'counter', 'Bytes written to npz files', self.npz_bytes_written),
+            (prefix + 'disk_bytes_written_total', 'counter', 'Bytes of records and access times written to the cache files', self.n_bytes_written),
+            (prefix + 'disk_records_written_total', 'counter', 'Records written to the cache files', self.n_records_written),
+            (prefix + 'syncs_total', 'counter', 'Completed syncs to disk', self.n_syncs),
+            (prefix + 'sync_seconds_total', 'counter', 'Time spent syncing to disk', self.sync_seconds),
+            (prefix + 'last_sync_seconds', 'gauge', 'Duration of the last sync to disk', self.last_sync_duration),
+            (prefix + 'evicted_entries_total', 'counter', 'Entries removed to keep the load factor', [
+                ({'scope': 'entry'}, self.n_evicted),
+                ({'scope': 'disk_only'}, self.n_evicted_from_disk_only),
+            ]),
+            (prefix + 'record_probes_total', 'counter', 'Records probed to allocate or find records', self.n_probes),
+            (prefix + 'lru_bytes', 'gauge', 'Bytes of vectors in the memory LRU', lru.n_bytes),
+            (prefix + 'lru_lookups_total', 'counter', 'Lookups in the memory LRU', [
+                ({'outcome': 'hit'}, lru.hits),
+                ({'outcome': 'miss'}, lru.misses),
+            ]),
+            (prefix + 'lru_evictions_total', 'counter', 'Vectors evicted from the memory LRU', lru.evictions),
+        ]
+
+    def export_metrics(self, force = False):
+        if not self.metrics_filename:
+            return
+        now = time.time()
+        if now < self.last_metrics_export + self.metrics_interval and not force:
+            return
+        self.last_metrics_export = now
+        metrics_export.write_metrics_file(
+            self.metrics_filename,
+            metrics_export.format_metrics(self.get_metrics())
+        )
+
     def load_from_disk(self):
         print('Loading elmo cache from disk...')
         sys.stdout.flush()
@@ -510,8 +925,8 @@ class ElmoCache:
         self.record_states.fromfile(f_zero, self.n_records)
         f_zero.close()
         self.idx2key_and_part = self.n_records * [None]
+        self.load_atimes()
         data_file = open(self.data_filename, 'rb')
-        atime_file = open(self.atime_filename, 'rb')
         n_discarded_records = 0
         last_verbose = time.time()
         last_bytes = 0
@@ -524,7 +939,17 @@ class ElmoCache:
                 bytes_so_far = bytes_so_far,
             )
             data_file.seek(r_index * self.record_size)
-            line = data_file.readline(self.record_size)
+            line = data_file.read(4)
+            if line != b'data':
+                # block is free/recycled or never been used; records
+                # that were never written may read as zero bytes
+                if line[:1] in (b'i', b'\0', b''):
+                    self.record_states[r_index] = ord('i')
+                else:
+                    self.record_states[r_index] = ord('f')
+                bytes_so_far += len(line)
+                continue
+            line += data_file.readline(self.record_size - 4)
             bytes_so_far += len(line)
             #          [0]  [1] [2] [3]
             # example: data 123 500 xyz
@@ -536,15 +961,16 @@ class ElmoCache:
             #      that may occur _after_ the obligatory lines below
             #  [3] a hash of the payload to detect partially
             #      written, damaged or inconsistent data
-            self.record_states[r_index] = utilities.b_ord(line[0])
-            if not line.startswith(b'data'):
-                # block is free/recycled or never been used
-                continue
+            self.record_states[r_index] = ord('d')
             fields = line.split()
             assert fields[1] == (b'%d' %r_index)
             n_payload = int(fields[2])
             assert n_payload < self.record_size
             payload_hash = fields[3]
+            if not self.verify_on_load:
+                # only read the key, part, length and lcode lines;
+                # vectors are read when needed
+                n_payload = min(n_payload, 4)
             payload_lines = []
             while n_payload:
                 line = data_file.readline(self.record_size)
@@ -553,11 +979,11 @@ class ElmoCache:
                     continue
                 payload_lines.append(line)
                 n_payload -= 1
-            if payload_hash != self.get_payload_hash(b''.join(payload_lines)):
+            if self.verify_on_load \
+            and payload_hash != self.get_payload_hash(b''.join(payload_lines)):
                 print('skipping record %d with wrong payload hash' %r_index)
                 n_discarded_records += 1
-                self.record_states[r_index2] = ord('f')
-                self.idx2key_and_part[r_index2] = None
+                self.record_states[r_index] = ord('f')
                 continue
             # line: key 00017:en:ksdjahfhqwefuih
             fields = payload_lines[0].split()
@@ -579,13 +1005,7 @@ class ElmoCache:
             assert fields[0] == b'lcode'
             lcode = fields[1]
             # get time of last access
-            atime_file.seek(self.atime_size*r_index)
-            line = atime_file.readline()
-            bytes_so_far += len(line)
-            try:
-                atime = float(line.split()[0])
-            except:
-                raise ValueError('atime for record %d is %r' %(r_index, line))
+            atime = float(self.atimes[r_index])
             # create in-memory cache entry if it does not exist yet
             if not key in self.key2entry:
                 entry = ElmoCache.Entry(None, lcode, None)
@@ -604,21 +1024,17 @@ class ElmoCache:
             or part_index in entry.have_parts:
                 # already collected all parts or this part for this entry
                 n_discarded_records += 1
-                self.record_states[r_index2] = ord('f')
-                self.idx2key_and_part[r_index2] = None
+                self.record_states[r_index] = ord('f')
+                self.idx2key_and_part[r_index] = None
                 continue
             # add new part to entry
-            vectors = self.payload_lines_to_vectors(payload_lines[4:])   # TODO
-            entry.have_parts[part_index] = (r_index, vectors)
+            entry.have_parts[part_index] = r_index
             entry.access_times.append(atime)
             if len(entry.have_parts) == entry.n_parts:
-                # all parts are ready
-                parts = []
+                # all parts are ready; vectors stay on disk until needed
                 for part_index in sorted(list(entry.have_parts.keys())):
-                    r_index2, vectors = entry.have_parts[part_index]
-                    entry.records.append(r_index2)
-                    parts.append(vectors)
-                entry.vectors = numpy.concatenate(parts, axis=0)
+                    entry.records.append(entry.have_parts[part_index])
+                entry.ready = True
                 entry.last_access = max(entry.access_times)
                 entry.access_time_synced = (
                     entry.last_access == min(entry.access_times)
@@ -628,7 +1044,6 @@ class ElmoCache:
                 entry.have_parts = None
                 entry.access_times = None
         data_file.close()
-        atime_file.close()
         # remove all incomplete in-memory cache entries
         incomplete = []
         n_atime_not_synced = 0
@@ -637,30 +1052,93 @@ class ElmoCache:
             if entry.have_parts is not None:
                 incomplete.append(key)
                 for part_index in entry.have_parts:
-                    r_index2, _ = entry.have_parts[part_index]
-                    self.record_states[r_index2] = ord('f')
+                    r_index = entry.have_parts[part_index]
+                    self.record_states[r_index] = ord('f')
                     # release memory:
-                    self.idx2key_and_part[r_index2] = None
+                    self.idx2key_and_part[r_index] = None
             elif not entry.access_time_synced:
                 n_atime_not_synced += 1
             else:
                 n_normal += 1
         for key in incomplete:
             del self.key2entry[key]
+        self.rebuild_location_index()
+        self.count_record_states()
         print('\t# normal entries found:', n_normal)
         print('\t# entries with inconsistent acess time:', n_atime_not_synced)
         print('\t# incomplete entries discarded:', len(incomplete))
+        print('\t# damaged or duplicate records discarded:', n_discarded_records)
         sys.stdout.flush()
 
-    def __init__(self):
+    def __init__(self, cache_dir = None, read_only = False):
         self.npz2ready_count = {}
+        self.npz2keys = {}      # keys of requested entries (each key once)
         self.key2entry = {}
         self.hdf5_tasks = []
         self.hdf5_workdir_usage = {}
-        cache_dir = os.environ['EFML_NPZ_CACHE_DIR']
-        self.atime_filename = cache_dir + '/access'
-        self.data_filename  = cache_dir + '/data'
+        self.watcher = None
+        if cache_dir is None:
+            cache_dir = os.environ['EFML_NPZ_CACHE_DIR']
+        self.atime_filename = cache_dir + '/' + self.atime_basename
+        if self.legacy_atime_basename:
+            self.legacy_atime_filename = cache_dir + '/' + self.legacy_atime_basename
+        else:
+            self.legacy_atime_filename = None
+        self.data_filename  = cache_dir + '/' + self.data_basename
         self.config_filename  = cache_dir + '/config'
+        # elmo-hdf5 task sizing
+        self.hdf5_stats_filename = cache_dir + '/hdf5-stats.tsv'
+        self.hdf5_stats_window = 200
+        self.hdf5_max_sentences = 2000
+        self.hdf5_token_budget = 40000
+        self.hdf5_long_sentence = 100
+        self.hdf5_target_duration = 900.0
+        if 'EUD_DEBUG' in os.environ \
+        and os.environ['EUD_DEBUG'].lower() not in ('0', 'false'):
+            self.hdf5_max_sentences = 400
+            self.hdf5_token_budget = 8000
+        if 'EFML_HDF5_TOKEN_BUDGET' in os.environ:
+            self.hdf5_token_budget = int(os.environ['EFML_HDF5_TOKEN_BUDGET'])
+        if 'EFML_HDF5_LONG_SENTENCE' in os.environ:
+            self.hdf5_long_sentence = int(os.environ['EFML_HDF5_LONG_SENTENCE'])
+        if 'EFML_HDF5_TARGET_DURATION' in os.environ:
+            self.hdf5_target_duration = float(os.environ['EFML_HDF5_TARGET_DURATION'])
+        self.load_hdf5_stats()
+        self.read_only = read_only
+        self.data_reader = None
+        self.max_write_size = 16 * 1024**2
+        self.preallocate = 'EFML_NPZ_CACHE_PREALLOCATE' in os.environ \
+            and os.environ['EFML_NPZ_CACHE_PREALLOCATE'].lower() not in ('0', 'false')
+        self.sync_thread = None
+        self.sync_plan = None
+        self.background_sync = 'EFML_NPZ_CACHE_BACKGROUND_SYNC' in os.environ \
+            and os.environ['EFML_NPZ_CACHE_BACKGROUND_SYNC'].lower() not in ('0', 'false')
+        self.key_and_part2idx = {}
+        self.last_probe_key = None
+        self.n_probes = 0
+        if 'EFML_NPZ_CACHE_MEMORY' in os.environ:
+            lru_size = utilities.float_with_suffix(
+                os.environ['EFML_NPZ_CACHE_MEMORY']
+            )
+        else:
+            lru_size = 1024**3
+        self.vector_lru = VectorLRU(lru_size)
+        self.eviction_policy = eviction_policies.new_policy()
+        # optional log of requests for simulate_elmo_cache.py
+        self.trace_file = None
+        if 'EFML_NPZ_CACHE_TRACE' in os.environ and not read_only:
+            self.trace_file = open(os.environ['EFML_NPZ_CACHE_TRACE'], 'ab')
+        # payload checksums are verified when vectors are read
+        # (EFML_NPZ_CACHE_VERIFY unset), also when the cache is
+        # loaded ('load') or never ('0')
+        self.verify_payload = True
+        self.verify_on_load = False
+        if 'EFML_NPZ_CACHE_VERIFY' in os.environ:
+            verify = os.environ['EFML_NPZ_CACHE_VERIFY'].lower()
+            if verify in ('0', 'false'):
+                self.verify_payload = False
+            elif verify == 'load':
+                self.verify_on_load = True
         self.atime_size = 48
         self.max_load_factor = 0.95
         self.last_scan = 0.0
@@ -683,14 +1161,40 @@ class ElmoCache:
         self.cache_hit_in_progress = 0
         self.cache_miss = 0
         self.cache_hit  = 0
-        if os.path.exists(self.atime_filename) \
+        self.n_syncs = 0
+        self.sync_seconds = 0.0
+        self.last_sync_duration = 0.0
+        self.n_records_written = 0
+        self.n_bytes_written = 0
+        self.n_evicted = 0
+        self.n_evicted_from_disk_only = 0
+        self.state2count = collections.Counter()
+        # metrics for monitoring, see metrics_export.py
+        self.metrics_filename = None
+        self.last_metrics_export = 0.0
+        self.metrics_interval = 60.0
+        if 'EFML_NPZ_CACHE_METRICS_FILE' in os.environ:
+            self.metrics_filename = os.environ['EFML_NPZ_CACHE_METRICS_FILE']
+        self.metrics_server = None
+        if 'EFML_NPZ_CACHE_METRICS_PORT' in os.environ and not read_only:
+            self.metrics_server = metrics_export.start_metrics_server(
+                int(os.environ['EFML_NPZ_CACHE_METRICS_PORT']),
+                self.get_metrics,
+            )
+        if self.have_atime_file() \
         and os.path.exists(self.data_filename) \
         and os.path.exists(self.config_filename):
             self.load_from_disk()
+            for entry in self.key2entry.values():
+                self.eviction_policy.on_insert(entry, self.get_n_parts(entry))
+        elif read_only:
+            raise ValueError('No elmo cache found in %s' %cache_dir)
         else:
             self.record_size = -1
             self.vectors_per_record = -1
             self.n_records = -1
+        if read_only:
+            return
         # check desired configuration against existing cache file
         rewrite_files = False
         if 'EFML_NPZ_CACHE_RECORD_SIZE' in os.environ:
@@ -698,19 +1202,29 @@ class ElmoCache:
         else:
             record_size = 32768
         if record_size != self.record_size:
-            self.record_size = record_size
             rewrite_files = True
         if 'EFML_NPZ_CACHE_VECTORS_PER_RECORD' in os.environ:
             vectors_per_record = int(os.environ['EFML_NPZ_CACHE_VECTORS_PER_RECORD'])
         else:
-            vectors_per_record = 6
+            vectors_per_record = self.get_default_vectors_per_record(record_size)
         if vectors_per_record != self.vectors_per_record:
-            self.vectors_per_record = vectors_per_record
             rewrite_files = True
+        if rewrite_files:
+            # vectors on disk can only be read with the geometry
+            # of the existing files
+            for key, entry in utilities.iteritems(self.key2entry):
+                if entry.ready:
+                    self.keep_vectors_in_memory(entry)
+            self.record_size = record_size
+            self.vectors_per_record = vectors_per_record
         n_records = self.get_n_records()
         if n_records != self.n_records:
-            self.n_records = n_records
-            rewrite_files = True
+            if rewrite_files or self.n_records < 0:
+                self.n_records = n_records
+                rewrite_files = True
+            else:
+                self.resize_disk_files(n_records)
+                self.sync_to_disk_files()
         if rewrite_files:
             # update disk files
             for key, entry in utilities.iteritems(self.key2entry):
@@ -720,6 +1234,9 @@ class ElmoCache:
             self.create_new_disk_files()
             self.sync_to_disk_files()
 
+    def get_default_vectors_per_record(self, record_size):
+        return 6
+
     def p_progress(self,
         last_verbose, last_bytes, r_index, record_size,
         what, is_after = True,
@@ -744,73 +1261,154 @@ class ElmoCache:
         return (last_verbose, last_bytes)
 
     def create_new_disk_files(self):
-        ''' write cache disk files pre-allocating space
-            with empty records, according to
+        ''' create cache disk files according to
               * self.record_size  and
               * self.n_records
+            without writing any records: all-zero records,
+            e.g. in sparse files, are initialised records
         '''
         print('Allocating elmo npz disk cache...')
         sys.stdout.flush()
+        self.unmap_disk_files()
         self.record_states = array.array('B', self.n_records * [ord('i')])
+        self.count_record_states()
         self.idx2key_and_part = self.n_records * [None]
+        self.key_and_part2idx = {}
+        self.write_config()
+        self.allocate_file(self.data_filename, self.n_records * self.record_size)
+        self.allocate_file(self.atime_filename, self.n_records * 8)
+        self.atimes = numpy.zeros((self.n_records,), dtype = '<f8')
+        if self.legacy_atime_filename \
+        and os.path.exists(self.legacy_atime_filename):
+            os.unlink(self.legacy_atime_filename)
+        self.map_disk_files()
+        print('\tdone')
+        sys.stdout.flush()
+
+    def write_config(self):
         config = open(self.config_filename, 'wb')
         config.write(b'record_size %d\n' %self.record_size)
         config.write(b'vectors_per_record %d\n' %self.vectors_per_record)
         config.close()
-        data_file = open(self.data_filename, 'wb')
-        last_verbose = time.time()
-        last_bytes = 0
-        for r_index in range(self.n_records):
-            data_file.write(self.get_data_record(r_index))
-            last_verbose, last_bytes = self.p_progress(
-                last_verbose, last_bytes, r_index, self.record_size,
-                'of elmo disk cache data records allocated',
-            )
-        data_file.close()
-        atime_file = open(self.atime_filename, 'wb')
-        last_verbose = time.time()
-        last_bytes = 0
-        for r_index in range(self.n_records):
-            atime_file.write(self.get_atime_record(0, r_index))
-            last_verbose, last_bytes = self.p_progress(
-                last_verbose, last_bytes, r_index, self.atime_size,
-                'of elmo disk cache access records allocated',
-            )
-        atime_file.close()
-        print('\tdone')
+
+    def allocate_file(self, filename, size, keep_data = False):
+        ''' sets the size of a cache file; new space is sparse
+            unless EFML_NPZ_CACHE_PREALLOCATE is set
+        '''
+        if keep_data and os.path.exists(filename):
+            old_size = os.path.getsize(filename)
+            f = open(filename, 'r+b')
+        else:
+            old_size = 0
+            f = open(filename, 'wb')
+        f.truncate(size)
+        if self.preallocate and size > old_size:
+            try:
+                os.posix_fallocate(f.fileno(), old_size, size - old_size)
+            except (AttributeError, OSError) as e:
+                print('Warning: cannot preallocate %s: %s' %(filename, e))
+        f.close()
+
+    def resize_disk_files(self, n_records):
+        ''' changes the number of records without rewriting the
+            records that are kept
+        '''
+        print('Resizing elmo disk cache from %d to %d records...' %(
+            self.n_records, n_records
+        ))
+        sys.stdout.flush()
+        if n_records < self.n_records:
+            # truncating the data file would invalidate
+            # vectors of get_vectors() that are still in use
+            if not self.unmap_disk_files():
+                self.map_disk_files()
+                print('\tnot resizing as vectors of disk records are still in use')
+                sys.stdout.flush()
+                return
+            self.map_disk_files()
+        n_moved = 0
+        for key, entry in utilities.iteritems(self.key2entry):
+            if entry.records and max(entry.records) >= n_records:
+                # entry needs to be written again in the smaller file
+                self.keep_vectors_in_memory(entry)
+                for r_index in entry.records:
+                    if r_index < n_records:
+                        self.set_record_state(r_index, ord('f'))
+                entry.records = []
+                entry.vectors_on_disk = False
+                entry.access_time_synced = False
+                n_moved += 1
+        self.unmap_disk_files()
+        if n_records < self.n_records:
+            del self.record_states[n_records:]
+            del self.idx2key_and_part[n_records:]
+        else:
+            n_new = n_records - self.n_records
+            self.record_states.extend(array.array('B', n_new * [ord('i')]))
+            self.idx2key_and_part.extend(n_new * [None])
+        self.resize_atimes(n_records)
+        self.allocate_file(self.data_filename, n_records * self.record_size, keep_data = True)
+        self.allocate_file(self.atime_filename, n_records * 8, keep_data = True)
+        self.n_records = n_records
+        self.map_disk_files()
+        self.rebuild_location_index()
+        self.count_record_states()
+        print('\t# entries that need to be written again:', n_moved)
         sys.stdout.flush()
 
-    def write_atime(self, atime_file, r_index, last_access):
-        atime_file.seek(r_index * self.atime_size)
-        atime_file.write(self.get_atime_record(last_access, r_index))
-
-    def get_atime_record(self, atime, r_index):
-        fields = []
-        fields.append(b'%.1f' %atime)
-        # optional / comment fields:
-        fields.append(b'%d' %r_index)
-        state = self.record_states[r_index]
-        if ord('a') <= state <= ord('z'):
-            fields.append(utilities.bstring(chr(state)))
-        elif not state:
-            fields.append(b'-')
+    def resize_atimes(self, n_records):
+        atimes = numpy.zeros((n_records,), dtype = '<f8')
+        n_kept = min(n_records, self.atimes.shape[0])
+        atimes[:n_kept] = self.atimes[:n_kept]
+        self.atimes = atimes
+
+    def map_disk_files(self):
+        pass
+
+    def unmap_disk_files(self):
+        ''' returns whether all disk records were released '''
+        if self.data_reader is not None:
+            self.data_reader.close()
+            self.data_reader = None
+        return True
+
+    def have_atime_file(self):
+        if os.path.exists(self.atime_filename):
+            return True
+        return self.legacy_atime_filename is not None \
+            and os.path.exists(self.legacy_atime_filename)
+
+    def load_atimes(self):
+        ''' reads the access times of all records into self.atimes,
+            converting the text format of earlier versions
+        '''
+        if os.path.exists(self.atime_filename):
+            atimes = numpy.fromfile(self.atime_filename, dtype = '<f8')
         else:
-            fields.append(b'?')
-        fields.append(utilities.bstring(time.ctime(atime)))
-        # force final tab
-        fields.append(b'')
-        while True:
-            record = b'\t'.join(fields)
-            if len(record) <= self.atime_size:
-                break
-            # cannot fit r_index into record
-            if len(fields) < 2:
-                break
-            del fields[-2]
-        if len(record) > self.atime_size:
-            # required field doesn't fit --> reduce precision
-            record = b'%.0f\t' %atime
-        return self.with_padding(record, self.atime_size)
+            print('Converting elmo cache access times to binary format...')
+            f = open(self.legacy_atime_filename, 'rb')
+            data = f.read()
+            f.close()
+            atime_size = self.atime_size
+            atimes = []
+            for r_index in range(int(len(data) / atime_size)):
+                record = data[r_index*atime_size:(r_index+1)*atime_size]
+                try:
+                    atimes.append(float(record.split()[0]))
+                except:
+                    raise ValueError('atime for record %d is %r' %(r_index, record))
+            atimes = numpy.array(atimes, dtype = '<f8')
+        if atimes.shape[0] != self.n_records:
+            # e.g. interrupted allocation: records without
+            # access time are treated as not recently used
+            atimes = numpy.concatenate((
+                atimes[:self.n_records],
+                numpy.zeros((max(0, self.n_records - atimes.shape[0]),), dtype = '<f8')
+            ))
+        self.atimes = atimes
+        if not os.path.exists(self.atime_filename) and not self.read_only:
+            self.atimes.tofile(self.atime_filename)
+            os.unlink(self.legacy_atime_filename)
 
     def with_padding(self, record, target_size):
         ''' note that the last character may be replaced with a newline
@@ -872,7 +1470,17 @@ class ElmoCache:
         key = self.get_cache_key(tokens, hdf5_key, lcode)
         if not key in self.key2entry:
             self.key2entry[key] = ElmoCache.Entry(tokens, lcode, hdf5_key)
-        self.key2entry[key].requesters.append(npz_name)
+        if self.trace_file is not None:
+            self.trace_file.write(b'%.3f\t%s\t%d\n' %(
+                time.time(), key, self.key2entry[key].length
+            ))
+        requesters = self.key2entry[key].requesters
+        if npz_name not in requesters:
+            try:
+                self.npz2keys[npz_name].append(key)
+            except KeyError:
+                self.npz2keys[npz_name] = [key]
+        requesters[npz_name] += 1
 
     def submit(self, npz_name):
         if npz_name in self.npz2ready_count:
@@ -886,23 +1494,24 @@ class ElmoCache:
         cache_hit_in_progress = 0
         cache_miss = 0
         cache_hit  = 0
-        for key, entry in utilities.iteritems(self.key2entry):
-            #number_of_entries += 1
-            #if entry.vectors is not None:
-            #    number_of_vectors += entry.length
-            #    if entry.vectors_on_disk:
-            #        number_on_disk += entry.length
-            if npz_name in entry.requesters:
-                n_requests = entry.requesters.count(npz_name)
-                if entry.hdf5_in_progress:
-                    cache_hit_in_progress += n_requests
-                elif entry.vectors is None:
-                    need_hdf5.append(entry)
-                    cache_miss += n_requests
-                    entry.hdf5_in_progress = True
-                else:
-                    self.npz2ready_count[npz_name] += n_requests
-                    cache_hit += n_requests
+        if npz_name in self.npz2keys:
+            keys = self.npz2keys[npz_name]
+        else:
+            # request without sentences
+            keys = []
+            self.npz2keys[npz_name] = keys
+        for key in keys:
+            entry = self.key2entry[key]
+            n_requests = entry.requesters[npz_name]
+            if entry.hdf5_in_progress:
+                cache_hit_in_progress += n_requests
+            elif not entry.ready:
+                need_hdf5.append(entry)
+                cache_miss += n_requests
+                entry.hdf5_in_progress = True
+            else:
+                self.npz2ready_count[npz_name] += n_requests
+                cache_hit += n_requests
         self.cache_hit_in_progress += cache_hit_in_progress
         self.cache_miss += cache_miss
         self.cache_hit  += cache_hit
@@ -927,20 +1536,70 @@ class ElmoCache:
         print('\t# hdf5 workdirs:', len(self.hdf5_workdir_usage))
         self.print_cache_stats()
 
+    def get_hdf5_token_budget(self):
+        ''' number of tokens per elmo-hdf5 task expected to take
+            hdf5_target_duration seconds according to a linear fit
+            of recent task durations
+        '''
+        budget = self.hdf5_token_budget
+        stats = self.hdf5_stats[-self.hdf5_stats_window:]
+        if len(stats) < 5:
+            return budget
+        n_tokens = numpy.array([row[0] for row in stats], dtype = numpy.float64)
+        durations = numpy.array([row[1] for row in stats], dtype = numpy.float64)
+        if n_tokens.min() == n_tokens.max():
+            seconds_per_token = durations.mean() / n_tokens.mean()
+            overhead = 0.0
+        else:
+            seconds_per_token, overhead = numpy.polyfit(n_tokens, durations, 1)
+        if seconds_per_token <= 0.0:
+            return budget
+        tuned = (self.hdf5_target_duration - max(0.0, overhead)) / seconds_per_token
+        # do not move too far from the configured budget
+        tuned = min(10.0 * budget, max(0.1 * budget, tuned))
+        return int(tuned)
+
+    def split_hdf5_entries(self, entries):
+        ''' returns lists of entries for elmo-hdf5 tasks with up to
+            the current token budget each; sentences are sorted by
+            length so that each task has sentences of similar length
+            and long sentences get their own tasks
+        '''
+        budget = self.get_hdf5_token_budget()
+        long_entries = []
+        short_entries = []
+        for entry in entries:
+            if entry.length >= self.hdf5_long_sentence:
+                long_entries.append(entry)
+            else:
+                short_entries.append(entry)
+        retval = []
+        for group in (long_entries, short_entries):
+            group.sort(key = lambda x: -x.length)
+            part = []
+            n_tokens = 0
+            for entry in group:
+                if part and (n_tokens + entry.length > budget \
+                or len(part) >= self.hdf5_max_sentences):
+                    retval.append(part)
+                    part = []
+                    n_tokens = 0
+                part.append(entry)
+                n_tokens += entry.length
+            if part:
+                retval.append(part)
+        return retval, budget
+
     def p_submit(self, entries, workdir, npz_name):
         if not entries:
             return 0
-        max_per_elmo_task = 2000
-        if 'EUD_DEBUG' in os.environ \
-        and os.environ['EUD_DEBUG'].lower() not in ('0', 'false'):
-            max_per_elmo_task = 400
-        if len(entries) > max_per_elmo_task:
-            middle = int(len(entries)/2)
-            part_1 = entries[:middle]
-            part_2 = entries[middle:]
-            n1 = self.p_submit(part_1, workdir, npz_name)
-            n2 = self.p_submit(part_2, workdir, npz_name)
-            return n1 + n2
+        parts, budget = self.split_hdf5_entries(entries)
+        print('\t# elmo-hdf5 tasks: %d with up to %d tokens each' %(len(parts), budget))
+        for part in parts:
+            self.p_submit_task(part, workdir, npz_name)
+        return len(parts)
+
+    def p_submit_task(self, entries, workdir, npz_name):
         # write sentences to file
         conllu_file = b'%s/part-%03d.conllu' %(workdir, self.next_part)
         hdf5_basename = b'part-%03d.hdf5'   %self.next_part
@@ -987,14 +1646,21 @@ class ElmoCache:
         command.append(workdir)
         command.append(hdf5_basename)
         task = common_udpipe_future.Task(command, 'elmo-hdf5')
+        start = time.time()
         task.submit()
+        if 'EUD_TASK_DIR' not in os.environ:
+            # task ran in this process
+            task.local_duration = time.time() - start
         task.entries = entries
+        task.lcode = lcode
+        task.n_tokens = sum([entry.length for entry in entries])
         task.conllu_file = conllu_file
         task.hdf5_name   = b'%s/%s' %(workdir, hdf5_basename)
         task.npz_name    = npz_name
         task.workdir     = workdir
         print('Submitted elmo-hdf5 task to produce', utilities.std_string(task.hdf5_name))
         self.hdf5_tasks.append(task)
+        self.get_watcher().add(task.hdf5_name)
         return 1
 
     def collect(self, tokens, hdf5_key, lcode, npz_name):
@@ -1002,12 +1668,19 @@ class ElmoCache:
         if key not in self.key2entry:
             raise ValueError('trying to collect vectors for hdf5_key that was not previously requested or has been collected previously and the cache entry has been released')
         entry = self.key2entry[key]
-        if entry.vectors is None:
+        if not entry.ready:
             raise ValueError('trying to collect vectors for hdf5_key that is not ready')
-        entry.requesters.remove(npz_name)  # removes one occurrence only
+        requesters = entry.requesters
+        if npz_name not in requesters:
+            raise ValueError('trying to collect vectors for %s more often than requested' %utilities.std_string(npz_name))
+        # remove one request only
+        requesters[npz_name] -= 1
+        if not requesters[npz_name]:
+            del requesters[npz_name]
         entry.last_access = time.time()
         entry.access_time_synced = False
-        return entry.vectors
+        self.eviction_policy.on_access(entry, self.get_n_parts(entry))
+        return self.get_vectors(entry)
 
     def get_n_ready(self, npz_name):
         self.scan_for_ready_vectors()
@@ -1015,30 +1688,45 @@ class ElmoCache:
         return self.npz2ready_count[npz_name]
 
     def scan_for_ready_vectors(self):
+        if not self.hdf5_tasks:
+            return
+        # hdf5 files reported by the watcher are checked immediately,
+        # all hdf5 files every scan_interval in case a notification
+        # was missed, e.g. on a network file system
+        changed = self.get_watcher().poll()
         now = time.time()
-        if now < self.last_scan + self.scan_interval:
+        check_all = now >= self.last_scan + self.scan_interval
+        if not changed and not check_all:
             return
-        self.last_scan = now
+        if check_all:
+            self.last_scan = now
         still_not_ready = []
         for task in self.hdf5_tasks:
+            if not check_all and task.hdf5_name not in changed:
+                still_not_ready.append(task)
+                continue
             if os.path.exists(task.hdf5_name):
+                self.watcher.remove(task.hdf5_name)
                 os.unlink(task.conllu_file)
                 hdf5_data = h5py.File(task.hdf5_name, 'r')
                 print('Reading hdf5 file', utilities.std_string(task.hdf5_name))
                 for entry in task.entries:
                     entry.vectors = hdf5_data[entry.hdf5_key][()]
+                    entry.ready = True
+                    self.eviction_policy.on_insert(entry, self.get_n_parts(entry))
                     entry.hdf5_in_progress = False
                     entry.hdf5_key = None           # release memory as no longer needed
                     # all requesters, not just task.npz_name, need
                     # to be notified that the vectors are ready
-                    for npz_name in entry.requesters:
-                        self.npz2ready_count[npz_name] += 1
+                    for npz_name, n_requests in utilities.iteritems(entry.requesters):
+                        self.npz2ready_count[npz_name] += n_requests
                     # must keep list of requesters to prevent entry from being
                     # flushed out before requester has a chance to collect the
                     # vector; new requesters may join but will trigger any new
                     # hdf5 tasks because entry.vectors is set
                 hdf5_data.close()
                 os.unlink(task.hdf5_name)
+                self.record_hdf5_stats(task)
                 self.hdf5_workdir_usage[task.workdir] -= 1
             else:
                 still_not_ready.append(task)
@@ -1051,10 +1739,419 @@ class ElmoCache:
                 del self.hdf5_workdir_usage[task.workdir]
         self.hdf5_tasks = still_not_ready
 
+    def get_hdf5_task_duration(self, task):
+        ''' returns the run time of a finished elmo-hdf5 task in
+            seconds or None if not known
+        '''
+        try:
+            return task.local_duration
+        except AttributeError:
+            pass
+        # elmo.start and elmo.end are touched by get-elmo-vectors.sh
+        # but are shared by all tasks of the workdir, i.e. they are
+        # only used if the task master's completion marker is missing
+        try:
+            marker = b'%s/completed/%d/%s.task' %(
+                task.queue_dir, task.my_task_bucket, task.task_id,
+            )
+            f = open(marker, 'rb')
+            while True:
+                line = f.readline().rstrip()
+                if not line:
+                    break
+                fields = line.split(b'\t')
+                if fields[0] == b'duration':
+                    f.close()
+                    return float(fields[1])
+            f.close()
+        except (AttributeError, IOError, OSError, ValueError, IndexError):
+            pass
+        try:
+            start = os.path.getmtime(b'/'.join((task.workdir, b'elmo.start')))
+            end   = os.path.getmtime(b'/'.join((task.workdir, b'elmo.end')))
+        except OSError:
+            return None
+        if end < start or start < task.submit_time:
+            return None
+        return end - start
+
+    def load_hdf5_stats(self):
+        self.hdf5_stats = []
+        if not os.path.exists(self.hdf5_stats_filename):
+            return
+        f = open(self.hdf5_stats_filename, 'rb')
+        header = f.readline()
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            fields = line.split()
+            try:
+                self.hdf5_stats.append((int(fields[3]), float(fields[5])))
+            except (IndexError, ValueError):
+                # e.g. incomplete line
+                continue
+        f.close()
+        del self.hdf5_stats[:-self.hdf5_stats_window]
+
+    def record_hdf5_stats(self, task):
+        duration = self.get_hdf5_task_duration(task)
+        if duration is None:
+            return
+        self.hdf5_stats.append((task.n_tokens, duration))
+        del self.hdf5_stats[:-self.hdf5_stats_window]
+        if self.read_only:
+            return
+        write_header = not os.path.exists(self.hdf5_stats_filename)
+        f = open(self.hdf5_stats_filename, 'ab')
+        if write_header:
+            f.write(b'time\tlcode\tsentences\ttokens\tmax_length\tduration\n')
+        f.write(b'%.1f\t%s\t%d\t%d\t%d\t%.1f\n' %(
+            time.time(),
+            utilities.bstring(task.lcode),
+            len(task.entries),
+            task.n_tokens,
+            max([entry.length for entry in task.entries]),
+            duration,
+        ))
+        f.close()
+
+class ElmoMmapCache(ElmoCache):
+
+    ''' Elmo cache with binary records in a memory-mapped data file.
+
+        Each record starts with a fixed 128 byte header followed by
+        the raw vectors of one part of a sentence. Loading the cache
+        only reads the headers and vectors are read from the mapped
+        file when they are needed, without copying if the entry
+        fits into a single record and is stored as float32.
+
+        Selected with EFML_NPZ_CACHE_FORMAT=binary. The data type of
+        stored vectors can be set with EFML_NPZ_CACHE_DTYPE (float32
+        or float16) when the cache is created.
+    '''
+
+    data_basename  = 'data.bin'
+    atime_basename = 'access.bin'
+    legacy_atime_basename = None
+
+    magic = b'EMC1'
+    # magic, state, dtype code, number of dimensions, pad byte,
+    # part index, number of parts, number of tokens in sentence,
+    # number of rows in this record, 2nd and 3rd dimension,
+    # key, lcode, crc32 of payload, crc32 of header
+    header_format = '<4scBBxIIIIII80s8sII'
+    header_size = 128
+    state_offset = 4
+    code2dtype = {1: '<f2', 2: '<f4'}
+    dtype2code = {'float16': 1, 'float32': 2}
+    # for the default number of vectors per record
+    expected_vector_size = 1024
+
+    def __init__(self, cache_dir = None, read_only = False):
+        assert struct.calcsize(self.header_format) == self.header_size
+        self.data_map  = None
+        self.atime_map = None
+        if 'EFML_NPZ_CACHE_DTYPE' in os.environ:
+            self.dtype_name = os.environ['EFML_NPZ_CACHE_DTYPE']
+        else:
+            self.dtype_name = 'float32'
+        if self.dtype_name not in self.dtype2code:
+            raise ValueError('Unsupported elmo cache dtype %s' %self.dtype_name)
+        ElmoCache.__init__(self, cache_dir, read_only)
+
+    def get_default_vectors_per_record(self, record_size):
+        itemsize = numpy.dtype(self.code2dtype[self.dtype2code[self.dtype_name]]).itemsize
+        return max(1, int(
+            (record_size - self.header_size)
+            / (self.expected_vector_size * itemsize)
+        ))
+
+    def map_disk_files(self):
+        self.unmap_disk_files()
+        if self.n_records <= 0:
+            return
+        if self.read_only:
+            mode, access = 'rb', mmap.ACCESS_READ
+        else:
+            mode, access = 'r+b', mmap.ACCESS_WRITE
+        for filename, attr in (
+            (self.data_filename,  'data_map'),
+            (self.atime_filename, 'atime_map'),
+        ):
+            f = open(filename, mode)
+            setattr(self, attr, mmap.mmap(f.fileno(), 0, access = access))
+            f.close()
+        self.atimes = numpy.frombuffer(
+            self.atime_map, dtype = '<f8', count = self.n_records,
+        )
+
+    def unmap_disk_files(self):
+        ''' returns whether the mappings were closed, i.e. False if
+            vectors returned by get_vectors() are still in use
+        '''
+        self.atimes = None
+        # views of the mappings held by the cache itself
+        for entry in self.key2entry.values():
+            if entry.vectors is not None and is_mmap_view(entry.vectors):
+                entry.vectors = numpy.array(entry.vectors)
+        self.vector_lru.discard_mmap_views()
+        closed = True
+        for attr in ('data_map', 'atime_map'):
+            m = getattr(self, attr)
+            if m is not None:
+                m.flush()
+                try:
+                    m.close()
+                except BufferError:
+                    # the mapping is released together
+                    # with the last view
+                    closed = False
+                setattr(self, attr, None)
+        return closed
+
+    def open_disk_files(self):
+        return self.data_map, self.atimes
+
+    def close_disk_files(self, data_file, atime_file):
+        self.data_map.flush()
+        self.atime_map.flush()
+
+    def write_records(self, data_map, vector_writes):
+        for r_index, key, part_index, n_parts, vectors, lcode, n_tokens in vector_writes:
+            self.write_vectors(
+                data_map, r_index, key, part_index, n_parts,
+                vectors, lcode, n_tokens,
+            )
+
+    def write_atimes(self, atimes, atime_writes):
+        for r_index, last_access in atime_writes:
+            atimes[r_index] = last_access
+
+    def pack_header(self, state, dtype_code, shape, key, part_index, n_parts, n_tokens, lcode, payload_crc):
+        if len(key) > 80 or len(lcode) > 8:
+            raise ValueError('Key %r or lcode %r too long for elmo cache header' %(key, lcode))
+        if len(shape) > 3:
+            raise ValueError('Cannot store vectors with shape %r in elmo cache' %(shape,))
+        dims = list(shape[1:]) + (2 - len(shape[1:])) * [0]
+        header = struct.pack(
+            self.header_format[:-1],
+            self.magic, state, dtype_code, len(shape),
+            part_index, n_parts, n_tokens, shape[0], dims[0], dims[1],
+            key, lcode, payload_crc,
+        )
+        return header + struct.pack('<I', zlib.crc32(header) & 0xffffffff)
+
+    def unpack_header(self, r_index):
+        ''' returns the header fields of a data record or None
+            if the record does not hold a valid header
+        '''
+        offset = r_index * self.record_size
+        header = self.data_map[offset:offset+self.header_size]
+        fields = struct.unpack(self.header_format, header)
+        if fields[0] != self.magic \
+        or fields[-1] != zlib.crc32(header[:-4]) & 0xffffffff:
+            return None
+        return fields
+
+    def write_vectors(self, data_map, r_index, key, part_index, n_parts, partial_vectors, lcode, n_tokens):
+        dtype_code = self.dtype2code[self.dtype_name]
+        payload = numpy.ascontiguousarray(
+            partial_vectors, dtype = self.code2dtype[dtype_code]
+        ).tobytes()
+        if self.header_size + len(payload) > self.record_size:
+            raise ValueError('Record size %d is too small for %d bytes of vectors' %(
+                self.record_size, len(payload)
+            ))
+        header = self.pack_header(
+            b'd', dtype_code, partial_vectors.shape,
+            key, part_index, n_parts, n_tokens, lcode,
+            zlib.crc32(payload) & 0xffffffff,
+        )
+        offset = r_index * self.record_size
+        # invalidate the record while it is written so that a partially
+        # written record is not loaded after a crash
+        data_map[offset+self.state_offset] = ord('p')
+        start = offset + self.header_size
+        data_map[start:start+len(payload)] = payload
+        data_map[offset:offset+self.header_size] = header
+
+    def read_part(self, r_index):
+        ''' returns the vectors stored in a data record as a
+            read-only array backed by the memory-mapped file
+        '''
+        fields = self.unpack_header(r_index)
+        if fields is None or fields[1] != b'd':
+            raise ValueError('No vectors in elmo cache record %d' %r_index)
+        _, _, dtype_code, ndim, _, _, _, n_rows, dim1, dim2, _, _, payload_crc, _ = fields
+        shape = (n_rows, dim1, dim2)[:ndim]
+        dtype = numpy.dtype(self.code2dtype[dtype_code])
+        offset = r_index * self.record_size + self.header_size
+        n_bytes = dtype.itemsize * int(numpy.prod(shape))
+        if self.verify_payload:
+            payload = memoryview(self.data_map)[offset:offset+n_bytes]
+            crc = zlib.crc32(payload) & 0xffffffff
+            payload.release()
+            if crc != payload_crc:
+                raise ValueError('Wrong payload checksum in elmo cache record %d' %r_index)
+        # unlike numpy.ndarray(buffer = ...), frombuffer() holds
+        # the buffer so that the mapping cannot be closed while
+        # the vectors are in use, see unmap_disk_files()
+        vectors = numpy.frombuffer(
+            self.data_map, dtype = dtype,
+            count = int(numpy.prod(shape)), offset = offset,
+        ).reshape(shape)
+        vectors.flags.writeable = False
+        return vectors
+
+    def read_vectors(self, records):
+        vectors = ElmoCache.read_vectors(self, records)
+        if vectors.dtype != numpy.float32:
+            vectors = vectors.astype(numpy.float32)
+        return vectors
+
+    def load_from_disk(self):
+        print('Loading elmo cache headers from disk...')
+        sys.stdout.flush()
+        start_time = time.time()
+        config = {}
+        for line in open(self.config_filename, 'rb'):
+            fields = line.split()
+            if len(fields) == 2:
+                config[utilities.std_string(fields[0])] = utilities.std_string(fields[1])
+        if config.get('format') != 'binary':
+            raise ValueError('Elmo cache in %s is not in binary format' %self.config_filename)
+        self.record_size = int(config['record_size'])
+        self.vectors_per_record = int(config['vectors_per_record'])
+        self.dtype_name = config['dtype']
+        self.n_records = int(os.path.getsize(self.data_filename) / self.record_size)
+        self.map_disk_files()
+        # read all record states in one go: records that have never
+        # been written are all-zero and count as initialised records;
+        # records that were being written when the worker stopped
+        # are free
+        states = numpy.ndarray(
+            shape = (self.n_records,), dtype = numpy.uint8,
+            buffer = self.data_map, offset = self.state_offset,
+            strides = (self.record_size,),
+        )
+        data_indices = numpy.nonzero(states == ord('d'))[0]
+        states = numpy.where(states == 0, ord('i'), ord('f')).astype(numpy.uint8)
+        self.record_states = array.array('B', states.tobytes())
+        del states
+        self.idx2key_and_part = self.n_records * [None]
+        n_discarded_records = 0
+        for r_index in data_indices:
+            r_index = int(r_index)
+            fields = self.unpack_header(r_index)
+            if fields is not None and self.verify_on_load:
+                try:
+                    self.read_part(r_index)
+                except ValueError:
+                    fields = None
+            if fields is None:
+                n_discarded_records += 1
+                self.record_states[r_index] = ord('f')
+                continue
+            _, _, _, _, part_index, n_parts, n_tokens, _, _, _, key, lcode, _, _ = fields
+            key   = key.rstrip(b'\0')
+            lcode = lcode.rstrip(b'\0')
+            if not key in self.key2entry:
+                entry = ElmoCache.Entry(None, lcode, None)
+                entry.length = n_tokens
+                entry.have_parts = {}
+                entry.n_parts = n_parts
+                self.key2entry[key] = entry
+            else:
+                entry = self.key2entry[key]
+            if entry.have_parts is None \
+            or part_index in entry.have_parts \
+            or entry.n_parts != n_parts \
+            or entry.length != n_tokens \
+            or part_index >= n_parts:
+                # duplicate or inconsistent record
+                n_discarded_records += 1
+                self.record_states[r_index] = ord('f')
+                continue
+            self.record_states[r_index] = ord('d')
+            self.idx2key_and_part[r_index] = (key, part_index)
+            entry.have_parts[part_index] = r_index
+            if len(entry.have_parts) == entry.n_parts:
+                # all parts are ready
+                entry.records = [
+                    entry.have_parts[part_index]
+                    for part_index in range(entry.n_parts)
+                ]
+                access_times = self.atimes[entry.records]
+                entry.last_access = float(access_times.max())
+                entry.access_time_synced = bool(access_times.min() == entry.last_access)
+                entry.vectors_on_disk = True
+                entry.ready = True
+                entry.have_parts = None
+        # remove all incomplete in-memory cache entries
+        incomplete = []
+        n_atime_not_synced = 0
+        n_normal = 0
+        for key, entry in utilities.iteritems(self.key2entry):
+            if entry.have_parts is not None:
+                incomplete.append(key)
+                for part_index in entry.have_parts:
+                    r_index = entry.have_parts[part_index]
+                    self.record_states[r_index] = ord('f')
+                    self.idx2key_and_part[r_index] = None
+            elif not entry.access_time_synced:
+                n_atime_not_synced += 1
+            else:
+                n_normal += 1
+        for key in incomplete:
+            del self.key2entry[key]
+        self.rebuild_location_index()
+        self.count_record_states()
+        print('\t# normal entries found:', n_normal)
+        print('\t# entries with inconsistent acess time:', n_atime_not_synced)
+        print('\t# incomplete entries discarded:', len(incomplete))
+        print('\t# damaged or duplicate records discarded:', n_discarded_records)
+        print('\t# duration: %.1f seconds' %(time.time() - start_time))
+        sys.stdout.flush()
+
+    def write_config(self):
+        ElmoCache.write_config(self)
+        config = open(self.config_filename, 'ab')
+        config.write(b'format binary\n')
+        config.write(b'dtype %s\n' %utilities.bstring(self.dtype_name))
+        config.close()
+
+    def resize_atimes(self, n_records):
+        # the mapped access times are resized with the file
+        pass
+
+def new_elmo_cache(cache_dir = None, read_only = False):
+    ''' returns an elmo cache in the format selected with
+        EFML_NPZ_CACHE_FORMAT (text or binary, default: text)
+    '''
+    if 'EFML_NPZ_CACHE_FORMAT' in os.environ:
+        cache_format = os.environ['EFML_NPZ_CACHE_FORMAT']
+    else:
+        cache_format = 'text'
+    if cache_format == 'text':
+        return ElmoCache(cache_dir, read_only)
+    elif cache_format == 'binary':
+        return ElmoMmapCache(cache_dir, read_only)
+    else:
+        raise ValueError('Unknown elmo cache format %s' %cache_format)
+
 class NPZTasks:
 
-    def __init__(self, output_dir, lcode, priority = 50):
+    def __init__(self, output_dir, lcode, priority = 50, file_format = 'npz'):
+        ''' file_format: 'npz' for numpy.savez() files or 'npy' for
+            files to be read with vector_handoff.VectorArray
+        '''
+        if file_format not in ('npz', 'npy'):
+            raise ValueError('Unknown vector file format %s' %file_format)
+        self.file_format = file_format
         self.tasks = []
+        # tasks are submitted together by submit() or wait()
+        self.batch = common_udpipe_future.TaskBatch()
         workdir = output_dir + '-npz-workdir'
         if not os.path.exists(workdir):
             common_udpipe_future.my_makedirs(workdir)
@@ -1064,17 +2161,20 @@ class NPZTasks:
         self.priority = priority
 
     def append(self, conllu_file):
-        npz_file = '%s/file-%d.npz' %(self.workdir, self.next_index)
+        npz_file = '%s/file-%d.%s' %(self.workdir, self.next_index, self.file_format)
         self.next_index += 1
         task = ElmoNpzTask(
             [conllu_file, npz_file, self.lcode],
             priority = self.priority
         )
-        task.submit()
+        self.batch.add(task)
         task.npz_file = npz_file
         self.tasks.append(task)
         return npz_file
 
+    def submit(self):
+        self.batch.submit()
+
     def get_npz_files(self):
         return [task.npz_file for task in self.tasks]
 
@@ -1083,20 +2183,35 @@ class NPZTasks:
         return self.tasks[-1].npz_file
 
     def wait(self):
+        self.submit()
         start = time.time()
-        while True:
-            found_all = True
-            for npz_file in self.get_npz_files():
-                if not os.path.exists(npz_file):
-                    found_all = False
-                    break
-            if found_all:
-                return time.time() - start
-            time.sleep(0.2)
+        # npz files are moved into place with rename() by the elmo-npz
+        # worker, i.e. we only need to check files reported by the
+        # watcher, plus all files now and then in case a notification
+        # was missed
+        watcher = file_watcher.FileWatcher(scan_interval = 0.2)
+        missing = set(self.get_npz_files())
+        for npz_file in missing:
+            watcher.add(npz_file)
+        last_check_all = start
+        while missing:
+            watcher.wait(10.0)
+            to_check = watcher.poll()
+            if time.time() >= last_check_all + 10.0:
+                to_check = set(missing)
+                last_check_all = time.time()
+            for npz_file in to_check:
+                if npz_file in missing and os.path.exists(npz_file):
+                    missing.remove(npz_file)
+                    watcher.remove(npz_file)
+        watcher.close()
+        return time.time() - start
 
     def cleanup(self):
         for npz_file in self.get_npz_files():
-            if os.path.exists(npz_file):
+            if self.file_format == 'npy':
+                vector_handoff.remove(npz_file)
+            elif os.path.exists(npz_file):
                 os.unlink(npz_file)
         for statsfile in ('elmo.start', 'elmo.end'):
             statspath = '/'.join((self.workdir, statsfile))
@@ -1147,6 +2262,7 @@ def train(
                 conllu_file = conllu_file.filename
             command.append(conllu_file)
             command.append(npz_tasks.append(conllu_file))
+    npz_tasks.submit()
     task = common_udpipe_future.run_command(
         command,
         requires = npz_tasks.get_npz_files(),
@@ -1242,7 +2358,7 @@ QUEUENAME:
     elmo-hdf5 for the .hdf5 workers (run as many as needed)"""
     if len(sys.argv) > 1 and sys.argv[-1] == 'elmo-npz':
         del sys.argv[-1]
-        cache = ElmoCache()
+        cache = new_elmo_cache()
         common_udpipe_future.main(
             queue_name = 'elmo-npz',
             task_processor = ElmoNpzTask,
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Bootstrap confidence intervals and significance tests from per-sentence
+# counts written by `iwpt20_xud_eval.py --per-sentence FILE.npy`.
+#
+# Resampling is done on the count arrays: each bootstrap sample is a
+# vector of sentence weights and the counts of all samples are obtained
+# with one matrix product, so that thousands of samples take seconds.
+
+from __future__ import print_function
+
+import sys
+
+import numpy
+
+from iwpt20_xud_eval import METRICS, CORRECT, GOLD_TOTAL, SYSTEM_TOTAL
+
+def print_usage():
+    print('Usage: %s [options] SYSTEM_A.npy [SYSTEM_B.npy]' %sys.argv[0])
+    print("""
+With one file, print bootstrap confidence intervals for the F1 score of
+each metric. With two files evaluated against the same gold file, also
+test whether the difference between the systems is significant with a
+paired bootstrap test and a paired approximate randomisation
+(permutation) test.
+
+Options:
+
+    --metric  NAME          Only report metric NAME; can be repeated.
+                            (Default: all metrics)
+
+    --resamples  N          Number of bootstrap samples and permutations
+                            (Default: 10000)
+
+    --confidence  LEVEL     Confidence level of intervals
+                            (Default: 0.95)
+
+    --seed  N               Seed for the random number generator
+                            (Default: 42)
+
+    --chunk-size  N         Number of samples processed at a time
+                            (Default: 1000)
+""")
+
+def f1_scores(totals):
+    ''' F1 from array [..., metric, (correct, gold, system)]
+        as in iwpt20_xud_eval.Score
+    '''
+    correct = totals[..., CORRECT].astype(numpy.float64)
+    denominator = totals[..., GOLD_TOTAL] + totals[..., SYSTEM_TOTAL]
+    return numpy.where(
+        denominator > 0,
+        2.0 * correct / numpy.maximum(denominator, 1),
+        0.0
+    )
+
+def bootstrap_totals(counts, weights):
+    ''' counts: (sentences, metrics, 3)
+        weights: (samples, sentences)
+        returns totals of shape (samples, metrics, 3)
+    '''
+    n_sentences = counts.shape[0]
+    flat = counts.reshape((n_sentences, -1)).astype(numpy.int64)
+    totals = numpy.dot(weights.astype(numpy.int64), flat)
+    return totals.reshape((weights.shape[0],) + counts.shape[1:])
+
+def bootstrap_weights(rng, n_samples, n_sentences):
+    ''' number of times each sentence is drawn in each sample '''
+    return rng.multinomial(
+        n_sentences,
+        numpy.ones(n_sentences) / n_sentences,
+        size = n_samples
+    )
+
+def run_bootstrap(rng, counts_a, counts_b, n_samples, chunk_size):
+    ''' returns F1 scores for all samples, shape (samples, metrics),
+        for system A and, if given, system B on the same samples
+    '''
+    n_sentences = counts_a.shape[0]
+    scores_a = []
+    scores_b = []
+    n_remaining = n_samples
+    while n_remaining > 0:
+        n = min(chunk_size, n_remaining)
+        n_remaining -= n
+        weights = bootstrap_weights(rng, n, n_sentences)
+        scores_a.append(f1_scores(bootstrap_totals(counts_a, weights)))
+        if counts_b is not None:
+            scores_b.append(f1_scores(bootstrap_totals(counts_b, weights)))
+    scores_a = numpy.concatenate(scores_a, axis = 0)
+    if counts_b is None:
+        return scores_a, None
+    return scores_a, numpy.concatenate(scores_b, axis = 0)
+
+def run_permutation(rng, counts_a, counts_b, n_samples, chunk_size):
+    ''' paired approximate randomisation test: swaps the outputs of
+        the two systems for a random subset of sentences and returns
+        the absolute differences in F1, shape (samples, metrics)
+    '''
+    n_sentences = counts_a.shape[0]
+    total_a = counts_a.sum(axis = 0).astype(numpy.int64)
+    total_b = counts_b.sum(axis = 0).astype(numpy.int64)
+    # gold totals do not change when swapping
+    delta = (counts_b.astype(numpy.int64) - counts_a).reshape((n_sentences, -1))
+    differences = []
+    n_remaining = n_samples
+    while n_remaining > 0:
+        n = min(chunk_size, n_remaining)
+        n_remaining -= n
+        swap = rng.randint(0, 2, size = (n, n_sentences))
+        shift = numpy.dot(swap, delta).reshape((n,) + counts_a.shape[1:])
+        scores_a = f1_scores(total_a + shift)
+        scores_b = f1_scores(total_b - shift)
+        differences.append(numpy.abs(scores_a - scores_b))
+    return numpy.concatenate(differences, axis = 0)
+
+def main():
+    opt_metrics = []
+    opt_resamples = 10000
+    opt_confidence = 0.95
+    opt_seed = 42
+    opt_chunk_size = 1000
+    while len(sys.argv) >= 2 and sys.argv[1][:1] == '-':
+        option = sys.argv[1]
+        option = option.replace('_', '-')
+        del sys.argv[1]
+        if option in ('--help', '-h'):
+            print_usage()
+            sys.exit(0)
+        elif option == '--metric':
+            opt_metrics.append(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--resamples':
+            opt_resamples = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--confidence':
+            opt_confidence = float(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--seed':
+            opt_seed = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--chunk-size':
+            opt_chunk_size = int(sys.argv[1])
+            del sys.argv[1]
+        else:
+            print('Unsupported option %s' %option)
+            print_usage()
+            sys.exit(1)
+    if len(sys.argv) not in (2, 3):
+        print_usage()
+        sys.exit(1)
+    if not opt_metrics:
+        opt_metrics = METRICS
+    for metric in opt_metrics:
+        if metric not in METRICS:
+            raise ValueError('Unknown metric %r' %metric)
+    metric_indices = [METRICS.index(metric) for metric in opt_metrics]
+    counts_a = numpy.load(sys.argv[1])
+    counts_b = None
+    if len(sys.argv) == 3:
+        counts_b = numpy.load(sys.argv[2])
+        if counts_a.shape != counts_b.shape:
+            raise ValueError('Per-sentence counts have different shapes %r and %r' %(counts_a.shape, counts_b.shape))
+        if (counts_a[:, :, GOLD_TOTAL] != counts_b[:, :, GOLD_TOTAL]).any():
+            raise ValueError('Systems were not evaluated against the same gold file')
+    rng = numpy.random.RandomState(opt_seed)
+    lower_q = 100.0 * (1.0 - opt_confidence) / 2.0
+    upper_q = 100.0 - lower_q
+    observed_a = f1_scores(counts_a.sum(axis = 0))
+    samples_a, samples_b = run_bootstrap(
+        rng, counts_a, counts_b, opt_resamples, opt_chunk_size
+    )
+    print('%d sentences, %d bootstrap samples, %.1f%% confidence intervals' %(
+        counts_a.shape[0], opt_resamples, 100.0 * opt_confidence
+    ))
+    if counts_b is None:
+        print('Metric     |  F1 Score |     Lower |     Upper')
+        print('-----------+-----------+-----------+-----------')
+        lower = numpy.percentile(samples_a, lower_q, axis = 0)
+        upper = numpy.percentile(samples_a, upper_q, axis = 0)
+        for m_index in metric_indices:
+            print('%-11s|%10.2f |%10.2f |%10.2f' %(
+                METRICS[m_index],
+                100.0 * observed_a[m_index],
+                100.0 * lower[m_index],
+                100.0 * upper[m_index],
+            ))
+        return
+    observed_b = f1_scores(counts_b.sum(axis = 0))
+    observed_diff = observed_a - observed_b
+    sample_diff = samples_a - samples_b
+    lower = numpy.percentile(sample_diff, lower_q, axis = 0)
+    upper = numpy.percentile(sample_diff, upper_q, axis = 0)
+    # paired bootstrap test (Berg-Kirkpatrick et al. 2012): how often
+    # is the difference in a sample more than twice the observed
+    # difference, i.e. how likely is the observed advantage of the
+    # better system due to the sample of sentences
+    sign = numpy.where(observed_diff >= 0, 1.0, -1.0)
+    p_bootstrap = (
+        (sign * sample_diff > 2.0 * sign * observed_diff).sum(axis = 0) + 1.0
+    ) / (opt_resamples + 1.0)
+    permuted_diff = run_permutation(
+        rng, counts_a, counts_b, opt_resamples, opt_chunk_size
+    )
+    p_permutation = (
+        (permuted_diff >= numpy.abs(observed_diff) - 1e-12).sum(axis = 0) + 1.0
+    ) / (opt_resamples + 1.0)
+    print('Metric     |  System A |  System B |      Diff |     Lower |     Upper | p (boot.) | p (perm.)')
+    print('-----------+-----------+-----------+-----------+-----------+-----------+-----------+-----------')
+    for m_index in metric_indices:
+        print('%-11s|%10.2f |%10.2f |%10.2f |%10.2f |%10.2f |%10.4f |%10.4f' %(
+            METRICS[m_index],
+            100.0 * observed_a[m_index],
+            100.0 * observed_b[m_index],
+            100.0 * observed_diff[m_index],
+            100.0 * lower[m_index],
+            100.0 * upper[m_index],
+            p_bootstrap[m_index],
+            p_permutation[m_index],
+        ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Store for evaluation results keyed by the content of the system and gold
+# files and the enhancements level, so that evaluation results can be
+# re-used regardless of file names and are not re-used when a prediction
+# file is replaced with new content under the same name.
+#
+# Entries are written via rename() to be safe with concurrent workers
+# sharing the store. The modification time of an entry is updated on
+# each use and the least recently used entries are removed when the
+# store grows beyond its size limit. Temporary files of evaluations
+# that did not finish, e.g. because the process was killed, are removed
+# after EUD_EVAL_STORE_PREP_TIMEOUT seconds (default: 1 day).
+
+from __future__ import print_function
+
+import hashlib
+import os
+import time
+
+import utilities
+
+class EvalStore:
+
+    def __init__(self, store_dir, max_size = None):
+        self.store_dir = store_dir
+        if max_size is None:
+            if 'EUD_EVAL_STORE_SIZE' in os.environ:
+                max_size = utilities.float_with_suffix(
+                    os.environ['EUD_EVAL_STORE_SIZE']
+                )
+            else:
+                max_size = 256 * 1024**2
+        self.max_size = max_size
+        self.path2hash = {}
+        # running estimate of the size of the store to
+        # avoid scanning the store on each add()
+        self.size_estimate = None
+        self.last_scan = 0.0
+        self.scan_interval = 600.0
+        if 'EUD_EVAL_STORE_PREP_TIMEOUT' in os.environ:
+            self.prep_timeout = float(os.environ['EUD_EVAL_STORE_PREP_TIMEOUT'])
+        else:
+            self.prep_timeout = 24 * 3600.0
+
+    def get_file_hash(self, path):
+        ''' sha256 of the file content, re-using the hash of the
+            previous call if size and modification time did not
+            change
+        '''
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime)
+        if path in self.path2hash:
+            last_signature, h = self.path2hash[path]
+            if last_signature == signature:
+                return h
+        h = hashlib.sha256()
+        f = open(path, 'rb')
+        while True:
+            data = f.read(1024**2)
+            if not data:
+                break
+            h.update(data)
+        f.close()
+        h = h.hexdigest()
+        self.path2hash[path] = (signature, h)
+        return h
+
+    def get_key(self, system_path, gold_path, enhancements = '0'):
+        return '%s-%s-%s' %(
+            self.get_file_hash(system_path)[:32],
+            self.get_file_hash(gold_path)[:32],
+            enhancements,
+        )
+
+    def get_path(self, key):
+        return '%s/%s/%s.eval.txt' %(self.store_dir, key[:2], key)
+
+    def lookup(self, key):
+        ''' returns the path to the stored evaluation result or
+            None if there is no non-empty result for the key
+        '''
+        path = self.get_path(key)
+        try:
+            if not os.path.getsize(path):
+                return None
+            # mark as recently used
+            os.utime(path, None)
+        except OSError:
+            # not in store or evicted by another process
+            return None
+        return path
+
+    def get_temp_name(self, key):
+        ''' returns a filename for writing a new result that
+            will not clash with other processes writing the same
+            result
+        '''
+        dirname = '%s/%s' %(self.store_dir, key[:2])
+        utilities.makedirs(dirname)
+        return '%s/%s.%s-%d.prep' %(
+            dirname, key,
+            utilities.std_string(utilities.hex2base62(
+                hashlib.sha256(b'%.9f' %time.time()).hexdigest(), 6
+            )[:6]),
+            os.getpid(),
+        )
+
+    def add(self, key, temp_name):
+        ''' moves a result written to the path returned by
+            get_temp_name() into the store and returns its new path
+        '''
+        path = self.get_path(key)
+        if not os.path.exists(temp_name):
+            raise ValueError('Missing evaluation result for %s' %key)
+        size = os.path.getsize(temp_name)
+        if not size:
+            os.unlink(temp_name)
+            raise ValueError('Refusing to store empty evaluation result for %s' %key)
+        os.rename(temp_name, path)
+        if self.size_estimate is not None:
+            self.size_estimate += size
+        if self.size_estimate is None \
+        or self.max_size and self.size_estimate > self.max_size \
+        or time.time() > self.last_scan + self.scan_interval:
+            # other processes also add to the store
+            # --> re-scan from time to time
+            self.evict()
+        return path
+
+    def evict(self):
+        ''' removes the least recently used results until the
+            store is within its size limit and removes stale
+            temporary files
+        '''
+        now = time.time()
+        self.last_scan = now
+        entries = []
+        total_size = 0
+        for subdir in os.listdir(self.store_dir):
+            dirname = '/'.join((self.store_dir, subdir))
+            if not os.path.isdir(dirname):
+                continue
+            for filename in os.listdir(dirname):
+                path = '/'.join((dirname, filename))
+                if filename.endswith('.prep'):
+                    try:
+                        if now > os.path.getmtime(path) + self.prep_timeout:
+                            os.unlink(path)
+                    except OSError:
+                        # finished or removed by another process
+                        pass
+                    continue
+                if not filename.endswith('.eval.txt'):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+        if self.max_size and total_size > self.max_size:
+            entries.sort()
+            for _, size, path in entries:
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    # removed by another process
+                    pass
+                total_size -= size
+        self.size_estimate = total_size
+
+def get_store(options):
+    ''' returns the evaluation store configured for the
+        given options, creating it on first use
+    '''
+    try:
+        return options.eval_store
+    except AttributeError:
+        pass
+    if 'EUD_EVAL_STORE_DIR' in os.environ:
+        store_dir = os.environ['EUD_EVAL_STORE_DIR']
+    else:
+        store_dir = '%s/eval-store' %options.predictdir
+    utilities.makedirs(store_dir)
+    options.eval_store = EvalStore(store_dir)
+    return options.eval_store
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Eviction policies for the disk records of the elmo cache, selected
+# with EFML_NPZ_CACHE_POLICY:
+#
+#   lru  keep the most recently used entries (default)
+#   lfu  keep the most frequently used entries, breaking ties by recency
+#   gds  GreedyDual-Size (Cao and Irani 1997): keep entries that are
+#        expensive to recompute relative to the number of records they
+#        occupy, ageing entries that are not used
+#
+# Policies only look at the attributes length, last_access, n_accesses
+# and priority of entries, so that they can also be used by the trace
+# simulator in simulate_elmo_cache.py.
+
+from __future__ import print_function
+
+import os
+
+def get_n_parts(n_tokens, vectors_per_record):
+    return int((n_tokens+vectors_per_record-1)/vectors_per_record)
+
+def estimate_cost(n_tokens):
+    ''' relative cost of recomputing the vectors of a sentence
+        with elmo, in tokens: task run time grows about linearly
+        with the number of tokens plus some overhead per sentence
+    '''
+    return 10.0 + n_tokens
+
+class LRUPolicy:
+
+    name = 'lru'
+
+    def on_insert(self, entry, n_parts):
+        pass
+
+    def on_access(self, entry, n_parts):
+        entry.n_accesses += 1
+
+    def on_evict(self, entries):
+        pass
+
+    def get_sort_key(self, entry, n_parts, now):
+        ''' entries with smaller keys are kept first '''
+        return now - entry.last_access
+
+class LFUPolicy(LRUPolicy):
+
+    name = 'lfu'
+
+    def get_sort_key(self, entry, n_parts, now):
+        return (-entry.n_accesses, now - entry.last_access)
+
+class GreedyDualSizePolicy(LRUPolicy):
+
+    name = 'gds'
+
+    def __init__(self):
+        self.inflation = 0.0
+
+    def p_update(self, entry, n_parts):
+        entry.priority = self.inflation + estimate_cost(entry.length) / max(1, n_parts)
+
+    def on_insert(self, entry, n_parts):
+        self.p_update(entry, n_parts)
+
+    def on_access(self, entry, n_parts):
+        entry.n_accesses += 1
+        self.p_update(entry, n_parts)
+
+    def on_evict(self, entries):
+        # entries inserted or used from now on rank above
+        # entries that have not been used since
+        for entry in entries:
+            self.inflation = max(self.inflation, entry.priority)
+
+    def get_sort_key(self, entry, n_parts, now):
+        return (-entry.priority, now - entry.last_access)
+
+name2policy = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    'gds': GreedyDualSizePolicy,
+}
+
+def new_policy(name = None):
+    if name is None:
+        if 'EFML_NPZ_CACHE_POLICY' in os.environ:
+            name = os.environ['EFML_NPZ_CACHE_POLICY']
+        else:
+            name = 'lru'
+    try:
+        return name2policy[name.lower()]()
+    except KeyError:
+        raise ValueError('Unknown elmo cache eviction policy %s' %name)
+
+def select_entries(policy, candidates, max_records, now):
+    ''' candidates: list of (key, entry, n_parts, pinned) where pinned
+        entries, e.g. with open requests, are kept first
+        returns (kept, evicted), each a list of (sort_key, key, n_parts)
+        with kept entries requiring less than max_records records
+    '''
+    ranked = []
+    for key, entry, n_parts, pinned in candidates:
+        if pinned:
+            rank = 0
+        else:
+            rank = 1
+        ranked.append(((rank, policy.get_sort_key(entry, n_parts, now)), key, n_parts))
+    ranked.sort()
+    n_keys = 0
+    n_records_so_far = 0
+    while n_keys < len(ranked) \
+    and n_records_so_far + ranked[n_keys][2] < max_records:
+        n_records_so_far += ranked[n_keys][2]
+        n_keys += 1
+    return ranked[:n_keys], ranked[n_keys:]
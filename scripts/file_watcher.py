@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Notification when files appear or disappear, e.g. output files and
+# task markers that are moved into place with rename().
+#
+# On Linux, the directories of the watched files are watched with
+# inotify (via ctypes, no extra package needed). Elsewhere, or when
+# EUD_FILE_WATCHER=scan, each directory with watched files is listed
+# once per scan interval, i.e. the cost does not grow with the number
+# of watched files in the same directory.
+#
+# Note that inotify does not see changes made by other hosts on network
+# file systems. Callers therefore should still re-check the files after
+# a timeout, and EUD_FILE_WATCHER=scan should be used if the files are
+# produced on other hosts and low latency is needed.
+
+from __future__ import print_function
+
+import os
+import select
+import struct
+import time
+
+import utilities
+
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+except (ImportError, OSError, AttributeError, TypeError):
+    libc = None
+
+# constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_NONBLOCK    = 0x00000800
+IN_CLOEXEC     = 0x00080000
+
+event_header_format = 'iIII'
+event_header_size = struct.calcsize(event_header_format)
+
+def have_inotify():
+    return libc is not None
+
+class FileWatcher:
+
+    ''' Collects watched paths that may have appeared or disappeared.
+        Spurious reports are possible, e.g. when a file is re-written,
+        and each newly added path is reported once, so that callers
+        can simply re-check all reported paths.
+    '''
+
+    def __init__(self, scan_interval = 1.0, method = None):
+        if method is None:
+            if 'EUD_FILE_WATCHER' in os.environ:
+                method = os.environ['EUD_FILE_WATCHER']
+            else:
+                method = 'auto'
+        if method not in ('auto', 'inotify', 'scan'):
+            raise ValueError('Unknown file watcher method %s' %method)
+        self.scan_interval = scan_interval
+        self.last_scan = 0.0
+        self.dir2names = {}     # dirname -> {basename -> set of watched paths}
+        self.dir2listing = {}   # dirname -> watched basenames present at last scan
+        self.dir2wd = {}
+        self.wd2dir = {}
+        self.changed = set()
+        self.inotify_fd = None
+        if method != 'scan' and libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.inotify_fd = fd
+        if method == 'inotify' and self.inotify_fd is None:
+            raise ValueError('inotify not available')
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+        self.dir2wd = {}
+        self.wd2dir = {}
+
+    def split_path(self, path):
+        dirname, basename = os.path.split(utilities.bstring(path))
+        if not dirname:
+            dirname = b'.'
+        return dirname, basename
+
+    def add(self, path):
+        dirname, basename = self.split_path(path)
+        if dirname not in self.dir2names:
+            self.dir2names[dirname] = {}
+            self.p_add_watch(dirname)
+        name2paths = self.dir2names[dirname]
+        if basename not in name2paths:
+            name2paths[basename] = set()
+        name2paths[basename].add(path)
+        # the file may have changed before the directory was watched
+        self.changed.add(path)
+
+    def remove(self, path):
+        dirname, basename = self.split_path(path)
+        self.changed.discard(path)
+        try:
+            name2paths = self.dir2names[dirname]
+            name2paths[basename].discard(path)
+        except KeyError:
+            return
+        if name2paths[basename]:
+            return
+        del name2paths[basename]
+        if dirname in self.dir2listing:
+            self.dir2listing[dirname].discard(basename)
+        if name2paths:
+            return
+        del self.dir2names[dirname]
+        if dirname in self.dir2listing:
+            del self.dir2listing[dirname]
+        if dirname in self.dir2wd:
+            wd = self.dir2wd[dirname]
+            del self.dir2wd[dirname]
+            del self.wd2dir[wd]
+            libc.inotify_rm_watch(self.inotify_fd, wd)
+
+    def p_add_watch(self, dirname):
+        if self.inotify_fd is None:
+            return
+        wd = libc.inotify_add_watch(
+            self.inotify_fd, dirname,
+            IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_ONLYDIR
+        )
+        if wd < 0:
+            # e.g. directory does not exist (yet) --> scan instead
+            return
+        self.dir2wd[dirname] = wd
+        self.wd2dir[wd] = dirname
+
+    def p_mark_all(self, dirname):
+        for paths in self.dir2names[dirname].values():
+            self.changed.update(paths)
+
+    def p_read_events(self, timeout):
+        ''' blocks up to timeout seconds for inotify events '''
+        if self.inotify_fd is None or not self.dir2wd:
+            if timeout > 0.0:
+                time.sleep(timeout)
+            return
+        readable, _, _ = select.select([self.inotify_fd], [], [], max(0.0, timeout))
+        if not readable:
+            return
+        try:
+            data = os.read(self.inotify_fd, 65536)
+        except OSError:
+            return
+        offset = 0
+        while offset + event_header_size <= len(data):
+            wd, mask, _, name_length = struct.unpack_from(
+                event_header_format, data, offset
+            )
+            offset += event_header_size
+            name = data[offset:offset+name_length].rstrip(b'\0')
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                for dirname in self.dir2names:
+                    self.p_mark_all(dirname)
+                continue
+            if wd not in self.wd2dir:
+                continue
+            dirname = self.wd2dir[wd]
+            if mask & IN_IGNORED:
+                # directory was removed --> scan instead
+                del self.wd2dir[wd]
+                del self.dir2wd[dirname]
+                self.p_mark_all(dirname)
+                continue
+            name2paths = self.dir2names[dirname]
+            if name in name2paths:
+                self.changed.update(name2paths[name])
+
+    def p_scan(self):
+        ''' lists each directory that is not watched with inotify '''
+        self.last_scan = time.time()
+        for dirname, name2paths in utilities.iteritems(self.dir2names):
+            if dirname in self.dir2wd:
+                continue
+            if self.inotify_fd is not None:
+                # try again, e.g. the directory may exist now
+                self.p_add_watch(dirname)
+                if dirname in self.dir2wd:
+                    self.p_mark_all(dirname)
+                    continue
+            try:
+                listing = set(os.listdir(dirname))
+            except OSError:
+                listing = set()
+            present = set()
+            for basename in name2paths:
+                if basename in listing:
+                    present.add(basename)
+            if dirname in self.dir2listing:
+                last_present = self.dir2listing[dirname]
+            else:
+                last_present = set()
+            for basename in present.symmetric_difference(last_present):
+                self.changed.update(name2paths[basename])
+            self.dir2listing[dirname] = present
+
+    def p_need_scan(self):
+        return len(self.dir2wd) < len(self.dir2names)
+
+    def poll(self):
+        ''' returns and forgets the watched paths that changed since
+            the last call, without blocking
+        '''
+        self.p_read_events(0.0)
+        if self.p_need_scan() \
+        and time.time() >= self.last_scan + self.scan_interval:
+            self.p_scan()
+        retval = self.changed
+        self.changed = set()
+        return retval
+
+    def wait(self, timeout):
+        ''' blocks until a watched path changed or for up to timeout
+            seconds; returns True if there are changes to collect
+            with poll()
+        '''
+        deadline = time.time() + timeout
+        while not self.changed:
+            now = time.time()
+            if now >= deadline:
+                break
+            wait_until = deadline
+            if self.p_need_scan():
+                next_scan = self.last_scan + self.scan_interval
+                if now >= next_scan:
+                    self.p_scan()
+                    continue
+                wait_until = min(wait_until, next_scan)
+            self.p_read_events(wait_until - now)
+        return bool(self.changed)
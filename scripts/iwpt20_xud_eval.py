@@ -71,6 +71,12 @@
 #   - raises UDError if the concatenated tokens of gold and system file do not match
 #   - returns a dictionary with the metrics described above, each metric having
 #     three fields: precision, recall and f1
+# - evaluate(gold_ud, system_ud, per_sentence=True)
+#   - returns the above dictionary and a NumPy array of shape
+#     (gold sentences, len(METRICS), 3) with the correct, gold and system
+#     counts of each metric for each gold sentence (system words and
+#     tokens are counted in the gold sentence in which they start), e.g.
+#     for bootstrap resampling with eval_significance.py
 
 # Description of token matching
 # -----------------------------
@@ -104,6 +110,7 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import bisect
 import io
 import sys
 import unicodedata
@@ -112,6 +119,12 @@ import unittest
 # CoNLL-U column names
 ID, FORM, LEMMA, UPOS, XPOS, FEATS, HEAD, DEPREL, DEPS, MISC = range(10)
 
+# Metrics in the order they are printed and stored in per-sentence counts
+METRICS = ["Tokens", "Sentences", "Words", "UPOS", "XPOS", "UFeats", "AllTags", "Lemmas", "UAS", "LAS", "ELAS", "EULAS", "CLAS", "MLAS", "BLEX"]
+
+# Indices of the last axis of per-sentence counts
+CORRECT, GOLD_TOTAL, SYSTEM_TOTAL = range(3)
+
 # Content and functional relations
 CONTENT_DEPRELS = {
     "nsubj", "obj", "iobj", "csubj", "ccomp", "xcomp", "obl", "vocative",
@@ -406,7 +419,7 @@ def load_conllu(file,treebank_type):
     return ud
 
 # Evaluate the gold and system treebanks (loaded using load_conllu).
-def evaluate(gold_ud, system_ud):
+def evaluate(gold_ud, system_ud, per_sentence=False):
     class Score:
         def __init__(self, gold_total, system_total, correct, aligned_total=None):
             self.correct = correct
@@ -431,7 +444,18 @@ def evaluate(gold_ud, system_ud):
             self.matched_words.append(AlignmentWord(gold_word, system_word))
             self.matched_words_map[system_word] = gold_word
 
-    def spans_score(gold_spans, system_spans):
+    # Per-sentence counts, indexed by the gold sentence containing
+    # the start of a span
+    sentence_counts = None
+    sentence_starts = [sentence.start for sentence in gold_ud.sentences]
+    def sentence_of(span):
+        return max(0, bisect.bisect_right(sentence_starts, span.start) - 1)
+
+    def count(metric, column, span, n=1):
+        if sentence_counts is not None and metric is not None:
+            sentence_counts[sentence_of(span), METRICS.index(metric), column] += n
+
+    def spans_score(gold_spans, system_spans, metric=None):
         correct, gi, si = 0, 0, 0
         while gi < len(gold_spans) and si < len(system_spans):
             if system_spans[si].start < gold_spans[gi].start:
@@ -439,13 +463,27 @@ def evaluate(gold_ud, system_ud):
             elif gold_spans[gi].start < system_spans[si].start:
                 gi += 1
             else:
-                correct += gold_spans[gi].end == system_spans[si].end
+                if gold_spans[gi].end == system_spans[si].end:
+                    correct += 1
+                    count(metric, CORRECT, gold_spans[gi])
                 si += 1
                 gi += 1
+        if sentence_counts is not None and metric is not None:
+            for span in gold_spans:
+                count(metric, GOLD_TOTAL, span)
+            for span in system_spans:
+                count(metric, SYSTEM_TOTAL, span)
 
         return Score(len(gold_spans), len(system_spans), correct)
 
-    def alignment_score(alignment, key_fn=None, filter_fn=None):
+    def alignment_score(alignment, key_fn=None, filter_fn=None, metric=None):
+        if sentence_counts is not None and metric is not None:
+            for word in alignment.gold_words:
+                if filter_fn is None or filter_fn(word):
+                    count(metric, GOLD_TOTAL, word.span)
+            for word in alignment.system_words:
+                if filter_fn is None or filter_fn(word):
+                    count(metric, SYSTEM_TOTAL, word.span)
         if filter_fn is not None:
             gold = sum(1 for gold in alignment.gold_words if filter_fn(gold))
             system = sum(1 for system in alignment.system_words if filter_fn(system))
@@ -457,6 +495,8 @@ def evaluate(gold_ud, system_ud):
 
         if key_fn is None:
             # Return score for whole aligned words
+            for words in alignment.matched_words:
+                count(metric, CORRECT, words.gold_word.span)
             return Score(gold, system, aligned)
 
         def gold_aligned_gold(word):
@@ -468,10 +508,11 @@ def evaluate(gold_ud, system_ud):
             if filter_fn is None or filter_fn(words.gold_word):
                 if key_fn(words.gold_word, gold_aligned_gold) == key_fn(words.system_word, gold_aligned_system):
                     correct += 1
+                    count(metric, CORRECT, words.gold_word.span)
 
         return Score(gold, system, correct, aligned)
 
-    def enhanced_alignment_score(alignment,EULAS):
+    def enhanced_alignment_score(alignment,EULAS,metric=None):
         # count all matching enhanced deprels in gold, system GB
         # gold and system = sum of gold and predicted deps
         # parents are pointers to word object, make sure to compare system parent with aligned word in gold in cases where
@@ -479,9 +520,11 @@ def evaluate(gold_ud, system_ud):
         gold = 0
         for gold_word in alignment.gold_words :
             gold += len(gold_word.columns[DEPS])
+            count(metric, GOLD_TOTAL, gold_word.span, len(gold_word.columns[DEPS]))
         system = 0
         for system_word in alignment.system_words :
             system += len(system_word.columns[DEPS])
+            count(metric, SYSTEM_TOTAL, system_word.span, len(system_word.columns[DEPS]))
         # NB aligned does not play a role in computing f1 score -- GB
         aligned = len(alignment.matched_words)
         correct = 0
@@ -495,8 +538,10 @@ def evaluate(gold_ud, system_ud):
                         if dep == sdep or ( eulas_dep == eulas_sdep and EULAS ) :
                             if parent == alignment.matched_words_map.get(sparent,"NotAligned") :
                                 correct += 1
+                                count(metric, CORRECT, words.gold_word.span)
                             elif (parent == 0 and sparent == 0) :  # cases where parent is root
                                 correct += 1
+                                count(metric, CORRECT, words.gold_word.span)
 
         return Score(gold, system, correct, aligned)
 
@@ -604,38 +649,50 @@ def evaluate(gold_ud, system_ud):
     # Align words
     alignment = align_words(gold_ud.words, system_ud.words)
 
+    if per_sentence:
+        import numpy
+        sentence_counts = numpy.zeros((len(gold_ud.sentences), len(METRICS), 3), dtype=numpy.int32)
+
     # Compute the F1-scores
-    return {
-        "Tokens": spans_score(gold_ud.tokens, system_ud.tokens),
-        "Sentences": spans_score(gold_ud.sentences, system_ud.sentences),
-        "Words": alignment_score(alignment),
-        "UPOS": alignment_score(alignment, lambda w, _: w.columns[UPOS]),
-        "XPOS": alignment_score(alignment, lambda w, _: w.columns[XPOS]),
-        "UFeats": alignment_score(alignment, lambda w, _: w.columns[FEATS]),
-        "AllTags": alignment_score(alignment, lambda w, _: (w.columns[UPOS], w.columns[XPOS], w.columns[FEATS])),
-        "Lemmas": alignment_score(alignment, lambda w, ga: w.columns[LEMMA] if ga(w).columns[LEMMA] != "_" else "_"),
-        "UAS": alignment_score(alignment, lambda w, ga: ga(w.parent)),
-        "LAS": alignment_score(alignment, lambda w, ga: (ga(w.parent), w.columns[DEPREL])),
+    scores = {
+        "Tokens": spans_score(gold_ud.tokens, system_ud.tokens, "Tokens"),
+        "Sentences": spans_score(gold_ud.sentences, system_ud.sentences, "Sentences"),
+        "Words": alignment_score(alignment, metric="Words"),
+        "UPOS": alignment_score(alignment, lambda w, _: w.columns[UPOS], metric="UPOS"),
+        "XPOS": alignment_score(alignment, lambda w, _: w.columns[XPOS], metric="XPOS"),
+        "UFeats": alignment_score(alignment, lambda w, _: w.columns[FEATS], metric="UFeats"),
+        "AllTags": alignment_score(alignment, lambda w, _: (w.columns[UPOS], w.columns[XPOS], w.columns[FEATS]), metric="AllTags"),
+        "Lemmas": alignment_score(alignment, lambda w, ga: w.columns[LEMMA] if ga(w).columns[LEMMA] != "_" else "_", metric="Lemmas"),
+        "UAS": alignment_score(alignment, lambda w, ga: ga(w.parent), metric="UAS"),
+        "LAS": alignment_score(alignment, lambda w, ga: (ga(w.parent), w.columns[DEPREL]), metric="LAS"),
         # include enhanced DEPS score -- GB
-        "ELAS": enhanced_alignment_score(alignment,0),
-        "EULAS": enhanced_alignment_score(alignment,1),
+        "ELAS": enhanced_alignment_score(alignment,0,"ELAS"),
+        "EULAS": enhanced_alignment_score(alignment,1,"EULAS"),
         "CLAS": alignment_score(alignment, lambda w, ga: (ga(w.parent), w.columns[DEPREL]),
-                                filter_fn=lambda w: w.is_content_deprel),
+                                filter_fn=lambda w: w.is_content_deprel, metric="CLAS"),
         "MLAS": alignment_score(alignment, lambda w, ga: (ga(w.parent), w.columns[DEPREL], w.columns[UPOS], w.columns[FEATS],
                                                          [(ga(c), c.columns[DEPREL], c.columns[UPOS], c.columns[FEATS])
                                                           for c in w.functional_children]),
-                                filter_fn=lambda w: w.is_content_deprel),
+                                filter_fn=lambda w: w.is_content_deprel, metric="MLAS"),
         "BLEX": alignment_score(alignment, lambda w, ga: (ga(w.parent), w.columns[DEPREL],
                                                           w.columns[LEMMA] if ga(w).columns[LEMMA] != "_" else "_"),
-                                filter_fn=lambda w: w.is_content_deprel),
+                                filter_fn=lambda w: w.is_content_deprel, metric="BLEX"),
     }
+    if per_sentence:
+        return scores, sentence_counts
+    return scores
 
 
-def load_conllu_file(path,treebank_type):
+def load_conllu_file(path,treebank_type,collapse_empty_nodes=False):
     _file = open(path, mode="r", **({"encoding": "utf-8"} if sys.version_info >= (3, 0) else {}))
+    if collapse_empty_nodes:
+        # collapse empty nodes sentence by sentence while loading
+        # instead of running enhanced_collapse_empty_nodes.pl first
+        import collapse_empty_nodes as collapser
+        _file = collapser.CollapsedFile(_file)
     return load_conllu(_file,treebank_type)
 
-def evaluate_wrapper(args):
+def evaluate_wrapper(args, per_sentence=False):
     treebank_type = {}
     enhancements = list(args.enhancements)
     treebank_type['no_gapping'] = 1 if '1' in enhancements else 0
@@ -646,9 +703,9 @@ def evaluate_wrapper(args):
     treebank_type['no_case_info'] = 1 if '6' in enhancements else 0
 
     # Load CoNLL-U files
-    gold_ud = load_conllu_file(args.gold_file,treebank_type)
-    system_ud = load_conllu_file(args.system_file,treebank_type)
-    return evaluate(gold_ud, system_ud)
+    gold_ud = load_conllu_file(args.gold_file,treebank_type,args.collapse_empty_nodes)
+    system_ud = load_conllu_file(args.system_file,treebank_type,args.collapse_empty_nodes)
+    return evaluate(gold_ud, system_ud, per_sentence)
 
 def main():
     # Parse arguments
@@ -665,6 +722,10 @@ def main():
                         help="Print raw counts of correct/gold/system/aligned words instead of prec/rec/F1 for all metrics.")
     parser.add_argument("--enhancements", type=str, default='0',
                         help="Level of enhancements in the gold data (see guidelines) 0=all (default), 1=no gapping, 2=no shared parents, 3=no shared dependents 4=no control, 5=no external arguments, 6=no lemma info, combinations: 12=both 1 and 2 apply, etc.")
+    parser.add_argument("--collapse-empty-nodes", default=False, action="store_true",
+                        help="Collapse empty nodes while loading the input files (no need to run enhanced_collapse_empty_nodes.pl first).")
+    parser.add_argument("--per-sentence", default=None, action="store",
+                        help="Save per-sentence correct/gold/system counts of all metrics as a NumPy .npy file, e.g. for eval_significance.py.")
     args = parser.parse_args()
 
     if args.output:
@@ -673,7 +734,12 @@ def main():
         sys.stdout = open(args.output, 'w')
 
     # Evaluate
-    evaluation = evaluate_wrapper(args)
+    if args.per_sentence:
+        import numpy
+        evaluation, sentence_counts = evaluate_wrapper(args, per_sentence=True)
+        numpy.save(args.per_sentence, sentence_counts)
+    else:
+        evaluation = evaluate_wrapper(args)
 
     # Print the evaluation
     if not args.verbose and not args.counts:
@@ -689,7 +755,7 @@ def main():
         else:
             print("Metric     | Precision |    Recall |  F1 Score | AligndAcc")
         print("-----------+-----------+-----------+-----------+-----------")
-        for metric in["Tokens", "Sentences", "Words", "UPOS", "XPOS", "UFeats", "AllTags", "Lemmas", "UAS", "LAS", "ELAS", "EULAS", "CLAS", "MLAS", "BLEX"]:
+        for metric in METRICS:
             if args.counts:
                 print("{:11}|{:10} |{:10} |{:10} |{:10}".format(
                     metric,
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Export of counters of long-running workers in the Prometheus text
+# format, either as a file that is replaced atomically, e.g. for the
+# textfile collector of node_exporter, or via HTTP on localhost.
+#
+# Metrics are given as a list of (name, type, help, samples), where
+# type is 'counter' or 'gauge' and samples is either a number or a list
+# of (labels, value) with labels a dictionary.
+
+from __future__ import print_function
+
+import os
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+def format_metrics(metrics):
+    lines = []
+    for name, metric_type, help_text, samples in metrics:
+        lines.append('# HELP %s %s' %(name, help_text))
+        lines.append('# TYPE %s %s' %(name, metric_type))
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            if labels:
+                label_text = ','.join([
+                    '%s="%s"' %(key, labels[key]) for key in sorted(labels)
+                ])
+                lines.append('%s{%s} %s' %(name, label_text, format_value(value)))
+            else:
+                lines.append('%s %s' %(name, format_value(value)))
+    lines.append('')
+    return '\n'.join(lines)
+
+def format_value(value):
+    if isinstance(value, int):
+        return '%d' %value
+    return '%.6g' %value
+
+def write_metrics_file(path, text):
+    f = open(path + '.prep', 'wb')
+    f.write(text.encode('utf-8'))
+    f.close()
+    os.rename(path + '.prep', path)
+
+def start_metrics_server(port, get_metrics, host = '127.0.0.1'):
+    ''' serves the output of get_metrics() on http://host:port/metrics
+        from a daemon thread and returns the server
+    '''
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            data = format_metrics(get_metrics()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', '%d' %len(data))
+            self.end_headers()
+            self.wfile.write(data)
+        def log_message(self, *args):
+            # do not clutter the worker's log
+            pass
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print('Serving metrics on http://%s:%d/metrics' %(host, server.server_port))
+    return server
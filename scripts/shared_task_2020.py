@@ -16,16 +16,22 @@
 
 from __future__ import print_function
 
+import fcntl
 import importlib
 import hashlib
+import multiprocessing
 import os
 import random
 import string
 import sys
+import threading
 import time
 from collections import defaultdict
 
+import artifact_store
+import common_udpipe_future
 import conllu_dataset
+import task_dag
 import utilities
 
 class Options:
@@ -122,10 +128,24 @@ Options:
 
     --verbose               More detailed log output
 
-    --stopfile  FILE        Stop processing if FILE exists, tested after
-                            every enhanced prediction
+    --stopfile  FILE        Stop processing if FILE exists, tested before
+                            each segmentation, basic parse, enhanced parse
+                            and evaluation
                             (default: stop.me in the current folder)
 
+    --max-parallel  N       Run up to N segmentations, basic parses,
+                            enhanced parses and evaluations at the same
+                            time; with EUD_TASK_DIR, most of them wait for
+                            tasks running on workers.
+                            (Default: 0 = number of CPU cores with
+                            EUD_TASK_DIR, otherwise 1 as the steps run
+                            their models on this machine)
+
+    --max-parallel-votes  N Run up to N parsers of a basic parser ensemble
+                            at the same time
+                            (Default: 0 = all parsers of the ensemble with
+                            EUD_TASK_DIR, otherwise 1)
+
 """)
 
     def read_options(self):
@@ -145,6 +165,8 @@ Options:
         self.verbose    = False
         self.debug      = True
         self.stopfile   = 'stop.me'
+        self.max_parallel = 0
+        self.max_parallel_votes = 0
         while len(sys.argv) >= 2 and sys.argv[1][:1] == '-':
             option = sys.argv[1]
             option = option.replace('_', '-')
@@ -196,6 +218,12 @@ Options:
             elif option == '--stopfile':
                 self.stopfile = sys.argv[1]
                 del sys.argv[1]
+            elif option == '--max-parallel':
+                self.max_parallel = int(sys.argv[1])
+                del sys.argv[1]
+            elif option == '--max-parallel-votes':
+                self.max_parallel_votes = int(sys.argv[1])
+                del sys.argv[1]
             elif option == '--verbose':
                 self.verbose = True
             elif option == '--debug':
@@ -276,6 +304,7 @@ Options:
         return retval
 
     def get_tasks_and_configs(self):
+        start_time = time.time()
         self.task_treebanks = self.scan_ud_or_task_folder(
             self.taskdir, 'taskdir'
         )
@@ -326,6 +355,11 @@ Options:
                     variant = variant,
                 ))
             self.configs[tbid] = configs_for_tbid
+        if self.verbose:
+            print('Prepared %d configurations for %d TBIDs in %.1f seconds' %(
+                sum([len(configs) for configs in self.configs.values()]),
+                len(self.configs), time.time() - start_time,
+            ))
         if self.debug:
             print('%d TBIDs configured' %len(self.configs))
             for key in sorted(list(self.configs.keys())):
@@ -339,22 +373,24 @@ Options:
             print('\n== Training Models ==\n')
         tasks = []
         self.in_progress = set()
-        for tbid in sorted(list(self.configs.keys())):
-            for config in self.configs[tbid]:
-                if os.path.exists(self.stopfile):
-                    return
-                if not config.is_operational():
-                    print('Not training %r as it is not operational' %config)
-                    continue
-                if not config.skip(self.modules_not_to_train):
-                    tasks += config.train_missing_models()
-                else:
-                    print('Not training %r as user requested to skip it' %config)
+        # submit all tasks in one go at the end of the with block
+        with common_udpipe_future.TaskBatch():
+            for tbid in sorted(list(self.configs.keys())):
+                for config in self.configs[tbid]:
+                    if os.path.exists(self.stopfile):
+                        return
+                    if not config.is_operational():
+                        print('Not training %r as it is not operational' %config)
+                        continue
+                    if not config.skip(self.modules_not_to_train):
+                        tasks += config.train_missing_models()
+                    else:
+                        print('Not training %r as user requested to skip it' %config)
         if self.verbose:
             print('Submitted %d training task(s)' %(len(tasks)-tasks.count(None)))
         if self.training_only:
             return
-        utilities.wait_for_tasks(tasks)
+        common_udpipe_future.wait_for_tasks(tasks)
 
     def scan_ud25(self):
         self.ud25_treebanks = self.scan_ud_or_task_folder(
@@ -370,6 +406,10 @@ Options:
         utilities.makedirs(basic_p_dir)
         enhanced_dir = self.predictdir
         utilities.makedirs(enhanced_dir)
+        # each output file is a node of the task graph so that
+        # configs sharing a segmentation or basic parse share the
+        # node and independent steps run in parallel
+        graph = task_dag.TaskGraph()
         for tbid in sorted(list(self.task_treebanks.keys())):
             prediction_tasks = self.task_treebanks[tbid][3]
             for input_path, prediction_dataset_type in prediction_tasks:
@@ -394,13 +434,9 @@ Options:
                         config.segmenter_id,
                         prediction_name
                     )
-                    if not os.path.exists(segmented_path):
-                        config.segment(input_path, segmented_path)
-                    else:
-                        print('Reusing existing segmentation')
-                    if not os.path.exists(segmented_path):
-                        print('Warning: Failure to produce %s' %segmented_path)
-                        continue
+                    depends_on = self.p_add_step(
+                        graph, config, 'segment', input_path, segmented_path, [],
+                    )
                     # basic parsing
                     if config.basic_parser_id is None:
                         print('Basic parser not ready, e.g. missing model')
@@ -411,13 +447,9 @@ Options:
                         config.basic_parser_id,
                         prediction_name
                     )
-                    if not os.path.exists(basic_p_path):
-                        config.parse(segmented_path, basic_p_path)
-                    else:
-                        print('Reusing existing basic parse')
-                    if not os.path.exists(basic_p_path):
-                        print('Warning: Failure to produce %s' %basic_p_path)
-                        continue
+                    depends_on = self.p_add_step(
+                        graph, config, 'parse', segmented_path, basic_p_path, depends_on,
+                    )
                     # enhanced parsing
                     if config.enhanced_parser_id is None:
                         print('Enhanced parser not ready, e.g. missing model')
@@ -429,23 +461,214 @@ Options:
                         config.enhanced_parser_id,
                         prediction_name
                     )
-                    if not os.path.exists(enhanced_path):
-                        config.enhance(basic_p_path, enhanced_path)
-                    else:
-                        print('Reusing existing enhanced parse')
-                    if not os.path.exists(enhanced_path):
-                        print('Warning: Failure to produce %s' %enhanced_path)
-                        continue
+                    depends_on = self.p_add_step(
+                        graph, config, 'enhance', basic_p_path, enhanced_path, depends_on,
+                    )
                     # TODO: add post-processor here
                     # --
-                    if os.path.exists(self.stopfile):
-                        return
                     # evaluate: gold file is assumed to be in the same folder
                     # as the input text file with .conllu instead of .txt
                     if prediction_dataset_type == 'test':
                         continue
                     gold_path = '%s/%s.conllu' %(tb_dir, prediction_name)
-                    conllu_dataset.evaluate(enhanced_path, gold_path, self)
+                    node_id = 'evaluate ' + enhanced_path
+                    if node_id not in graph.nodes:
+                        graph.add_function(
+                            p_run_step,
+                            (None, 'evaluate', enhanced_path, gold_path, self),
+                            depends_on = depends_on,
+                            node_id = node_id,
+                        )
+        if not graph.nodes:
+            return
+        max_parallel = self.max_parallel
+        if not max_parallel:
+            if 'EUD_TASK_DIR' in os.environ:
+                max_parallel = multiprocessing.cpu_count()
+            else:
+                # parsers and GPU models run on this machine
+                max_parallel = 1
+        print('\n== Running %d prediction and evaluation steps, up to %d at a time ==\n' %(
+            len(graph.nodes), max_parallel,
+        ))
+        sys.stdout.flush()
+        # steps are functions running in child processes; their
+        # commands use the task queue if EUD_TASK_DIR is set
+        node2state = graph.run(executor = task_dag.LocalExecutor(max_parallel))
+        state2count = defaultdict(lambda: 0)
+        for node_id in node2state:
+            state2count[node2state[node_id]] += 1
+        print('Prediction and evaluation steps: %d completed, %d failed, %d skipped' %(
+            state2count['completed'], state2count['failed'], state2count['skipped'],
+        ))
+
+    def p_add_step(self, graph, config, step, input_path, output_path, depends_on):
+        ''' adds a node producing output_path unless the file exists or
+            another config already added it and returns the dependencies
+            of steps using the output
+        '''
+        if output_path in graph.nodes:
+            return [output_path]
+        if os.path.exists(output_path) \
+        and artifact_store.get_store(self) is None:
+            print('Reusing existing', output_path)
+            return []
+        graph.add_function(
+            p_run_step,
+            (config, step, input_path, output_path, self),
+            depends_on = depends_on,
+            node_id = output_path,
+        )
+        return [output_path]
+
+def p_run_step(config, step, input_path, output_path, options):
+    ''' runs a step of predict_and_evaluate() in a child process and
+        exits with an error if the step did not produce its output
+    '''
+    if os.path.exists(options.stopfile):
+        print('Found stop file, not starting %s for %s' %(step, output_path))
+        sys.exit(1)
+    if step == 'evaluate':
+        # output_path is the gold file
+        conllu_dataset.evaluate(input_path, output_path, options)
+        return
+    # re-uses the output of earlier runs with the same input,
+    # see artifact_store.py
+    artifact_store.run_step(
+        options, config.get_step_signature(step),
+        [input_path], output_path,
+        getattr(config, step), (input_path, output_path),
+    )
+    if not os.path.exists(output_path):
+        print('Warning: Failure to produce %s' %output_path)
+        sys.exit(1)
+
+# Caches for preparing the configurations, see
+# Config_default.filter_by_lcode_and_add_datasets()
+
+module_cache = {}
+query_cache = {}
+dataset_info_cache = {}
+combinations_cache = {}
+filter_cache = {}
+
+def get_module(module_name):
+    ''' imports the module or returns None if it is not available '''
+    try:
+        return module_cache[module_name]
+    except KeyError:
+        pass
+    try:
+        my_module = importlib.import_module(module_name)
+    except ImportError:
+        print('Warning: module %r not available, skipping' %module_name)
+        my_module = None
+    module_cache[module_name] = my_module
+    return my_module
+
+def query_module(module_name, function_name, *args):
+    ''' calls the function of the module with the given arguments
+        unless there is a result for the same call, assuming
+        that the module's answer does not change while the
+        configurations are prepared
+    '''
+    key = (module_name, function_name, args)
+    try:
+        return query_cache[key]
+    except KeyError:
+        pass
+    my_module = get_module(module_name)
+    if my_module is None:
+        raise ImportError('No module named %s' %module_name)
+    retval = getattr(my_module, function_name)(*args)
+    query_cache[key] = retval
+    return retval
+
+def get_dataset_info(dataset_name):
+    ''' returns source, tbid and lcode of the dataset, e.g.
+        ('ud25', 'en_gum', 'en') for 'ud25.en_gum'
+    '''
+    try:
+        return dataset_info_cache[dataset_name]
+    except KeyError:
+        pass
+    data_source, tbid = dataset_name.split('.', 1)
+    lcode = tbid.split('_')[0]
+    retval = (data_source, tbid, lcode)
+    dataset_info_cache[dataset_name] = retval
+    return retval
+
+def iter_dataset_combinations(datasets):
+    ''' yields the combinations of the given datasets that
+        are considered for training
+    '''
+    # https://stackoverflow.com/questions/1482308/how-to-get-all-subsets-of-a-set-powerset
+    n_datasets = len(datasets)
+    if n_datasets > 7:
+        print('8 or more datasets. Only considering mono-treebank models and the multi-treebank model using all datasets.')
+    elif n_datasets > 4:
+        print('Between 5 and 7 datasets. Only considering combinations of 1, n-1 and n datasets')
+    else:
+        # explore all 2**n - 1 non-empty combinations (1, 3, 7 or 15)
+        for combination_index in range(1, 1 << n_datasets):
+            yield [datasets[j]
+                for j in range(n_datasets)
+                if (combination_index & (1 << j))
+            ]
+        return
+    for dataset in datasets:
+        yield [dataset]
+    yield list(datasets)
+    if n_datasets <= 7:
+        for i in range(n_datasets):
+            yield datasets[:i] + datasets[i+1:]
+
+def get_dataset_combinations(lcode, datasets):
+    ''' returns a list of combinations of the given datasets
+        with their priority and the properties relevant for
+        selecting modules that can use them, computed once
+        for each language and list of datasets
+    '''
+    key = (lcode, tuple(datasets))
+    try:
+        return combinations_cache[key]
+    except KeyError:
+        pass
+    all_tbids = set()
+    for dataset in datasets:
+        all_tbids.add(get_dataset_info(dataset)[1])
+    n_all_tbids = len(all_tbids)
+    retval = []
+    for combination in iter_dataset_combinations(datasets):
+        contains_ud25_data = False
+        contains_task_data = False
+        contains_target_lcode = False
+        duplicate_tbid = False
+        data_lcodes = set()
+        data_tbids = set()
+        for dataset_name in combination:
+            data_source, tbid, data_lcode = get_dataset_info(dataset_name)
+            if data_source == 'ud25':
+                contains_ud25_data = True
+            if data_source == 'task':
+                contains_task_data = True
+            if data_lcode == lcode:
+                contains_target_lcode = True
+            if tbid in data_tbids:
+                duplicate_tbid = True
+            data_lcodes.add(data_lcode)
+            data_tbids.add(tbid)
+        prio1 = len(data_tbids)
+        prio2 = n_all_tbids - prio1
+        priority = min(2*prio1-1, 2*prio2)
+        retval.append((
+            combination, priority, tuple(sorted(data_tbids)),
+            contains_ud25_data, contains_task_data, len(data_lcodes) > 1,
+            contains_target_lcode, duplicate_tbid,
+            data_lcode,  # lcode of last dataset as used for external models
+        ))
+    combinations_cache[key] = retval
+    return retval
 
 class Config_default:
 
@@ -596,139 +819,102 @@ class Config_default:
         datasets.sort()
         if self.options.debug:
             print('\t-->', datasets)
+        # get_variants() asks for the same modules many times and
+        # configs of the same language usually have the same datasets
+        key = (self.options, self.lcode, tuple(module_names), tuple(datasets), length_limit)
+        try:
+            retval = filter_cache[key]
+            if self.options.debug:
+                print('\tRe-using result of previous check for', self.lcode)
+                print('\t-->', retval)
+            return list(retval)
+        except KeyError:
+            pass
         retval = []
         external_model_ids_covered = {}
         for module_name in module_names:
             if self.options.debug:
                 print('\t\tImporting', module_name)
                 sys.stdout.flush()
-            try:
-                my_module = importlib.import_module(module_name)
-            except ImportError:
-                print('Warning: module %r not available, skipping' %module_name)
+            my_module = get_module(module_name)
+            if my_module is None:
                 continue
-            if my_module.supports_lcode(self.lcode):
+            if query_module(module_name, 'supports_lcode', self.lcode):
                 if self.options.debug:
                     print('\t\tLanguage %s is supported' %self.lcode)
                 if not datasets:
-                    if my_module.has_default_model_for_lcode(self.lcode):
+                    if query_module(module_name, 'has_default_model_for_lcode', self.lcode):
                         retval.append((0, module_name))
-                else:
-                    tbid_combinations_covered = {}
-                    all_tbids = set()
-                    # find number of tbids
-                    for dataset in datasets:
-                        _, tbid = dataset.split('.', 1)
-                        all_tbids.add(tbid)
-                    n_all_tbids = len(all_tbids)
-                    # https://stackoverflow.com/questions/1482308/how-to-get-all-subsets-of-a-set-powerset
-                    n_datasets = len(datasets)
-                    combination_indices = []
-                    for i in range(n_datasets):
-                        combination_indices.append(1<<i)
-                    combi_all = (1 << n_datasets) - 1
-                    combination_indices.append(combi_all)
-                    if n_datasets > 7:
-                        print('8 or more datasets. Only considering mono-treebank models and the multi-treebank model using all datasets.')
-                    elif n_datasets > 4:
-                        print('Between 5 and 7 datasets. Only considering combinations of 1, n-1 and n datasets')
-                        for i in range(n_datasets):
-                            combination_indices.append(combi_all - (1<<i))
-                    else:
-                        # explore all 2**n - 1 non-empty combinations (1, 3, 7 or 15)
-                        combination_indices = range(1, 1 << n_datasets)
-                    for combination_index in combination_indices:
-                        combination = [datasets[j]
-                            for j in range(n_datasets)
-                            if (combination_index & (1 << j))
-                        ]
+                    continue
+                tbid_combinations_covered = {}
+                for combination_info in get_dataset_combinations(self.lcode, datasets):
+                    combination, priority, tbid_combi, \
+                    contains_ud25_data, contains_task_data, is_polyglot, \
+                    contains_target_lcode, duplicate_tbid, lcode = combination_info
+                    if self.options.debug:
+                        print('\t\t\tChecking dataset combination', combination)
+                    if duplicate_tbid:
                         if self.options.debug:
-                            print('\t\t\tChecking dataset combination', combination)
-                        contains_ud25_data = False
-                        contains_task_data = False
-                        _, first_tbid = combination[0].split('.', 1)
-                        first_lcode = first_tbid.split('_')[0]
-                        contains_target_lcode = False
-                        duplicate_tbid = False
-                        data_lcodes = set()
-                        data_tbids = set()
-                        for dataset_name in combination:
-                            if dataset_name.startswith('ud25.'):
-                                contains_ud25_data = True
-                            if dataset_name.startswith('task.'):
-                                contains_task_data = True
-                            data_source, tbid = dataset_name.split('.', 1)
-                            lcode = tbid.split('_')[0]
-                            if lcode == self.lcode:
-                                contains_target_lcode = True
-                            if tbid in data_tbids:
-                                duplicate_tbid = True
-                            data_lcodes.add(lcode)
-                            data_tbids.add(tbid)
-                        prio1 = len(data_tbids)
-                        prio2 = n_all_tbids - prio1
-                        priority = min(2*prio1-1, 2*prio2)
-                        if duplicate_tbid:
+                            print('\t\t\t--> duplicate tbid, skipping')
+                        continue
+                    if tbid_combi in tbid_combinations_covered:
+                        if self.options.debug:
+                            print('\t\t\t-->not adding as already have', tbid_combinations_covered[tbid_combi])
+                    if not contains_target_lcode:
+                        # dataset combination has no data with the
+                        # target lcode --> skip
+                        if self.options.debug:
+                            print('\t\t\t--> no matching lcode, skipping')
+                        continue
+                    if query_module(module_name, 'uses_external_models'):
+                        model_id = query_module(
+                            module_name, 'get_model_id',
+                            lcode, None, datasets[-1], self.options,
+                        )
+                        if model_id is None:
+                            if self.options.debug:
+                                print('\t\t\t--> not adding as no matching model available')
+                        elif model_id in external_model_ids_covered:
+                            if self.options.debug:
+                                print('\t\t\t--> not adding as already have %s with model ID %s' %(
+                                    external_model_ids_covered[model_id], model_id,
+                                ))
+                        else:
+                            retval.append((priority, ':'.join((module_name, '+'.join(combination)))))
+                            external_model_ids_covered[model_id] = retval[-1][1]
                             if self.options.debug:
-                                print('\t\t\t--> duplicate tbid, skipping')
-                            continue
-                        tbid_combi = tuple(sorted(data_tbids))
-                        if tbid_combi in tbid_combinations_covered:
+                                print('\t\t\t--> added data as module has external model matching it')
+                                print('\t\t\t--> model ID is', model_id)
+                        continue
+                    #if is_polyglot:
+                    #    TODO: do we want to check that all languages are supported,
+                    #          e.g. word embeddings are available, or do we assume
+                    #          that modules that support polyglot training use internal
+                    #          word embeddings only?
+                    if len(combination) == 1 \
+                    and contains_ud25_data   \
+                    and query_module(module_name, 'has_ud25_model_for_tbid', combination[0][5:]):
+                            retval.append((priority, ':'.join((module_name, combination[0]))))
+                            tbid_combinations_covered[tbid_combi] = combination
+                            if self.options.debug:
+                                print('\t\t\t--> added data as module has a ud25 model ready')
+                    if len(combination) == 1 \
+                    and contains_task_data   \
+                    and query_module(module_name, 'has_task_model_for_tbid', combination[0][5:]):
+                            retval.append((priority, ':'.join((module_name, combination[0]))))
+                            tbid_combinations_covered[tbid_combi] = combination
                             if self.options.debug:
-                                print('\t\t\t-->not adding as already have', tbid_combinations_covered[tbid_combi])
-                        if not contains_target_lcode:
-                            # dataset combination has no data with the
-                            # target lcode --> skip
+                                print('\t\t\t--> added data as module has a task model ready')
+                    elif query_module(module_name, 'can_train_on', contains_ud25_data, contains_task_data, is_polyglot):
+                            retval.append((priority, ':'.join((module_name, '+'.join(combination)))))
+                            tbid_combinations_covered[tbid_combi] = combination
                             if self.options.debug:
-                                print('\t\t\t--> no matching lcode, skipping')
-                            continue
-                        if my_module.uses_external_models():
-                            model_id = my_module.get_model_id(lcode, None, dataset, self.options)
-                            if model_id is None:
-                                if self.options.debug:
-                                    print('\t\t\t--> not adding as no matching model available')
-                            elif model_id in external_model_ids_covered:
-                                if self.options.debug:
-                                    print('\t\t\t--> not adding as already have %s with model ID %s' %(
-                                        external_model_ids_covered[model_id], model_id,
-                                    ))
-                            else:
-                                retval.append((priority, ':'.join((module_name, '+'.join(combination)))))
-                                external_model_ids_covered[model_id] = retval[-1][1]
-                                if self.options.debug:
-                                    print('\t\t\t--> added data as module has external model matching it')
-                                    print('\t\t\t--> model ID is', model_id)
-                            continue
-                        is_polyglot = len(data_lcodes) > 1
-                        #if is_polyglot:
-                        #    TODO: do we want to check that all languages are supported,
-                        #          e.g. word embeddings are available, or do we assume
-                        #          that modules that support polyglot training use internal
-                        #          word embeddings only?
-                        if len(combination) == 1 \
-                        and contains_ud25_data   \
-                        and my_module.has_ud25_model_for_tbid(combination[0][5:]):
-                                retval.append((priority, ':'.join((module_name, combination[0]))))
-                                tbid_combinations_covered[tbid_combi] = combination
-                                if self.options.debug:
-                                    print('\t\t\t--> added data as module has a ud25 model ready')
-                        if len(combination) == 1 \
-                        and contains_task_data   \
-                        and my_module.has_task_model_for_tbid(combination[0][5:]):
-                                retval.append((priority, ':'.join((module_name, combination[0]))))
-                                tbid_combinations_covered[tbid_combi] = combination
-                                if self.options.debug:
-                                    print('\t\t\t--> added data as module has a task model ready')
-                        elif my_module.can_train_on(contains_ud25_data, contains_task_data, is_polyglot):
-                                retval.append((priority, ':'.join((module_name, '+'.join(combination)))))
-                                tbid_combinations_covered[tbid_combi] = combination
-                                if self.options.debug:
-                                    print('\t\t\t--> added data as module can train on it')
-                        elif self.options.debug:
-                            print('\t\t\tNo suitable data found for')
-                            print('\t\t\t * contains_ud25_data', contains_ud25_data)
-                            print('\t\t\t * contains_task_data', contains_task_data)
-                            print('\t\t\t * is_polyglot', is_polyglot)
+                                print('\t\t\t--> added data as module can train on it')
+                    elif self.options.debug:
+                        print('\t\t\tNo suitable data found for')
+                        print('\t\t\t * contains_ud25_data', contains_ud25_data)
+                        print('\t\t\t * contains_task_data', contains_task_data)
+                        print('\t\t\t * is_polyglot', is_polyglot)
             elif self.options.debug:
                 print('\t\tLanguage %s is not supported' %self.lcode)
         retval.sort()
@@ -736,12 +922,13 @@ class Config_default:
             print('\tPruning too long list of modules', retval)
             retval = retval[:length_limit]
         # remove priority
-        retval = map(lambda x: x[1], retval)
+        retval = [x[1] for x in retval]
+        filter_cache[key] = retval
         if self.options.debug:
             print('\tFinished checking modules for', self.tbid)
             print('\t-->', retval)
             sys.stdout.flush()
-        return retval
+        return list(retval)
 
     def get_dataset_names(self):
         ''' subclasses should extend this list to include
@@ -757,8 +944,8 @@ class Config_default:
     def init_segmenter(self):
         self.segmenter = self.variant[0]
         segmenter_module, datasets = self.segmenter.split(':', 1)
-        segmenter = importlib.import_module(segmenter_module)
-        self.segmenter_id = segmenter.get_model_id(
+        self.segmenter_id = query_module(
+            segmenter_module, 'get_model_id',
             self.lcode,
             self.options.init_seed,
             datasets,
@@ -791,8 +978,8 @@ class Config_default:
     def init_enhanced_parser(self):
         self.enhanced_parser = self.variant[2]
         enhanced_module, datasets = self.enhanced_parser.split(':', 1)
-        enhanced_parser = importlib.import_module(enhanced_module)
-        self.enhanced_parser_id = enhanced_parser.get_model_id(
+        self.enhanced_parser_id = query_module(
+            enhanced_module, 'get_model_id',
             self.lcode,
             self.options.init_seed,
             datasets,
@@ -874,6 +1061,29 @@ class Config_default:
         ))
         return tasks
 
+    def get_step_signature(self, step):
+        ''' describes the modules, models and options used by a
+            prediction step for the artifact store
+        '''
+        if step == 'segment':
+            return 'segment %s %s %s %s' %(
+                self.lcode, self.segmenter, self.segmenter_id,
+                self.options.init_seed,
+            )
+        if step == 'parse':
+            # includes the tbid as multi-treebank
+            # parsers use it as proxy treebank
+            return 'parse %s %s %s %s %r' %(
+                self.tbid, self.basic_parser_id,
+                self.options.init_seed, self.lcode, self.basic_parsers,
+            )
+        if step == 'enhance':
+            return 'enhance %s %s %s %s' %(
+                self.lcode, self.enhanced_parser, self.enhanced_parser_id,
+                self.options.init_seed,
+            )
+        raise ValueError('Unknown prediction step %s' %step)
+
     def segment(self, raw_text_input, conllu_output):
         segmenter_module, datasets = self.segmenter.split(':', 1)
         segmenter = importlib.import_module(segmenter_module)
@@ -901,59 +1111,125 @@ class Config_default:
     def parse(self, conllu_input, conllu_output):
         votesdir = '%s/basic-parses/votes' %self.options.tempdir
         utilities.makedirs(votesdir)
-        ensemble_predictions = []
         _, vote_suffix = conllu_input.rsplit('/', 1)
+        self.p_parse(conllu_input, conllu_output, votesdir, vote_suffix)
+
+    def p_parse_member(self, conllu_input, votesdir, vote_suffix, parser_and_dataset, votes):
+        ''' produces a basic parse with the given parser and
+            datasets, trying further seeds if it fails
+        '''
+        try:
+            self.p_parse_member_with_retries(
+                conllu_input, votesdir, vote_suffix, parser_and_dataset, votes,
+            )
+        except Exception as e:
+            # re-raised by p_parse()
+            with votes.lock:
+                votes.exceptions.append(e)
+
+    def p_parse_member_with_retries(self, conllu_input, votesdir, vote_suffix, parser_and_dataset, votes):
+        parser_module, datasets = parser_and_dataset.split(':', 1)
+        parser = importlib.import_module(parser_module)
+        patience_left = 5
+        while patience_left > 0:
+            with votes.lock:
+                if votes.n_failed or votes.exceptions:
+                    # ensemble will be skipped
+                    return
+                # members with the same parser and datasets
+                # need different seeds
+                p_index = votes.pad2next_index[parser_and_dataset]
+                votes.pad2next_index[parser_and_dataset] = p_index + 1
+            init_seed = '%s%02d' %(self.options.init_seed, p_index)
+            conllu_individual_output = '%s/%s-%s-%s-%s' %(
+                votesdir,
+                parser_module,
+                datasets.replace(':', '_').replace('-', '_'),
+                init_seed,
+                vote_suffix,
+            )
+            if self.options.debug:
+                print('Basic parse for %s using %s trained on %s with seed %s' %(
+                    conllu_input, parser_module, datasets,
+                    init_seed,
+                ))
+            if '+' in datasets:
+                # multi-treebank mode
+                proxy_tbid = self.tbid
+            else:
+                proxy_tbid = None
+            with votes.semaphore:
+                # ensembles parsing the same input in parallel, see
+                # predict_and_evaluate(), share the individual parses
+                lock_file = open('%s.lock' %conllu_individual_output, 'wb')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    # re-uses an existing or stored parse if possible
+                    is_successful = artifact_store.run_step(
+                        self.options,
+                        'vote %s %s %s %s %s' %(
+                            parser_module, self.lcode, datasets, init_seed, proxy_tbid,
+                        ),
+                        [conllu_input], conllu_individual_output,
+                        parser.predict, (
+                            self.lcode, init_seed, datasets, self.options,
+                            conllu_input, conllu_individual_output,
+                        ), {'proxy_tbid': proxy_tbid},
+                    )
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    lock_file.close()
+            if is_successful:
+                with votes.lock:
+                    votes.pad2votes[parser_and_dataset].append(
+                        (p_index, conllu_individual_output)
+                    )
+                return
+            patience_left -= 1
+            if self.options.debug:
+                print('Parse failed.')
+        with votes.lock:
+            votes.n_failed += 1
+
+    def p_parse(self, conllu_input, conllu_output, votesdir, vote_suffix):
         n_parses = len(self.basic_parsers)
         pad2freq = defaultdict(lambda: 0)
         for parser_and_dataset, _ in self.basic_parsers:
             pad2freq[parser_and_dataset] += 1
+        max_parallel = self.options.max_parallel_votes
+        if not max_parallel:
+            if 'EUD_TASK_DIR' in os.environ:
+                max_parallel = n_parses
+            else:
+                # parsers run on this machine
+                max_parallel = 1
+        votes = EnsembleVotes(max_parallel)
+        # create store before the threads use it
+        artifact_store.get_store(self.options)
+        # the parsers wait for subprocesses or tasks
+        # --> run ensemble members in threads
+        threads = []
         for parser_and_dataset in sorted(list(pad2freq.keys())):
-            parser_module, datasets = parser_and_dataset.split(':', 1)
-            parser = importlib.import_module(parser_module)
-            number_parses_needed = pad2freq[parser_and_dataset]
-            patience_at_start = 5
-            patience_left = patience_at_start
-            p_index = 0
-            while number_parses_needed > 0 and patience_left > 0:
-                init_seed = '%s%02d' %(self.options.init_seed, p_index)
-                conllu_individual_output = '%s/%s-%s-%s-%s' %(
-                    votesdir,
-                    parser_module,
-                    datasets.replace(':', '_').replace('-', '_'),
-                    init_seed,
-                    vote_suffix,
+            votes.pad2next_index[parser_and_dataset] = 0
+            votes.pad2votes[parser_and_dataset] = []
+            for _ in range(pad2freq[parser_and_dataset]):
+                thread = threading.Thread(
+                    target = self.p_parse_member,
+                    args = (
+                        conllu_input, votesdir, vote_suffix,
+                        parser_and_dataset, votes,
+                    ),
                 )
-                if os.path.exists(conllu_individual_output):
-                    action = 'Reusing'
-                    is_successful = True
-                else:
-                    action = 'Predicting'
-                if self.options.debug:
-                    print('%s basic parse for %s using %s trained on %s with seed %s' %(
-                        action,
-                        conllu_input, parser_module, datasets,
-                        init_seed,
-                    ))
-                if action == 'Predicting':
-                    if '+' in datasets:
-                        # multi-treebank mode
-                        proxy_tbid = self.tbid
-                    else:
-                        proxy_tbid = None
-                    is_successful = parser.predict(
-                        self.lcode, init_seed, datasets, self.options,
-                        conllu_input, conllu_individual_output,
-                        proxy_tbid = proxy_tbid,
-                    )
-                if is_successful:
-                    ensemble_predictions.append(conllu_individual_output)
-                    number_parses_needed -= 1
-                    patience_left= patience_at_start
-                else:
-                    patience_left -= 1
-                    if self.options.debug:
-                        print('Parse failed.')
-                p_index += 1
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if votes.exceptions:
+            raise votes.exceptions[0]
+        ensemble_predictions = []
+        for parser_and_dataset in sorted(list(pad2freq.keys())):
+            for _, conllu_individual_output in sorted(votes.pad2votes[parser_and_dataset]):
+                ensemble_predictions.append(conllu_individual_output)
         if self.options.debug:
             print('%d of %d basic parses are ready' %(len(ensemble_predictions), n_parses))
         if len(ensemble_predictions) < n_parses:
@@ -967,6 +1243,18 @@ class Config_default:
             conllu_dataset.combine(ensemble_predictions, conllu_output, self.options)
 
 
+class EnsembleVotes:
+
+    ''' state shared by the ensemble members of Config_default.p_parse() '''
+
+    def __init__(self, max_parallel):
+        self.lock = threading.Lock()
+        self.semaphore = threading.Semaphore(max_parallel)
+        self.pad2next_index = {}
+        self.pad2votes = {}
+        self.n_failed = 0
+        self.exceptions = []
+
 class Config_with_more_datasets(Config_default):
 
     def get_dataset_names(self):
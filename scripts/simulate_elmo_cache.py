@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Replays request traces written by the elmo-npz worker with
+# EFML_NPZ_CACHE_TRACE=FILE and compares hit rates and recompute cost
+# of the eviction policies in eviction_policies.py.
+#
+# As in the elmo cache, new entries are held in memory and the cache
+# is only pruned back to its maximum load factor at each sync.
+
+from __future__ import print_function
+
+import sys
+
+import eviction_policies
+
+def print_usage():
+    print('Usage: %s [options] TRACE [TRACE ...]' %sys.argv[0])
+    print("""
+Options:
+
+    --records  N            Number of records of the simulated cache
+                            (Default: 100000)
+
+    --vectors-per-record  N Vectors (tokens) per record
+                            (Default: 6)
+
+    --sync-interval  SECONDS
+                            Trace time between syncs
+                            (Default: 900)
+
+    --max-load-factor  F    Fraction of records used after a sync
+                            (Default: 0.95)
+
+    --policy  NAME          Simulate policy NAME; can be repeated.
+                            (Default: all policies)
+""")
+
+class SimEntry:
+
+    def __init__(self, length):
+        self.length = length
+        self.last_access = 0.0
+        self.n_accesses  = 0
+        self.priority    = 0.0
+
+def read_trace(filenames):
+    trace = []
+    for filename in filenames:
+        f = open(filename, 'rb')
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            fields = line.split()
+            try:
+                trace.append((float(fields[0]), fields[1], int(fields[2])))
+            except (IndexError, ValueError):
+                # e.g. incomplete last line of a running worker
+                continue
+        f.close()
+    trace.sort(key = lambda x: x[0])
+    return trace
+
+def simulate(policy, trace, n_records, vectors_per_record, sync_interval, max_load_factor):
+    key2entry = {}
+    max_records = max_load_factor * n_records
+    retval = {
+        'hits': 0, 'misses': 0, 'cost': 0.0, 'tokens': 0,
+        'syncs': 0, 'evicted': 0,
+    }
+    next_sync = None
+    for now, key, length in trace:
+        if next_sync is None:
+            next_sync = now + sync_interval
+        if now >= next_sync:
+            candidates = []
+            for c_key, entry in key2entry.items():
+                n_parts = eviction_policies.get_n_parts(entry.length, vectors_per_record)
+                candidates.append((c_key, entry, n_parts, False))
+            _, evicted = eviction_policies.select_entries(
+                policy, candidates, max_records, now
+            )
+            evicted_entries = []
+            for _, c_key, _ in evicted:
+                evicted_entries.append(key2entry[c_key])
+                del key2entry[c_key]
+            policy.on_evict(evicted_entries)
+            retval['syncs'] += 1
+            retval['evicted'] += len(evicted)
+            next_sync = now + sync_interval
+        n_parts = eviction_policies.get_n_parts(length, vectors_per_record)
+        if key in key2entry:
+            entry = key2entry[key]
+            retval['hits'] += 1
+        else:
+            entry = SimEntry(length)
+            key2entry[key] = entry
+            policy.on_insert(entry, n_parts)
+            retval['misses'] += 1
+            retval['cost'] += eviction_policies.estimate_cost(length)
+            retval['tokens'] += length
+        entry.last_access = now
+        policy.on_access(entry, n_parts)
+    return retval
+
+def main():
+    opt_records = 100000
+    opt_vectors_per_record = 6
+    opt_sync_interval = 900.0
+    opt_max_load_factor = 0.95
+    opt_policies = []
+    while len(sys.argv) >= 2 and sys.argv[1][:1] == '-':
+        option = sys.argv[1]
+        option = option.replace('_', '-')
+        del sys.argv[1]
+        if option in ('--help', '-h'):
+            print_usage()
+            sys.exit(0)
+        elif option == '--records':
+            opt_records = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--vectors-per-record':
+            opt_vectors_per_record = int(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--sync-interval':
+            opt_sync_interval = float(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--max-load-factor':
+            opt_max_load_factor = float(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--policy':
+            opt_policies.append(sys.argv[1])
+            del sys.argv[1]
+        else:
+            print('Unsupported option %s' %option)
+            print_usage()
+            sys.exit(1)
+    if len(sys.argv) < 2:
+        print_usage()
+        sys.exit(1)
+    if not opt_policies:
+        opt_policies = sorted(eviction_policies.name2policy.keys())
+    trace = read_trace(sys.argv[1:])
+    if not trace:
+        raise ValueError('No requests found in trace')
+    print('%d requests, %.1f hours, %d records of %d vectors' %(
+        len(trace), (trace[-1][0] - trace[0][0]) / 3600.0,
+        opt_records, opt_vectors_per_record,
+    ))
+    print('Policy | Hit rate | Misses | Recomputed tokens | Recompute cost | Evicted')
+    print('-------+----------+--------+-------------------+----------------+--------')
+    for name in opt_policies:
+        result = simulate(
+            eviction_policies.new_policy(name), trace,
+            opt_records, opt_vectors_per_record,
+            opt_sync_interval, opt_max_load_factor,
+        )
+        print('%-7s|%8.2f%% |%7d |%18d |%15.0f |%8d' %(
+            name,
+            100.0 * result['hits'] / len(trace),
+            result['misses'],
+            result['tokens'],
+            result['cost'],
+            result['evicted'],
+        ))
+
+if __name__ == "__main__":
+    main()
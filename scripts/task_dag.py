@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Runs a graph of tasks in which tasks depend on other tasks of the
+# graph and/or on files, e.g. elmo npz -> udpf training -> prediction.
+# A task is released as soon as the tasks it depends on are completed
+# and its required files exist, instead of being picked up by the next
+# poll of a worker.
+#
+# Nodes are common_udpipe_future.Task objects or Python functions.
+# Executors:
+#
+#   queue  submit tasks to the task queue in EUD_TASK_DIR; completion is
+#          detected via the task master's completion records
+#   local  run tasks as child processes of this process, i.e. without
+#          any workers or SLURM jobs
+#
+# Python functions always run in a child process of this process.
+# The executor is selected with EUD_DAG_EXECUTOR (default: queue if
+# EUD_TASK_DIR is set, local otherwise).
+#
+# Ready nodes are started in the order they became ready unless
+# EUD_DAG_ORDER selects one of
+#
+#   sje       shortest expected job first
+#   critical  longest expected path to the end of the graph first
+#
+# Expected durations of tasks come from task_stats.py (EUD_TASK_STATS);
+# nodes of unknown duration count as the average node.
+#
+# Nodes that still wait for required files when the graph has nothing
+# else to wait for fail at their deadline, i.e. when the task expires
+# or, for functions, EUD_DAG_MAX_WAIT seconds after the graph started
+# (default: EUD_TASK_PATIENCE or 48 hours as for tasks).
+
+from __future__ import print_function
+
+import collections
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import file_watcher
+import task_index
+import task_stats
+import utilities
+
+def p_run_function(function, args, kw_args):
+    # do not use sqlite3 connections of the parent process
+    task_index.reset()
+    task_stats.reset()
+    function(*args, **kw_args)
+
+class LocalExecutor:
+
+    def __init__(self, max_parallel = None):
+        if not max_parallel:
+            max_parallel = multiprocessing.cpu_count()
+        self.max_parallel = max_parallel
+        self.poll_interval = 0.05
+
+    def start(self, node):
+        if node.task is not None:
+            task = node.task
+            print('Running', task.command)
+            sys.stdout.flush()
+            node.process = subprocess.Popen(task.command)
+        else:
+            node.process = multiprocessing.Process(
+                target = p_run_function,
+                args = (node.function, node.args, node.kw_args),
+            )
+            node.process.start()
+
+    def poll(self, node):
+        ''' returns None while the node is running, otherwise
+            whether it completed successfully
+        '''
+        process = node.process
+        if isinstance(process, subprocess.Popen):
+            returncode = process.poll()
+        else:
+            if process.is_alive():
+                return None
+            process.join()
+            returncode = process.exitcode
+        if returncode is None:
+            return None
+        node.process = None
+        return returncode == 0
+
+    def watch(self, node, watcher):
+        # child processes are polled
+        pass
+
+class QueueExecutor(LocalExecutor):
+
+    def __init__(self, max_parallel = None):
+        if not max_parallel:
+            # tasks run on workers, not on this machine
+            max_parallel = 1000000
+        LocalExecutor.__init__(self, max_parallel)
+        self.poll_interval = 30.0
+
+    def start(self, node):
+        if node.task is None:
+            LocalExecutor.start(self, node)
+            return
+        node.task.submit()
+        node.process = None
+
+    def poll(self, node):
+        if node.task is None:
+            return LocalExecutor.poll(self, node)
+        state = node.task.get_state()
+        if state in ('queued', 'active'):
+            return None
+        if state == 'failed':
+            return False
+        try:
+            node.task.finish()
+        except ValueError:
+            return False
+        return True
+
+    def watch(self, node, watcher):
+        if node.task is None or 'EUD_TASK_DIR' not in os.environ:
+            return
+        for state in ('active', 'completed'):
+            marker = node.task.get_marker_name(state)
+            utilities.makedirs(os.path.dirname(marker))
+            watcher.add(marker)
+
+def new_executor(name = None, max_parallel = None):
+    if name is None:
+        if 'EUD_DAG_EXECUTOR' in os.environ:
+            name = os.environ['EUD_DAG_EXECUTOR']
+        elif 'EUD_TASK_DIR' in os.environ:
+            name = 'queue'
+        else:
+            name = 'local'
+    if name == 'local':
+        return LocalExecutor(max_parallel)
+    elif name == 'queue':
+        return QueueExecutor(max_parallel)
+    raise ValueError('Unknown task graph executor %s' %name)
+
+class TaskGraph:
+
+    class Node:
+        def __init__(self, node_id, task, function, args, kw_args, depends_on, requires):
+            self.node_id    = node_id
+            self.task       = task
+            self.function   = function
+            self.args       = args
+            self.kw_args    = kw_args
+            self.depends_on = depends_on
+            self.requires   = requires
+            self.dependents = []
+            self.state      = 'waiting'  # ready, running, completed, failed or skipped
+            self.process    = None
+            self.expected_duration = None
+            self.path_duration     = None
+            self.n_missing_deps  = 0
+            self.missing_files   = set()
+            self.deadline        = None
+
+    def __init__(self):
+        self.nodes = collections.OrderedDict()
+
+    def p_add(self, node_id, task, function, args, kw_args, depends_on, requires):
+        if node_id is None:
+            node_id = 'node-%d' %(len(self.nodes) + 1)
+        if node_id in self.nodes:
+            raise ValueError('Duplicate node %s in task graph' %node_id)
+        for other_id in depends_on:
+            if other_id not in self.nodes:
+                raise ValueError('Node %s depends on unknown node %s' %(node_id, other_id))
+        self.nodes[node_id] = TaskGraph.Node(
+            node_id, task, function, args, kw_args,
+            list(depends_on), [utilities.bstring(x) for x in requires],
+        )
+        return node_id
+
+    def add_task(self, task, depends_on = [], node_id = None):
+        ''' adds a common_udpipe_future.Task, which also
+            waits for the required files of the task,
+            and returns its node id
+        '''
+        return self.p_add(node_id, task, None, None, None, depends_on, task.requires)
+
+    def add_function(self, function, args = (), kw_args = {}, depends_on = [], requires = [], node_id = None, expected_duration = None):
+        node_id = self.p_add(node_id, None, function, args, kw_args, depends_on, requires)
+        self.nodes[node_id].expected_duration = expected_duration
+        return node_id
+
+    def run(self, executor = None, max_parallel = None, verbose = True, order = None, max_wait = None):
+        ''' runs all nodes and returns a dictionary mapping
+            node ids to 'completed', 'failed' or 'skipped';
+            order: 'fifo', 'sje' or 'critical', see above;
+            max_wait: seconds function nodes wait for required
+            files, see above
+        '''
+        if max_wait is None:
+            if 'EUD_DAG_MAX_WAIT' in os.environ:
+                max_wait = float(os.environ['EUD_DAG_MAX_WAIT'])
+            elif 'EUD_TASK_PATIENCE' in os.environ:
+                max_wait = float(os.environ['EUD_TASK_PATIENCE'])
+            else:
+                max_wait = 48 * 3600.0
+        if order is None:
+            if 'EUD_DAG_ORDER' in os.environ:
+                order = os.environ['EUD_DAG_ORDER']
+            else:
+                order = 'fifo'
+        if order == 'sje':
+            self.p_estimate_durations()
+            sort_key = lambda x: x.expected_duration
+        elif order == 'critical':
+            self.p_estimate_durations()
+            sort_key = lambda x: -x.path_duration
+        elif order == 'fifo':
+            sort_key = None
+        else:
+            raise ValueError('Unknown task graph order %s' %order)
+        if executor is None:
+            executor = new_executor(max_parallel = max_parallel)
+        elif max_parallel:
+            executor.max_parallel = max_parallel
+        watcher = file_watcher.FileWatcher(scan_interval = 1.0)
+        file2nodes = {}
+        ready = []
+        start_time = time.time()
+        for node in self.nodes.values():
+            if node.task is not None:
+                node.deadline = node.task.expires
+            else:
+                node.deadline = start_time + max_wait
+            node.n_missing_deps = len(node.depends_on)
+            for other_id in node.depends_on:
+                self.nodes[other_id].dependents.append(node)
+            for filename in node.requires:
+                if os.path.exists(filename):
+                    continue
+                node.missing_files.add(filename)
+                if filename not in file2nodes:
+                    file2nodes[filename] = []
+                    watcher.add(filename)
+                file2nodes[filename].append(node)
+        for node in self.nodes.values():
+            self.p_check_ready(node, ready)
+        running = []
+        n_done = 0
+        next_verbose = start_time + 60.0
+        while n_done < len(self.nodes):
+            if sort_key is not None:
+                # stable sort keeps nodes of equal rank in fifo order
+                ready.sort(key = sort_key)
+            # start as many ready nodes as allowed
+            while ready and len(running) < executor.max_parallel:
+                node = ready.pop(0)
+                node.state = 'running'
+                executor.start(node)
+                executor.watch(node, watcher)
+                running.append(node)
+            # check running nodes
+            still_running = []
+            for node in running:
+                result = executor.poll(node)
+                if result is None:
+                    still_running.append(node)
+                    continue
+                n_done += 1
+                if result:
+                    node.state = 'completed'
+                    for dependent in node.dependents:
+                        dependent.n_missing_deps -= 1
+                        self.p_check_ready(dependent, ready)
+                else:
+                    node.state = 'failed'
+                    print('Node %s of task graph failed' %node.node_id)
+                    n_done += self.p_skip_dependents(node)
+            running = still_running
+            if n_done == len(self.nodes):
+                break
+            if ready and len(running) < executor.max_parallel:
+                continue
+            if not running and not ready and not file2nodes:
+                raise ValueError('Task graph cannot make progress')
+            # wait for a completion or a required file
+            if running:
+                timeout = executor.poll_interval
+            else:
+                # wake up in time to fail nodes past their deadline
+                timeout = 60.0
+                now = time.time()
+                for nodes in file2nodes.values():
+                    for node in nodes:
+                        timeout = min(timeout, max(0.1, node.deadline - now + 0.1))
+            watcher.wait(timeout)
+            for filename in watcher.poll():
+                if filename not in file2nodes or not os.path.exists(filename):
+                    continue
+                watcher.remove(filename)
+                for node in file2nodes[filename]:
+                    node.missing_files.discard(filename)
+                    self.p_check_ready(node, ready)
+                del file2nodes[filename]
+            now = time.time()
+            if not running and not ready:
+                n_done += self.p_fail_expired(file2nodes, watcher, now)
+            if verbose and now >= next_verbose:
+                print('Task graph: %d of %d nodes done, %d running, %d ready, %.1f minutes so far' %(
+                    n_done, len(self.nodes), len(running), len(ready),
+                    (now - start_time) / 60.0,
+                ))
+                if file2nodes:
+                    filenames = sorted([utilities.std_string(x) for x in file2nodes])
+                    print('Task graph: waiting for %d file(s), e.g. %s' %(
+                        len(filenames), ', '.join(filenames[:3]),
+                    ))
+                sys.stdout.flush()
+                next_verbose = now + 600.0
+        watcher.close()
+        retval = {}
+        for node_id, node in utilities.iteritems(self.nodes):
+            retval[node_id] = node.state
+        return retval
+
+    def p_fail_expired(self, file2nodes, watcher, now):
+        ''' fails nodes that only wait for required files and
+            are past their deadline, and returns the number of
+            nodes failed or skipped
+        '''
+        expired = []
+        for filename in sorted(file2nodes.keys()):
+            for node in file2nodes[filename]:
+                if node.state == 'waiting' \
+                and not node.n_missing_deps \
+                and now > node.deadline \
+                and node not in expired:
+                    expired.append(node)
+        n_done = 0
+        for node in expired:
+            node.state = 'failed'
+            print('Node %s of task graph failed: gave up waiting for %s' %(
+                node.node_id,
+                ', '.join(sorted([utilities.std_string(x) for x in node.missing_files])),
+            ))
+            n_done += 1 + self.p_skip_dependents(node)
+        # stop watching files no node waits for
+        for filename in list(file2nodes.keys()):
+            nodes = [node for node in file2nodes[filename] if node.state == 'waiting']
+            if nodes:
+                file2nodes[filename] = nodes
+            else:
+                watcher.remove(filename)
+                del file2nodes[filename]
+        return n_done
+
+    def p_estimate_durations(self):
+        ''' sets the expected duration of each node and of the
+            longest path from each node to the end of the graph
+        '''
+        stats = task_stats.get_task_stats()
+        known = []
+        for node in self.nodes.values():
+            if node.task is not None and stats is not None:
+                command_type, tbid = task_stats.get_task_kind(node.task.command)
+                node.expected_duration = stats.estimate_duration(
+                    node.task.queue_name, command_type, tbid, any_kind = True,
+                )
+            if node.expected_duration is not None:
+                known.append(node.expected_duration)
+        if known:
+            default = sum(known) / len(known)
+        else:
+            # all nodes count the same, i.e. the
+            # critical path is the longest chain
+            default = 1.0
+        # nodes can only depend on nodes added before them
+        path_duration = {}
+        for node in reversed(list(self.nodes.values())):
+            if node.expected_duration is None:
+                node.expected_duration = default
+            node.path_duration = node.expected_duration
+            if node.node_id in path_duration:
+                node.path_duration += path_duration[node.node_id]
+            for other_id in node.depends_on:
+                path_duration[other_id] = max(
+                    path_duration.get(other_id, 0.0), node.path_duration
+                )
+
+    def p_check_ready(self, node, ready):
+        if node.state == 'waiting' \
+        and not node.n_missing_deps and not node.missing_files:
+            node.state = 'ready'
+            ready.append(node)
+
+    def p_skip_dependents(self, node):
+        ''' marks all nodes that depend directly or indirectly on
+            the given node as skipped and returns their number
+        '''
+        n_skipped = 0
+        for dependent in node.dependents:
+            if dependent.state in ('waiting', 'ready'):
+                dependent.state = 'skipped'
+                n_skipped += 1
+                n_skipped += self.p_skip_dependents(dependent)
+        return n_skipped
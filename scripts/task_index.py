@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Index of the tasks of all queues in an SQLite database, enabled with
+# EUD_TASK_INDEX=PATH (or EUD_TASK_INDEX=1 for task-index.sqlite in
+# EUD_TASK_DIR), so that workers do not need to list and read the inbox
+# to find the next task.
+#
+# The task files in the inbox, active and completed folders remain the
+# authoritative record: the index only records priority, expiry,
+# required files and state, and workers claim a task by changing its
+# state in a single UPDATE before moving the task file as usual.
+# Workers using the index also add task files that are not in the index
+# now and then, e.g. tasks submitted without EUD_TASK_INDEX, and remove
+# tasks that finished, expired or disappeared more than an hour ago.
+#
+# The database uses write-ahead logging (WAL) by default. WAL needs
+# shared memory and therefore does not work if workers on different
+# hosts access the database on a network file system. In this case,
+# set EUD_TASK_INDEX_JOURNAL=delete to use SQLite's rollback journal
+# with fcntl() locks.
+#
+# Resources that tasks declare in their task file, e.g. cpus, are
+# stored as text in the form "cpus=4 mem_gb=16".
+#
+# The kind of each task, i.e. its script and treebank(s), see
+# task_stats.get_task_kind(), is stored so that workers can order
+# tasks by their expected duration without reading the task files.
+
+from __future__ import print_function
+
+import os
+import sqlite3
+import threading
+import time
+
+import task_stats
+import utilities
+
+class TaskIndex:
+
+    def __init__(self, path, journal_mode = None):
+        if journal_mode is None:
+            if 'EUD_TASK_INDEX_JOURNAL' in os.environ:
+                journal_mode = os.environ['EUD_TASK_INDEX_JOURNAL']
+            else:
+                journal_mode = 'wal'
+        self.path = path
+        self.db = sqlite3.connect(path, timeout = 300.0)
+        self.db.execute('PRAGMA journal_mode=%s' %journal_mode)
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                queue      TEXT NOT NULL,
+                task_id    TEXT NOT NULL,
+                bucket     TEXT NOT NULL,
+                priority   INTEGER NOT NULL,
+                expires    REAL NOT NULL,
+                requires   TEXT NOT NULL,
+                state      TEXT NOT NULL,
+                submitted  REAL NOT NULL,
+                worker     TEXT,
+                changed    REAL NOT NULL,
+                resources  TEXT NOT NULL DEFAULT '',
+                command_type TEXT NOT NULL DEFAULT '',
+                tbid       TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (queue, task_id)
+            )""")
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(tasks)')]
+            # index created before tasks declared resources
+            # or before the kind of tasks was recorded
+            for column in ('resources', 'command_type', 'tbid'):
+                if column not in columns:
+                    self.db.execute("ALTER TABLE tasks ADD COLUMN %s TEXT NOT NULL DEFAULT ''" %column)
+            self.db.execute("""CREATE INDEX IF NOT EXISTS tasks_by_state
+                ON tasks (queue, state, priority, submitted)
+            """)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, queue_name, task_id, bucket, priority, expires, requires, submitted = None, resources = None, command = None):
+        ''' records a task in the inbox, ignoring tasks
+            that are already in the index
+        '''
+        self.add_many([(
+            queue_name, task_id, bucket, priority, expires, requires,
+            submitted, resources, command,
+        )])
+
+    def add_many(self, rows):
+        ''' like add() for a list of tuples of its parameters,
+            in a single transaction
+        '''
+        now = time.time()
+        values = []
+        for queue_name, task_id, bucket, priority, expires, requires, submitted, resources, command in rows:
+            if submitted is None:
+                submitted = now
+            if command:
+                command_type, tbid = task_stats.get_task_kind(command)
+            else:
+                command_type, tbid = '', ''
+            values.append((
+                utilities.std_string(queue_name),
+                utilities.std_string(task_id),
+                utilities.std_string(bucket),
+                priority, expires,
+                '\n'.join([utilities.std_string(x) for x in requires]),
+                'queued', submitted, now,
+                format_resources(resources),
+                command_type, tbid,
+            ))
+        with self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, ?, ?, ?, ?)',
+                values
+            )
+
+    def get_candidates(self, queue_name):
+        ''' returns all queued tasks in order of priority as
+            tuples (task_id, bucket, priority, expires, requires, resources,
+            command_type, tbid)
+
+            There is no limit as the caller filters by required
+            files and free resources and may re-order the tasks,
+            i.e. any queued task may be the one to run next.
+        '''
+        retval = []
+        for task_id, bucket, priority, expires, requires, resources, command_type, tbid in self.db.execute(
+            """SELECT task_id, bucket, priority, expires, requires, resources,
+                      command_type, tbid FROM tasks
+               WHERE queue = ? AND state = 'queued'
+               ORDER BY priority, submitted""",
+            (utilities.std_string(queue_name),)
+        ):
+            if requires:
+                requires = [utilities.bstring(x) for x in requires.split('\n')]
+            else:
+                requires = []
+            retval.append((
+                utilities.bstring(task_id), utilities.bstring(bucket),
+                priority, expires, requires, parse_resources(resources),
+                command_type, tbid,
+            ))
+        return retval
+
+    def get_task_ids(self, queue_name, state = 'queued'):
+        retval = set()
+        for row in self.db.execute(
+            'SELECT task_id FROM tasks WHERE queue = ? AND state = ?',
+            (utilities.std_string(queue_name), state)
+        ):
+            retval.add(utilities.bstring(row[0]))
+        return retval
+
+    def claim(self, queue_name, task_id, worker):
+        ''' marks a queued task as active and returns True if
+            no other worker claimed it first
+        '''
+        with self.db:
+            cursor = self.db.execute(
+                """UPDATE tasks SET state = 'active', worker = ?, changed = ?
+                   WHERE queue = ? AND task_id = ? AND state = 'queued'""",
+                (worker, time.time(), utilities.std_string(queue_name),
+                 utilities.std_string(task_id))
+            )
+            return cursor.rowcount == 1
+
+    def set_state(self, queue_name, task_id, state):
+        with self.db:
+            self.db.execute(
+                'UPDATE tasks SET state = ?, changed = ? WHERE queue = ? AND task_id = ?',
+                (state, time.time(), utilities.std_string(queue_name),
+                 utilities.std_string(task_id))
+            )
+
+    def purge(self, queue_name, before):
+        ''' removes tasks that are no longer queued or active and
+            did not change since the given time, e.g. completed and
+            expired tasks, and returns the number of tasks removed
+        '''
+        with self.db:
+            cursor = self.db.execute(
+                """DELETE FROM tasks WHERE queue = ?
+                   AND state NOT IN ('queued', 'active') AND changed < ?""",
+                (utilities.std_string(queue_name), before)
+            )
+            return cursor.rowcount
+
+    def count_states(self, queue_name):
+        retval = {}
+        for state, count in self.db.execute(
+            'SELECT state, COUNT(*) FROM tasks WHERE queue = ? GROUP BY state',
+            (utilities.std_string(queue_name),)
+        ):
+            retval[state] = count
+        return retval
+
+def format_resources(resources):
+    if not resources:
+        return ''
+    return ' '.join(['%s=%g' %(name, resources[name]) for name in sorted(resources)])
+
+def parse_resources(text):
+    retval = {}
+    for item in text.split():
+        name, value = item.split('=')
+        retval[name] = float(value)
+    return retval
+
+def get_index_path():
+    ''' returns the path configured with EUD_TASK_INDEX or None '''
+    if 'EUD_TASK_INDEX' not in os.environ:
+        return None
+    path = os.environ['EUD_TASK_INDEX']
+    if path.lower() in ('', '0', 'false'):
+        return None
+    if path.lower() in ('1', 'true'):
+        path = os.path.join(os.environ['EUD_TASK_DIR'], 'task-index.sqlite')
+    return path
+
+# sqlite3 connections must not be used in other threads
+# --> one TaskIndex object per thread
+p_local = threading.local()
+
+def get_task_index():
+    ''' returns the task index of this thread or
+        None if EUD_TASK_INDEX is not set
+    '''
+    try:
+        return p_local.index
+    except AttributeError:
+        pass
+    path = get_index_path()
+    if path is None:
+        return None
+    p_local.index = TaskIndex(path)
+    return p_local.index
+
+def reset():
+    ''' forgets the task index objects of this process, e.g. in
+        a child process after fork() as sqlite3 connections must
+        not be used in more than one process
+    '''
+    global p_local
+    p_local = threading.local()
@@ -0,0 +1,547 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Statistics of completed tasks: the completion records that workers
+# write to the completed and archive folders of each queue are indexed
+# in an SQLite database, enabled with EUD_TASK_STATS=PATH (or
+# EUD_TASK_STATS=1 for task-stats.sqlite in EUD_TASK_DIR). Workers add
+# their records as they write them; records of other workers are added
+# when a worker or this script scans the queue folders.
+#
+# Durations are modelled per queue by the empirical distribution of
+# earlier durations of tasks of the same kind, i.e. the same script
+# and treebank(s), falling back to the same script and then to the
+# whole queue if there are too few samples. The expected time to
+# completion of a running task is the median remaining duration of the
+# earlier tasks that ran longer than the task so far.
+#
+# Run this script to summarise throughput per queue:
+#
+#   task_stats.py [options] [QUEUE ...]
+#
+# As with task_index.py, set EUD_TASK_STATS_JOURNAL=delete if workers on
+# different hosts share the database on a network file system.
+
+from __future__ import print_function
+
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import utilities
+
+def print_usage():
+    print('Usage: %s [options] [QUEUE ...]' %sys.argv[0])
+    print("""
+Options:
+
+    --database  PATH        SQLite database with the statistics
+                            (Default: as configured with EUD_TASK_STATS)
+
+    --update                Add completion records in EUD_TASK_DIR that
+                            are not in the database yet
+
+    --hours  H              Only consider tasks that finished in the
+                            last H hours
+                            (Default: 0 = all tasks)
+
+    --kinds                 Also show durations per kind of task
+
+    --active                List active tasks with their expected
+                            time to completion
+""")
+
+script_extensions = ('.sh', '.py', '.pl')
+
+# datasets such as task.en_ewt+ud25.en_gum appear with '.'
+# replaced by '_' in model folders and concatenated conllu files
+dataset_tbid_re = re.compile(r'(?:^|[-+/])(?:task|ud25)[._]([a-z]+_[a-z0-9]+)')
+conllu_tbid_re  = re.compile(r'(?:^|/)([a-z]+_[a-z0-9]+)-ud-')
+
+def get_task_kind(command):
+    ''' returns the script and the treebank(s) of a task command,
+        e.g. ('plain_udpf-train.sh', 'en_ewt') for a udpf training task;
+        the script is '' for queues that pass data to a fixed task
+        processor, e.g. elmo-npz, and the treebank is '' if unknown
+    '''
+    command = [utilities.std_string(x) for x in command]
+    command_type = ''
+    if command:
+        basename = os.path.basename(command[0])
+        if '.' not in basename or basename.endswith(script_extensions):
+            command_type = basename
+    for arg in command:
+        tbids = dataset_tbid_re.findall(arg)
+        if not tbids:
+            tbids = conllu_tbid_re.findall(arg)
+        if tbids:
+            unique_tbids = []
+            for tbid in tbids:
+                if tbid not in unique_tbids:
+                    unique_tbids.append(tbid)
+            return command_type, '+'.join(unique_tbids)
+    return command_type, ''
+
+def read_completion_record(filename):
+    ''' returns the header fields and the command of a completion
+        record or None if the file cannot be read
+    '''
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    data = f.read()
+    f.close()
+    header, _, command = data.partition(b'\n\n')
+    fields = {}
+    for line in header.split(b'\n'):
+        line = line.split(b'\t')
+        if len(line) == 2:
+            fields[utilities.std_string(line[0])] = utilities.std_string(line[1])
+    command = command.split(b'\n')
+    # handle last line with linebreak
+    if command and command[-1] == b'':
+        del command[-1]
+    return fields, command
+
+def get_quantile(values, quantile):
+    ''' returns the quantile of a sorted list of values '''
+    return values[min(len(values) - 1, int(quantile * len(values)))]
+
+class TaskStats:
+
+    def __init__(self, path, journal_mode = None):
+        if journal_mode is None:
+            if 'EUD_TASK_STATS_JOURNAL' in os.environ:
+                journal_mode = os.environ['EUD_TASK_STATS_JOURNAL']
+            else:
+                journal_mode = 'wal'
+        self.path = path
+        self.db = sqlite3.connect(path, timeout = 300.0)
+        self.db.execute('PRAGMA journal_mode=%s' %journal_mode)
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS records (
+                queue        TEXT NOT NULL,
+                task_id      TEXT NOT NULL,
+                command_type TEXT NOT NULL,
+                tbid         TEXT NOT NULL,
+                host         TEXT NOT NULL,
+                submitted    REAL NOT NULL,
+                started      REAL NOT NULL,
+                finished     REAL NOT NULL,
+                speculative  INTEGER NOT NULL,
+                resources    TEXT NOT NULL,
+                PRIMARY KEY (queue, task_id, started)
+            )""")
+            self.db.execute("""CREATE INDEX IF NOT EXISTS records_by_finished
+                ON records (queue, finished)
+            """)
+        # duration models per queue, see get_durations()
+        self.queue2models = {}
+        self.model_refresh_interval = 600.0
+
+    def close(self):
+        self.db.close()
+
+    def add(self, queue_name, task_id, command, submitted, started, finished,
+        host = None, speculative = False, resources = None
+    ):
+        ''' records a completed task, ignoring tasks that
+            are already in the database
+        '''
+        self.add_many([(
+            queue_name, task_id, command, submitted, started, finished,
+            host, speculative, resources,
+        )])
+
+    def add_many(self, rows):
+        ''' like add() for a list of tuples of its parameters,
+            in a single transaction
+        '''
+        values = []
+        for queue_name, task_id, command, submitted, started, finished, \
+        host, speculative, resources in rows:
+            command_type, tbid = get_task_kind(command)
+            # same format as in task_index.py
+            resources = ' '.join([
+                '%s=%g' %(name, resources[name]) for name in sorted(resources or {})
+            ])
+            values.append((
+                utilities.std_string(queue_name),
+                utilities.std_string(task_id),
+                command_type, tbid,
+                utilities.std_string(host) if host else '',
+                submitted, started, finished,
+                1 if speculative else 0,
+                resources,
+            ))
+        with self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                values
+            )
+        for queue_name, _, _, _, _, _, _, _, _ in rows:
+            # refit with the new durations on next use
+            self.queue2models.pop(utilities.std_string(queue_name), None)
+
+    def get_task_ids(self, queue_name):
+        retval = set()
+        for row in self.db.execute(
+            'SELECT task_id FROM records WHERE queue = ?',
+            (utilities.std_string(queue_name),)
+        ):
+            retval.add(utilities.bstring(row[0]))
+        return retval
+
+    def update_queue(self, queue_dir, queue_name = None):
+        ''' adds the completion records of the queue that are not in
+            the database and returns their number
+        '''
+        queue_dir = utilities.bstring(queue_dir)
+        if queue_name is None:
+            queue_name = os.path.basename(queue_dir)
+        known = self.get_task_ids(queue_name)
+        filenames = []
+        final_dir = b'/'.join((queue_dir, b'completed'))
+        try:
+            buckets = os.listdir(final_dir)
+        except OSError:
+            buckets = []
+        for bucket in buckets:
+            bucket_dir = b'/'.join((final_dir, bucket))
+            try:
+                names = os.listdir(bucket_dir)
+            except OSError:
+                continue
+            for filename in names:
+                if filename.endswith(b'.task') \
+                and filename[:-5] not in known:
+                    filenames.append(b'/'.join((bucket_dir, filename)))
+        archive_dir = b'/'.join((queue_dir, b'archive'))
+        try:
+            names = os.listdir(archive_dir)
+        except OSError:
+            names = []
+        for filename in names:
+            # see Task.finish()
+            if filename.endswith(b'.task') \
+            and filename[:-5].rsplit(b'-run', 1)[0] not in known:
+                filenames.append(b'/'.join((archive_dir, filename)))
+        rows = []
+        for filename in filenames:
+            details = read_completion_record(filename)
+            if details is None:
+                continue
+            fields, command = details
+            try:
+                submitted = float(fields['submitted'])
+                started   = float(fields['start'])
+                finished  = float(fields['end'])
+                task_id   = fields['task_id']
+            except (KeyError, ValueError):
+                # incomplete or very old record
+                continue
+            resources = {}
+            for name in ('cpus', 'mem_gb', 'gpu'):
+                # see resource_names in common_udpipe_future.py
+                if name in fields:
+                    resources[name] = float(fields[name])
+            rows.append((
+                queue_name, task_id, command, submitted, started, finished,
+                fields.get('host'), 'speculative' in fields, resources,
+            ))
+        if rows:
+            self.add_many(rows)
+        return len(rows)
+
+    def update(self, task_dir, queue_names = None):
+        ''' runs update_queue() for the given or all queues in the
+            task folder and returns the number of records added
+        '''
+        task_dir = utilities.bstring(task_dir)
+        if queue_names is None:
+            queue_names = []
+            for name in sorted(os.listdir(task_dir)):
+                if os.path.isdir(b'/'.join((task_dir, name, b'completed'))) \
+                or os.path.isdir(b'/'.join((task_dir, name, b'archive'))):
+                    queue_names.append(name)
+        n_added = 0
+        for queue_name in queue_names:
+            queue_name = utilities.bstring(queue_name)
+            n_added += self.update_queue(b'/'.join((task_dir, queue_name)), queue_name)
+        return n_added
+
+    def get_durations(self, queue_name, command_type = None, tbid = None):
+        ''' returns the sorted durations of the queue's tasks of the given
+            kind, not counting re-executions of stragglers; with tbid None,
+            all treebanks, and with command_type None, all tasks
+        '''
+        queue_name = utilities.std_string(queue_name)
+        now = time.time()
+        if queue_name in self.queue2models:
+            fitted, models = self.queue2models[queue_name]
+            if now > fitted + self.model_refresh_interval:
+                # another process may have added records
+                models = None
+        else:
+            models = None
+        if models is None:
+            models = {}
+            for command_type_r, tbid_r, duration in self.db.execute(
+                """SELECT command_type, tbid, finished - started FROM records
+                   WHERE queue = ? AND speculative = 0""",
+                (queue_name,)
+            ):
+                for key in (
+                    (command_type_r, tbid_r),
+                    (command_type_r, None),
+                    (None, None),
+                ):
+                    if key not in models:
+                        models[key] = []
+                    models[key].append(duration)
+            for durations in models.values():
+                durations.sort()
+            self.queue2models[queue_name] = (now, models)
+        if command_type is None:
+            tbid = None
+        key = (utilities.std_string(command_type), utilities.std_string(tbid))
+        if key in models:
+            return models[key]
+        return []
+
+    def estimate_duration(self, queue_name, command_type, tbid = '',
+        min_samples = 3, quantile = 0.5, any_kind = False
+    ):
+        ''' returns the given quantile of the durations of tasks of the
+            same kind or None if there are fewer than min_samples
+            such tasks; with any_kind, falls back to all tasks of
+            the queue
+        '''
+        levels = [(command_type, tbid), (command_type, None)]
+        if any_kind:
+            levels.append((None, None))
+        for command_type, tbid in levels:
+            durations = self.get_durations(queue_name, command_type, tbid)
+            if len(durations) >= min_samples:
+                return get_quantile(durations, quantile)
+        return None
+
+    def get_eta(self, queue_name, command, start_time, now = None, min_samples = 3):
+        ''' returns the expected remaining duration of a task that started
+            at start_time or None if earlier tasks of this kind did not
+            run this long or there are too few of them
+        '''
+        if now is None:
+            now = time.time()
+        elapsed = now - start_time
+        command_type, tbid = get_task_kind(command)
+        for command_type, tbid in [(command_type, tbid), (command_type, None)]:
+            durations = self.get_durations(queue_name, command_type, tbid)
+            if len(durations) < min_samples:
+                continue
+            longer = [x for x in durations if x > elapsed]
+            if not longer:
+                return None
+            return longer[len(longer)//2] - elapsed
+        return None
+
+    def get_rows(self, queue_names = None, since = None):
+        ''' returns tuples (queue, command_type, tbid, submitted, started,
+            finished, speculative) of records finished after since
+        '''
+        query = """SELECT queue, command_type, tbid, submitted, started,
+                   finished, speculative FROM records WHERE finished >= ?"""
+        params = [since or 0.0]
+        if queue_names:
+            query += ' AND queue IN (%s)' %(', '.join(['?'] * len(queue_names)))
+            params += [utilities.std_string(x) for x in queue_names]
+        return list(self.db.execute(query + ' ORDER BY queue, finished', params))
+
+def get_stats_path():
+    ''' returns the path configured with EUD_TASK_STATS or None '''
+    if 'EUD_TASK_STATS' not in os.environ:
+        return None
+    path = os.environ['EUD_TASK_STATS']
+    if path.lower() in ('', '0', 'false'):
+        return None
+    if path.lower() in ('1', 'true'):
+        path = os.path.join(os.environ['EUD_TASK_DIR'], 'task-stats.sqlite')
+    return path
+
+# sqlite3 connections must not be used in other threads
+# --> one TaskStats object per thread
+p_local = threading.local()
+
+def get_task_stats():
+    ''' returns the task statistics of this thread or
+        None if EUD_TASK_STATS is not set
+    '''
+    try:
+        return p_local.stats
+    except AttributeError:
+        pass
+    path = get_stats_path()
+    if path is None:
+        return None
+    p_local.stats = TaskStats(path)
+    return p_local.stats
+
+def reset():
+    ''' forgets the task statistics objects of this process, e.g. in
+        a child process after fork() as sqlite3 connections must
+        not be used in more than one process
+    '''
+    global p_local
+    p_local = threading.local()
+
+def format_minutes(seconds):
+    if seconds is None:
+        return '-'
+    return '%.1f' %(seconds / 60.0)
+
+def print_summary(stats, queue_names, since, opt_kinds):
+    group2rows = {}
+    for row in stats.get_rows(queue_names, since):
+        queue_name, command_type, tbid = row[:3]
+        groups = [(queue_name, None, None)]
+        if opt_kinds:
+            groups.append((queue_name, command_type, tbid))
+        for group in groups:
+            if group not in group2rows:
+                group2rows[group] = []
+            group2rows[group].append(row)
+    if not group2rows:
+        print('No completed tasks found')
+        return
+    print('Queue / kind                        | Tasks | Tasks/hour | Busy hours | Wait (min) | Duration (min) | P90 (min) | Speculative')
+    print('------------------------------------+-------+------------+------------+------------+----------------+-----------+------------')
+    for group in sorted(group2rows, key = lambda x: (x[0], x[1] is not None, x[1] or '', x[2] or '')):
+        rows = group2rows[group]
+        queue_name, command_type, tbid = group
+        if command_type is None:
+            label = queue_name
+        else:
+            label = '  %s %s' %(command_type or '(data)', tbid or '(unknown tbid)')
+        waiting = sorted([x[4] - x[3] for x in rows])
+        durations = sorted([x[5] - x[4] for x in rows if not x[6]])
+        if since:
+            hours = (time.time() - since) / 3600.0
+        else:
+            first = min([x[3] for x in rows])
+            hours = max(rows[-1][5] - first, 1.0) / 3600.0
+        print('%-36s|%6d |%11.2f |%11.1f |%11s |%15s |%10s |%7d' %(
+            label[:36], len(rows),
+            len(rows) / hours,
+            sum([x[5] - x[4] for x in rows]) / 3600.0,
+            format_minutes(get_quantile(waiting, 0.5)),
+            format_minutes(get_quantile(durations, 0.5) if durations else None),
+            format_minutes(get_quantile(durations, 0.9) if durations else None),
+            sum([x[6] for x in rows]),
+        ))
+
+def print_active(stats, task_dir, queue_names):
+    now = time.time()
+    print()
+    print('Queue           | Task                                                | Worker             | Running (min) | ETA (min)')
+    print('----------------+-----------------------------------------------------+--------------------+---------------+----------')
+    for queue_name in queue_names:
+        active_dir = b'/'.join((task_dir, queue_name, b'active'))
+        try:
+            buckets = sorted(os.listdir(active_dir))
+        except OSError:
+            continue
+        for bucket in buckets:
+            bucket_dir = b'/'.join((active_dir, bucket))
+            for filename in sorted(os.listdir(bucket_dir)):
+                if not filename.endswith(b'.task'):
+                    continue
+                active_name = b'/'.join((bucket_dir, filename))
+                # same header format as completion records
+                details = read_completion_record(active_name)
+                if details is None:
+                    continue
+                fields, command = details
+                worker_name = fields.get('worker')
+                if 'start' in fields:
+                    start = float(fields['start'])
+                    eta = stats.get_eta(queue_name, command, start, now)
+                    running = now - start
+                else:
+                    # no start record, e.g. heartbeats disabled
+                    eta = None
+                    running = None
+                print('%-16s|%-53s|%-20s|%14s |%10s' %(
+                    utilities.std_string(queue_name)[:16],
+                    utilities.std_string(filename[:-5])[:53],
+                    (worker_name or '-')[:20],
+                    format_minutes(running),
+                    format_minutes(eta),
+                ))
+
+def main():
+    opt_database = None
+    opt_update = False
+    opt_hours = 0.0
+    opt_kinds = False
+    opt_active = False
+    while len(sys.argv) >= 2 and sys.argv[1][:1] == '-':
+        option = sys.argv[1]
+        option = option.replace('_', '-')
+        del sys.argv[1]
+        if option in ('--help', '-h'):
+            print_usage()
+            sys.exit(0)
+        elif option == '--database':
+            opt_database = sys.argv[1]
+            del sys.argv[1]
+        elif option == '--update':
+            opt_update = True
+        elif option == '--hours':
+            opt_hours = float(sys.argv[1])
+            del sys.argv[1]
+        elif option == '--kinds':
+            opt_kinds = True
+        elif option == '--active':
+            opt_active = True
+        else:
+            print('Unsupported option %s' %option)
+            print_usage()
+            sys.exit(1)
+    queue_names = [utilities.bstring(x) for x in sys.argv[1:]]
+    if opt_database is None:
+        opt_database = get_stats_path()
+    if opt_database is None:
+        raise ValueError('No database specified and EUD_TASK_STATS not set')
+    stats = TaskStats(opt_database)
+    if opt_update or opt_active:
+        task_dir = utilities.bstring(os.environ['EUD_TASK_DIR'])
+        if not queue_names:
+            queue_names = sorted([
+                x for x in os.listdir(task_dir)
+                if os.path.isdir(b'/'.join((task_dir, x, b'active')))
+            ])
+    if opt_update:
+        n_added = stats.update(task_dir, queue_names or None)
+        print('Added %d completion record(s)' %n_added)
+    since = None
+    if opt_hours:
+        since = time.time() - 3600.0 * opt_hours
+    print_summary(stats, queue_names, since, opt_kinds)
+    if opt_active:
+        print_active(stats, task_dir, queue_names)
+    stats.close()
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,7 @@ import hashlib
 import os
 import random as py_random
 import subprocess
+import threading
 import time
 
 def get_score_stats(scores):
@@ -432,16 +433,24 @@ def conllu_with_tbemb(datasets, options, conllu_input, proxy_tbid):
         filename = '%s/%s-proxy_%s.conllu' %(
             tbembdir, basename, tbemb.replace('.', '_')
         )
-        write_multi_treebank_conllu(filename, [(tbemb, conllu_input),])
     else:
         all_tbemb.sort()
         filename = '%s/%s-proxy_random_%s.conllu' %(
             tbembdir, basename, '_'.join(all_tbemb).replace('.', '_')
         )
+    # ensemble members may read the file in parallel, see
+    # shared_task_2020.py --> move into place when complete
+    temp_name = '%s-%d-%d' %(
+        filename, os.getpid(), threading.current_thread().ident
+    )
+    if tbemb:
+        write_multi_treebank_conllu(temp_name, [(tbemb, conllu_input),])
+    else:
         write_multi_treebank_conllu(
-            filename, [(None, conllu_input),],
+            temp_name, [(None, conllu_input),],
             random_choices = all_tbemb
         )
+    os.rename(temp_name, filename)
     return filename
 
 def get_conllu_and_text_for_dataset(dataset, options, dataset_partition = 'train'):
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# (C) 2020 Dublin City University
+# All rights reserved. This material may not be
+# reproduced, displayed, modified or distributed without the express prior
+# written permission of the copyright holder.
+
+# Author: Joachim Wagner
+
+# Alternative to npz files for handing over the vectors of a list of
+# sentences: all vectors are concatenated into a single .npy file that
+# consumers can memory-map, and a second .npy file `PATH.offsets.npy`
+# holds the index of the first row of each sentence plus the total
+# number of rows.
+#
+# The offsets file is written first and the vector file is moved into
+# place with rename(), i.e. once PATH exists both files are complete.
+
+from __future__ import print_function
+
+import os
+
+import numpy
+
+def get_offsets_name(path):
+    return path + '.offsets.npy'
+
+def write(path, vectors_list):
+    ''' writes the vectors of all sentences, each an array with
+        one row per token and the same trailing shape and dtype
+    '''
+    if not vectors_list:
+        raise ValueError('Cannot write empty list of vectors to %s' %path)
+    offsets = numpy.zeros((len(vectors_list)+1,), dtype = '<i8')
+    row_shape = vectors_list[0].shape[1:]
+    dtype = vectors_list[0].dtype
+    for index, vectors in enumerate(vectors_list):
+        if vectors.shape[1:] != row_shape:
+            raise ValueError('Vectors of sentence %d have shape %r, expected %r' %(
+                index, vectors.shape, (vectors.shape[0],) + row_shape
+            ))
+        offsets[index+1] = offsets[index] + vectors.shape[0]
+    numpy.save(get_offsets_name(path) + '.prep.npy', offsets)
+    os.rename(get_offsets_name(path) + '.prep.npy', get_offsets_name(path))
+    prep_name = path + '.prep.npy'
+    data = numpy.lib.format.open_memmap(
+        prep_name, mode = 'w+', dtype = dtype,
+        shape = (int(offsets[-1]),) + row_shape,
+    )
+    for index, vectors in enumerate(vectors_list):
+        data[offsets[index]:offsets[index+1]] = vectors
+    data.flush()
+    del data
+    os.rename(prep_name, path)
+
+def remove(path):
+    for filename in (path, get_offsets_name(path)):
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+class VectorArray:
+
+    ''' Read-only access to a file written with write(). Sentences
+        are returned as views of the memory-mapped file without
+        copying. Like the object returned by numpy.load() for npz
+        files, it also accepts keys 'arr_0', 'arr_1', etc.
+    '''
+
+    def __init__(self, path):
+        self.offsets = numpy.load(get_offsets_name(path))
+        self.data = numpy.load(path, mmap_mode = 'r')
+        if self.data.shape[0] != self.offsets[-1]:
+            raise ValueError('Offsets in %s do not match %s' %(
+                get_offsets_name(path), path
+            ))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if hasattr(index, 'startswith'):
+            if not index.startswith('arr_'):
+                raise KeyError(index)
+            index = int(index[4:])
+        if index < 0 or index >= len(self):
+            raise IndexError('Sentence index %d out of range' %index)
+        return self.data[self.offsets[index]:self.offsets[index+1]]
+
+    def keys(self):
+        return ['arr_%d' %index for index in range(len(self))]
+
+    def close(self):
+        self.data = None